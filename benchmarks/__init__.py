@@ -0,0 +1 @@
+"""Benchmarks for the ingest pipeline. See benchmarks/ingest.py."""
@@ -0,0 +1,129 @@
+"""Synthetic documents (PDFs and images) for benchmarks.
+
+Pages are drawn with lines of pseudo-random words, so that every page (and
+document) is unique and nothing is served from the parse cache or deduplicated
+(see processing.DocumentProcessor.copy_identical_document) by accident.
+"""
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+
+# Page sizes in points (1/72 inch).
+PAGE_SIZES = {
+    'a5': (420, 595),
+    'a4': (595, 842),
+    'letter': (612, 792),
+    'a3': (842, 1191),
+}
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam '
+    'quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+    'consequat duis aute irure in reprehenderit voluptate velit esse cillum '
+    'eu fugiat nulla pariatur excepteur sint occaecat cupidatat non proident '
+    'sunt culpa qui officia deserunt mollit anim id est laborum'
+).split()
+
+
+def draw_page(page_size='letter', dpi=100, rng=None):
+    """Draw a page of text.
+
+    Args:
+        page_size: str - One of PAGE_SIZES. Default 'letter'.
+        dpi: int - Optional. Resolution to draw the page at. Default 100.
+        rng: random.Random - Optional. Source of the page's words.
+
+    Returns:
+        PIL.Image.Image: A greyscale image of the page.
+    """
+    rng = rng or random.Random()
+    width_pts, height_pts = PAGE_SIZES[page_size]
+    width, height = int(width_pts * dpi / 72), int(height_pts * dpi / 72)
+
+    page = Image.new('L', (width, height), color=255)
+    draw = ImageDraw.Draw(page)
+
+    margin = int(0.75 * dpi)
+    line_height = max(12, dpi // 6)
+    for y in range(margin, height - margin, line_height):
+        words = []
+        # ~6px per character with the default font.
+        while len(' '.join(words)) * 6 < width - 2 * margin:
+            words.append(rng.choice(WORDS))
+
+        draw.text((margin, y), ' '.join(words[:-1]), fill=0)
+
+    return page
+
+
+def make_pdf(path, num_pages, page_size='letter', dpi=100, seed=None):
+    """Write a PDF of num_pages synthetic pages to path.
+
+    Returns:
+        str: path.
+    """
+    rng = random.Random(seed)
+    pages = [draw_page(page_size, dpi, rng) for _ in range(num_pages)]
+    pages[0].save(path, 'PDF', resolution=dpi, save_all=True, append_images=pages[1:])
+
+    return path
+
+
+def make_image(path, page_size='letter', dpi=150, seed=None):
+    """Write an image of a synthetic page to path, in the format its extension implies.
+
+    Returns:
+        str: path.
+    """
+    draw_page(page_size, dpi, random.Random(seed)).save(path)
+
+    return path
+
+
+def make_corpus(folder, pdf_pages=(1, 10, 50), page_sizes=('letter', 'a4'),
+        image_formats=('png', 'jpeg'), seed=None):
+    """Generate a set of synthetic documents.
+
+    One PDF for each combination of page count and page size, and one image
+    for each combination of image format and page size.
+
+    Args:
+        folder: str - Where to write the documents.
+        pdf_pages: list of int - Optional. Page counts of the PDFs.
+        page_sizes: list of str - Optional. Page sizes (see PAGE_SIZES).
+        image_formats: list of str - Optional. Image file extensions.
+        seed: int - Optional. Seed for the documents' contents.
+
+    Returns:
+        list of dict: Each document's name, path, type ('pdf' or 'image'),
+            number of pages and page size.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+
+    corpus = []
+    for page_size in page_sizes:
+        for num_pages in pdf_pages:
+            name = f'synthetic-{num_pages}p-{page_size}.pdf'
+            corpus.append({
+                'name': name,
+                'path': make_pdf(os.path.join(folder, name), num_pages, page_size, seed=rng.random()),
+                'type': 'pdf',
+                'pages': num_pages,
+                'page_size': page_size,
+            })
+
+        for image_format in image_formats:
+            name = f'synthetic-{page_size}.{image_format}'
+            corpus.append({
+                'name': name,
+                'path': make_image(os.path.join(folder, name), page_size, seed=rng.random()),
+                'type': 'image',
+                'pages': 1,
+                'page_size': page_size,
+            })
+
+    return corpus
@@ -0,0 +1,414 @@
+"""End to end ingest benchmark.
+
+Generates a synthetic corpus (see benchmarks/corpus.py) and runs each document
+through DocumentProcessor.process, as an ingest worker would, but against
+replayed LLM and embedding backends (see llm/replay.py) with synthetic
+latency. Reports pages/sec, time per stage, DB round trips and peak RSS per
+document, as JSON.
+
+Needs the database (migrated) and Poppler, as the app does. Run from the
+repository root:
+
+    python -m benchmarks.ingest --pdf-pages 1,10,50 --llm-latency-ms 500 --output results.json
+
+Stage times are busy time, summed over concurrent calls, so with pipelining
+they can add up to more than the document's wall time.
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from benchmarks.corpus import PAGE_SIZES, WORDS, make_corpus
+
+
+class StageTimer():
+    """Busy time and number of calls, per stage. Thread-safe."""
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                stats = self._stages.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+                stats['calls'] += 1
+                stats['seconds'] += elapsed
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: dict(stats) for stage, stats in self._stages.items()}
+
+    def wrap(self, stage, function):
+        """Return function (sync, async or an async generator) timed as stage."""
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def async_generator_wrapper(*args, **kwargs):
+                # Time spent waiting on each item, not on the consumer.
+                generator = function(*args, **kwargs)
+                try:
+                    while True:
+                        with self.measure(stage):
+                            try:
+                                item = await generator.__anext__()
+
+                            except StopAsyncIteration:
+                                return
+
+                        yield item
+
+                finally:
+                    await generator.aclose()
+
+            return async_generator_wrapper
+
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with self.measure(stage):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.measure(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+
+class QueryCounter():
+    """Counts DB round trips (and their time) on every connection. Thread-safe.
+
+    Installed as a Django execute wrapper on connections as they are opened,
+    including those the async ORM opens in its worker threads.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                self.queries += 1
+                self.seconds += elapsed
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        connection_created.connect(self._on_connection_created, weak=False)
+        for connection in connections.all():
+            self._on_connection_created(None, connection)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        # Reconnections reuse the same wrapper object.
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def snapshot(self):
+        with self._lock:
+            return {'queries': self.queries, 'seconds': self.seconds}
+
+
+def get_peak_rss_mb():
+    """Return the peak RSS (MB) of this process, and of its largest finished child process.
+
+    Children include the PDF rendering workers, once they have exited.
+    """
+    # KB on Linux, bytes on macOS.
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+def synthetic_page_result(seed, text_words=400):
+    """Return a plausible page parser result (dict), with text derived from seed."""
+    rng = random.Random(seed)
+    words = lambda count: ' '.join(rng.choice(WORDS) for _ in range(count))
+
+    return {
+        'text': words(text_words),
+        'summary': words(40),
+        'description': words(20),
+        'requestNextPage': False,
+    }
+
+
+def synthetic_prompt_response(request):
+    """Fallback for replayed LLMs: answer page parser prompts with synthetic pages.
+
+    Args:
+        request: dict - See llm.replay.ReplayAPI.
+
+    Returns:
+        str
+    """
+    from parser import PAGE_BATCH_PROMPT
+
+    seeds = request['images'] or [request['user_prompt']]
+    if request['user_prompt'] == PAGE_BATCH_PROMPT:
+        return json.dumps({'pages': [synthetic_page_result(seed) for seed in seeds]})
+
+    return json.dumps(synthetic_page_result(seeds[0]))
+
+
+def configure_backends(args):
+    """Set up the environment for replayed backends. Must run before the app is imported."""
+    os.environ['LLM_BACKEND_MODE'] = 'replay'
+    os.environ['EMBEDDING_BACKEND_MODE'] = 'replay'
+    os.environ['REPLAY_LATENCY_JITTER_MS'] = str(args.jitter_ms)
+    # Nothing is recorded; every request gets a synthetic response.
+    os.environ['REPLAY_FIXTURES_DIR'] = tempfile.mkdtemp(prefix='replay-fixtures-')
+
+
+def install_fallbacks(args):
+    import db.models
+    import llm.models
+    from llm.replay import ReplayAPI, synthetic_embedding
+
+    for value in vars(llm.models).values():
+        if isinstance(value, ReplayAPI):
+            value.fallback = synthetic_prompt_response
+            value.latency_ms = args.llm_latency_ms
+
+    db.models.embedding_backend.fallback = synthetic_embedding
+    db.models.embedding_backend.latency_ms = args.embedding_latency_ms
+
+
+def install_stage_timers(stage_timer):
+    """Time the pipeline's stages by wrapping the functions that implement them."""
+    import db.models
+    import processing
+
+    processor = processing.DocumentProcessor
+    processor.split_pdf = stage_timer.wrap('split_pdf', processor.split_pdf)
+    processor.save_page_to_db = stage_timer.wrap('save_page', processor.save_page_to_db)
+    processing.aparse_page_images = stage_timer.wrap('parse', processing.aparse_page_images)
+    db.models.Page.asave = stage_timer.wrap('page_save', db.models.Page.asave)
+    db.models.calculate_embeddings_batch = stage_timer.wrap('embed', db.models.calculate_embeddings_batch)
+
+
+def _diff(after, before):
+    return {
+        key: (
+            _diff(value, before.get(key, {})) if isinstance(value, dict)
+            else value - before.get(key, 0)
+        )
+        for key, value in after.items()
+    }
+
+
+def _sha256(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+async def run_case(case, args, stage_timer, query_counter):
+    """Ingest one document of the corpus and return its results (dict)."""
+    from db.models import Document, DocumentTypeCodes, Page, PageStatusCodes
+    from processing import UPLOAD_FOLDER, DocumentProcessor
+    import utils
+
+    # Uploaded the way routes.upload_file saves files.
+    filepath = os.path.join(UPLOAD_FOLDER, f'{uuid.uuid4().hex}_{case["name"]}')
+    shutil.copyfile(case['path'], filepath)
+
+    document = await Document.objects.acreate(
+        id=str(uuid.uuid4()),
+        name=case['name'],
+        filepath=filepath,
+        sha256=_sha256(filepath),
+        type=DocumentTypeCodes.PDF if case['type'] == 'pdf' else DocumentTypeCodes.IMAGE,
+    )
+
+    stages_before, queries_before = stage_timer.snapshot(), query_counter.snapshot()
+    start_time = time.perf_counter()
+
+    await DocumentProcessor(document, args.concurrency).process()
+
+    seconds = time.perf_counter() - start_time
+    stages, queries = _diff(stage_timer.snapshot(), stages_before), _diff(query_counter.snapshot(), queries_before)
+
+    pages_ready = await Page.objects.filter(document=document, status=PageStatusCodes.READY).acount()
+    pages_error = await Page.objects.filter(document=document, status=PageStatusCodes.ERROR).acount()
+
+    if not args.keep:
+        await document.adelete()
+        shutil.rmtree(os.path.join(os.path.dirname(filepath), document.id), ignore_errors=True)
+        for path in [filepath] + [
+            utils.page_image_derivative_path(filepath, size) for size in utils.PAGE_IMAGE_DERIVATIVES
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {
+        'name': case['name'],
+        'type': case['type'],
+        'page_size': case['page_size'],
+        'pages': case['pages'],
+        'pages_ready': pages_ready,
+        'pages_error': pages_error,
+        'file_bytes': os.path.getsize(case['path']),
+        'seconds': seconds,
+        'pages_per_second': case['pages'] / seconds if seconds else None,
+        'stages': stages,
+        'db': queries,
+        'db_queries_per_page': queries['queries'] / case['pages'],
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+
+async def run_benchmarks(args):
+    # The app has to be imported before processing to resolve the
+    # app -> routes -> processing -> sockets -> app import cycle.
+    # See the note in routes.py.
+    from app import app
+    from db.models import embedding_cache
+
+    install_fallbacks(args)
+    stage_timer, query_counter = StageTimer(), QueryCounter()
+    install_stage_timers(stage_timer)
+    query_counter.install()
+
+    corpus_folder = tempfile.mkdtemp(prefix='benchmark-corpus-')
+    try:
+        corpus = make_corpus(
+            corpus_folder,
+            pdf_pages=args.pdf_pages,
+            page_sizes=args.page_sizes,
+            image_formats=args.image_formats,
+            seed=args.seed,
+        )
+
+        results = []
+        for case in corpus:
+            print(f'Ingesting {case["name"]}...', file=sys.stderr)
+            results.append(await run_case(case, args, stage_timer, query_counter))
+
+    finally:
+        shutil.rmtree(corpus_folder, ignore_errors=True)
+        shutil.rmtree(os.environ['REPLAY_FIXTURES_DIR'], ignore_errors=True)
+
+    pages = sum(result['pages'] for result in results)
+    seconds = sum(result['seconds'] for result in results)
+
+    return {
+        'config': {
+            'pdf_pages': args.pdf_pages,
+            'page_sizes': args.page_sizes,
+            'image_formats': args.image_formats,
+            'llm_latency_ms': args.llm_latency_ms,
+            'embedding_latency_ms': args.embedding_latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+        'totals': {
+            'documents': len(results),
+            'pages': pages,
+            'seconds': seconds,
+            'pages_per_second': pages / seconds if seconds else None,
+            'stages': stage_timer.snapshot(),
+            'db': query_counter.snapshot(),
+            'embedding_cache': embedding_cache.stats(),
+            'peak_rss_mb': get_peak_rss_mb(),
+        },
+    }
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def _str_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pdf-pages', type=_int_list, default=[1, 10, 50],
+        help='Comma-separated page counts of the PDFs to generate. Default 1,10,50.')
+    parser.add_argument('--page-sizes', type=_str_list, default=['letter', 'a4'],
+        help=f'Comma-separated page sizes, of {", ".join(PAGE_SIZES)}. Default letter,a4.')
+    parser.add_argument('--image-formats', type=_str_list, default=['png', 'jpeg'],
+        help='Comma-separated formats of the single page images to generate. Default png,jpeg.')
+    parser.add_argument('--llm-latency-ms', type=float, default=200,
+        help='Synthetic latency of each LLM call. Default 200.')
+    parser.add_argument('--embedding-latency-ms', type=float, default=10,
+        help='Synthetic latency of each embedding call. Default 10.')
+    parser.add_argument('--jitter-ms', type=float, default=0,
+        help='Up to this much extra latency per call, fixed per request. Default 0.')
+    parser.add_argument('--concurrency', type=int, default=None,
+        help='Pages parsed at once per document. Default PAGE_PARSE_CONCURRENCY.')
+    parser.add_argument('--seed', type=int, default=None,
+        help='Seed for the corpus. Default random, so no two runs share documents '
+            '(identical documents would be copied rather than processed).')
+    parser.add_argument('--output', default=None,
+        help='File to write the results to. Default stdout.')
+    parser.add_argument('--keep', action='store_true',
+        help='Keep the ingested documents (DB records and files) afterwards.')
+
+    args = parser.parse_args(argv)
+    unknown_sizes = set(args.page_sizes) - set(PAGE_SIZES)
+    if unknown_sizes:
+        parser.error(f'Unknown page sizes: {", ".join(sorted(unknown_sizes))}')
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_backends(args)
+
+    results = asyncio.run(run_benchmarks(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
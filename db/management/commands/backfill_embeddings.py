@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from db.models import (PAGE_CONTENT_FIELDS, Page, PageChunk,
+    calculate_embeddings_batch)
+
+
+class Command(BaseCommand):
+    help = (
+        'Calculate the embeddings (and chunks) of pages missing them (or of all '
+        'pages, with --all), a window of pages at a time, in batched requests '
+        'to the embedding backend.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+            help='Recalculate every page\'s embeddings, e.g. after changing the embedding model.')
+        parser.add_argument('--pages', type=int, default=64,
+            help='Number of pages to embed and save at a time. Default 64.')
+        parser.add_argument('--batch-size', type=int, default=None,
+            help='Maximum texts per embedding request. Default EMBEDDING_BATCH_SIZE.')
+        parser.add_argument('--max-tokens', type=int, default=None,
+            help='Maximum estimated tokens per embedding request. Default EMBEDDING_BATCH_MAX_TOKENS.')
+
+    def handle(self, *args, **options):
+        pages = Page.objects.order_by('pk').only(
+            'pk', 'embedded_text_hashes', *PAGE_CONTENT_FIELDS
+        )
+
+        if not options['all']:
+            missing = Q()
+            for field in PAGE_CONTENT_FIELDS:
+                missing |= (
+                    Q(**{f'{field}_embeddings__isnull': True})
+                    & Q(**{f'{field}__isnull': False}) & ~Q(**{field: ''})
+                )
+
+            # e.g. pages from before chunks were introduced.
+            missing |= (
+                Q(text__isnull=False) & ~Q(text='')
+                & ~Exists(PageChunk.objects.filter(page=OuterRef('pk')))
+            )
+
+            pages = pages.filter(missing)
+
+        total = pages.count()
+        done = 0
+        window = []
+        for page in pages.iterator(chunk_size=options['pages']):
+            window.append(page)
+            if len(window) == options['pages']:
+                done += self.embed_pages(window, options['batch_size'], options['max_tokens'])
+                self.stdout.write(f'Embedded {done}/{total} pages.')
+                window = []
+
+        if window:
+            done += self.embed_pages(window, options['batch_size'], options['max_tokens'])
+
+        self.stdout.write(f'Embedded {done}/{total} pages.')
+
+    def embed_pages(self, pages, batch_size, max_tokens):
+        """Calculate and save the embeddings of pages and of their text's chunks, all in one go.
+
+        Returns:
+            int: The number of pages.
+        """
+        chunks = {page.pk: page.make_chunks() for page in pages}
+        texts = []
+        for page in pages:
+            texts += [getattr(page, field) for field in PAGE_CONTENT_FIELDS]
+            texts += [page.text[chunk.start:chunk.end] for chunk in chunks[page.pk]]
+
+        embeddings = iter(calculate_embeddings_batch(texts, batch_size, max_tokens))
+        for page in pages:
+            page.set_embeddings([next(embeddings) for _ in PAGE_CONTENT_FIELDS])
+            for chunk in chunks[page.pk]:
+                chunk.page = page
+                chunk.embedding = next(embeddings)
+
+        # bulk_update doesn't go through Page.save, so embeddings are not
+        # calculated again.
+        with transaction.atomic():
+            Page.objects.bulk_update(
+                pages,
+                [f'{field}_embeddings' for field in PAGE_CONTENT_FIELDS] + ['embedded_text_hashes']
+            )
+            PageChunk.objects.filter(page__in=pages).delete()
+            PageChunk.objects.bulk_create([chunk for page in pages for chunk in chunks[page.pk]])
+
+        return len(pages)
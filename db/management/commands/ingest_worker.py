@@ -0,0 +1,38 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Run an ingest worker: claim queued documents from the ingest job '
+        'table and process them. Run as many as needed, on as many machines '
+        'as needed, against the same database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None,
+            help='Number of documents to process at once.')
+        parser.add_argument('--lease', type=int, default=None,
+            help='Seconds a claimed job\'s lease lasts without renewal.')
+        parser.add_argument('--poll-interval', type=float, default=None,
+            help='Seconds to wait between checks for new jobs when idle.')
+
+    def handle(self, *args, **options):
+        # The app has to be imported before processing to resolve the
+        # app -> routes -> processing -> sockets -> app import cycle.
+        # See the note in routes.py.
+        from app import app
+        from processing import IngestWorker
+
+        worker = IngestWorker(
+            concurrency=options['concurrency'],
+            lease_duration=options['lease'],
+            poll_interval=options['poll_interval'],
+        )
+
+        try:
+            asyncio.run(worker.run())
+
+        except KeyboardInterrupt:
+            self.stdout.write(f'Ingest worker {worker.name} stopped.')
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from db.models import (EmbeddingCache, SearchQuery, calculate_embeddings_batch,
+    embedding_cache, query_embedding_cache)
+
+
+class Command(BaseCommand):
+    help = (
+        'Precompute the embeddings of the most popular search queries (see '
+        'db.models.QueryEmbeddingCache), and optionally of queries listed in a '
+        'file, into the embedding cache, so searching for them never waits on '
+        'the embedding model. Run it periodically to keep them from being '
+        'evicted from the cache.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=1000,
+            help='Number of the most searched queries to warm. Default 1000.')
+        parser.add_argument('--file', default=None,
+            help='A file of queries to warm as well, one per line.')
+
+    def handle(self, *args, **options):
+        texts = {}
+
+        if options['file']:
+            with open(options['file']) as f:
+                for line in f:
+                    text = EmbeddingCache.normalize(line)
+                    if text:
+                        texts[text] = None
+
+        top_queries = (
+            SearchQuery.objects.filter(model_name=query_embedding_cache.model_name)
+            .order_by('-searches').values_list('text', flat=True)[:options['top']]
+        )
+        for text in top_queries:
+            texts[text] = None
+
+        texts = list(texts)
+        # Cached queries are hits, which keeps them from being evicted; the
+        # rest are embedded and cached.
+        stats_before = embedding_cache.stats()
+        embeddings = calculate_embeddings_batch(texts)
+        stats_after = embedding_cache.stats()
+
+        cached = (stats_after['memory_hits'] + stats_after['db_hits']
+            - stats_before['memory_hits'] - stats_before['db_hits'])
+        failed = sum(embedding is None for embedding in embeddings)
+
+        self.stdout.write(
+            f'Warmed {len(texts) - failed} of {len(texts)} queries '
+            f'({cached} were already cached, {failed} failed).'
+        )
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0016_document_sha256_page_image_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParseCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_hash', models.CharField(max_length=64)),
+                ('prompt_hash', models.CharField(max_length=64)),
+                ('model_name', models.CharField(max_length=255)),
+                ('temperature', models.FloatField()),
+                ('result', models.JSONField()),
+                ('hits', models.IntegerField(default=0)),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+                ('time_last_used', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('image_hash', 'prompt_hash', 'model_name', 'temperature'), name='parse_cache_entry_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2 on 2026-10-18 14:05
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import BooleanField, ExpressionWrapper, Q
+
+
+PAGE_CONTENT_FIELDS = ('text', 'summary', 'description')
+BATCH_SIZE = 500
+
+
+def hash_embedded_texts(apps, schema_editor):
+    """Record the hashes of texts already embedded, so saves don't embed them again."""
+    Page = apps.get_model('db', 'Page')
+    pages = Page.objects.only('pk', *PAGE_CONTENT_FIELDS).annotate(**{
+        f'has_{field}_embeddings': ExpressionWrapper(
+            Q(**{f'{field}_embeddings__isnull': False}), output_field=BooleanField()
+        )
+        for field in PAGE_CONTENT_FIELDS
+    })
+
+    batch = []
+    for page in pages.iterator(chunk_size=BATCH_SIZE):
+        page.embedded_text_hashes = {
+            field: hashlib.sha256(getattr(page, field).encode()).hexdigest()
+            for field in PAGE_CONTENT_FIELDS
+            if getattr(page, field) and getattr(page, f'has_{field}_embeddings')
+        }
+        batch.append(page)
+
+        if len(batch) == BATCH_SIZE:
+            Page.objects.bulk_update(batch, ['embedded_text_hashes'])
+            batch = []
+
+    if batch:
+        Page.objects.bulk_update(batch, ['embedded_text_hashes'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0017_parsecacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='embedded_text_hashes',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(hash_embedded_texts, migrations.RunPython.noop),
+    ]
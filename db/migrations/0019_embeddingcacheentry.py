@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 15:20
+
+from django.db import migrations, models
+import pgvector.django.vector
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0018_page_embedded_text_hashes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=255)),
+                ('dimensions', models.IntegerField()),
+                ('text_hash', models.CharField(max_length=64)),
+                ('embedding', pgvector.django.vector.VectorField()),
+                ('hits', models.IntegerField(default=0)),
+                ('time_created', models.DateTimeField(auto_now_add=True)),
+                ('time_last_used', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('model_name', 'dimensions', 'text_hash'), name='embedding_cache_entry_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import pgvector.django.vector
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0019_embeddingcacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=255)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('text', models.TextField()),
+                ('embedding', pgvector.django.vector.VectorField(blank=True, null=True)),
+                ('time_embedded', models.DateTimeField(blank=True, null=True)),
+                ('searches', models.IntegerField(db_index=True, default=0)),
+                ('time_last_searched', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('model_name', 'text_hash'), name='search_query_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-18 18:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import pgvector.django.indexes
+import pgvector.django.vector
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0020_searchquery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('start', models.IntegerField()),
+                ('end', models.IntegerField()),
+                ('embedding', pgvector.django.vector.VectorField(blank=True, dimensions=768, null=True)),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='db.page')),
+            ],
+            options={
+                'ordering': ['page', 'index'],
+                'indexes': [pgvector.django.indexes.HnswIndex(ef_construction=64, fields=['embedding'], m=16, name='page_chunk_embedding_index', opclasses=['vector_cosine_ops'])],
+            },
+        ),
+    ]
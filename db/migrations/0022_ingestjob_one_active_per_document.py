@@ -0,0 +1,44 @@
+# Generated by Django 4.2 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+# IngestJobStatusCodes.QUEUED and RUNNING.
+ACTIVE_STATUSES = [0, 1]
+
+
+def delete_duplicate_active_jobs(apps, schema_editor):
+    """Keep one active job per document, preferring running ones, then the oldest."""
+    IngestJob = apps.get_model('db', 'IngestJob')
+    active_jobs = IngestJob.objects.filter(status__in=ACTIVE_STATUSES).order_by(
+        'document_id', '-status', 'time_created'
+    )
+
+    duplicate_ids = []
+    last_document_id = None
+    for job in active_jobs.only('id', 'document_id', 'status', 'time_created').iterator():
+        if job.document_id == last_document_id:
+            duplicate_ids.append(job.id)
+
+        last_document_id = job.document_id
+
+    IngestJob.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0021_pagechunk'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_active_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ingestjob',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('status__in', ACTIVE_STATUSES)),
+                fields=('document',),
+                name='ingest_job_one_active_per_document',
+            ),
+        ),
+    ]
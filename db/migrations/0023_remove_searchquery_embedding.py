@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 18:55
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0022_ingestjob_one_active_per_document'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='searchquery',
+            name='embedding',
+        ),
+        migrations.RemoveField(
+            model_name='searchquery',
+            name='time_embedded',
+        ),
+    ]
@@ -1,17 +1,63 @@
 import asyncio
+from collections import OrderedDict
+import datetime
+import hashlib
 import os
+import re
+import threading
+import time
+import unicodedata
 import uuid
+import weakref
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from ollama import Client
 from pgvector.django import VectorField, HnswIndex
 
 import env
+from llm.limits import embedding_backend_limits
+from llm.metrics import llm_metrics
+from llm.replay import ReplayEmbeddings, get_backend_mode
 
 
 ollama_client = Client(host=os.environ.get("OLLAMA_CLIENT_HOST"))
 
+EMBEDDING_MODEL = 'nomic-embed-text'
+EMBEDDING_DIMENSIONS = 768
+
+# Texts are sent to the embedding backend in batches of at most this many
+# texts and (estimated) tokens per request.
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.environ.get('EMBEDDING_BATCH_MAX_TOKENS', 16384))
+# How long texts to embed from concurrent Page.asave calls wait for others to
+# share a batch with.
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get('EMBEDDING_BATCH_WAIT_MS', 10))
+
+# Embeddings are cached (see EmbeddingCache), up to this many in the DB, shared
+# by all processes, and this many in each process's memory.
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 500000))
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MEMORY_ENTRIES', 10000))
+
+# Page text is also embedded in overlapping chunks of about this many
+# characters (~4 per token), so long pages aren't truncated or blurred into
+# one vector. See PageChunk.
+PAGE_CHUNK_SIZE = int(os.environ.get('PAGE_CHUNK_SIZE', 1000))
+PAGE_CHUNK_OVERLAP = int(os.environ.get('PAGE_CHUNK_OVERLAP', 200))
+
+# Up to SEARCH_QUERY_LOG_MAX_ENTRIES search queries are logged in the DB, and
+# the embeddings of QUERY_EMBEDDING_MEMORY_ENTRIES kept in each process's
+# memory. See QueryEmbeddingCache.
+QUERY_EMBEDDING_MEMORY_ENTRIES = int(os.environ.get('QUERY_EMBEDDING_MEMORY_ENTRIES', 2000))
+SEARCH_QUERY_LOG_MAX_ENTRIES = int(os.environ.get('SEARCH_QUERY_LOG_MAX_ENTRIES', 100000))
+
+# 'live', or 'record'/'replay' to record embeddings or serve recorded ones in
+# place of Ollama's. See llm.replay.
+EMBEDDING_BACKEND_MODE = get_backend_mode('EMBEDDING_BACKEND_MODE')
+
 
 def documents_path():
     return os.path.abspath(os.path.join(settings.BASE_DIR, '../media'))
@@ -36,6 +82,18 @@ class PageStatusCodes(models.IntegerChoices):
     ERROR = 2
 
 
+class IngestJobStatusCodes(models.IntegerChoices):
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+
+# Page fields that are filled in by parsing, each with a matching
+# <field>_embeddings field.
+PAGE_CONTENT_FIELDS = ('text', 'summary', 'description')
+
+
 class Document(models.Model):
     id = models.CharField(max_length=50, default=uuid.uuid4, primary_key=True)
     name = models.CharField(max_length=255)
@@ -46,6 +104,8 @@ class Document(models.Model):
     type = models.IntegerField(choices=DocumentTypeCodes.choices,
         default=DocumentTypeCodes.UNKNOWN)
     time_created = models.DateTimeField(auto_now_add=True)
+    # SHA-256 of the uploaded file, to spot re-uploads of the same file.
+    sha256 = models.CharField(max_length=64, blank=True, default='', db_index=True)
 
     class Meta:
         ordering = ['-time_created']
@@ -73,6 +133,12 @@ class Page(models.Model):
     status = models.IntegerField(choices=PageStatusCodes.choices,
         default=PageStatusCodes.PROCESSING)
     error_details = models.TextField(null=True, blank=True)
+    # SHA-256 of the page image's pixels (see image.Image.content_hash), to spot
+    # pages that have been parsed before.
+    image_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # Hash (see hash_text) of the text each of the <field>_embeddings was
+    # calculated from, by field, so saves only re-embed fields that changed.
+    embedded_text_hashes = models.JSONField(default=dict, blank=True)
 
     class Meta:
         ordering = ['document', 'number']
@@ -103,23 +169,407 @@ class Page(models.Model):
     def __str__(self):
         return f'{self.document.name} - {self.number}'
 
-    def save(self, *args, **kwargs):
-        # Presumably we're not going to be saving often, so OK to just
-        # calculate these without checking whether the underlying text has
-        # changed.
-        self.text_embeddings = calculate_embeddings(self.text)
-        self.summary_embeddings = calculate_embeddings(self.summary)
-        self.description_embeddings = calculate_embeddings(self.description)
+    def save(self, *args, recalculate_embeddings=None, **kwargs):
+        """
+        Args:
+            recalculate_embeddings: bool - True to calculate all the
+                embeddings afresh, False to leave them as they are. Default:
+                calculate only those whose text has changed since they were
+                last calculated (see get_stale_embedding_fields). The text's
+                chunks (see PageChunk) are replaced whenever its embeddings
+                are calculated.
+        """
+        fields = self._get_fields_to_embed(recalculate_embeddings, kwargs.get('update_fields'))
+        chunks = None
+        if fields:
+            chunks = self.make_chunks() if 'text' in fields else []
+            self._set_embeddings_and_chunks(
+                fields, chunks, calculate_embeddings_batch(self._get_texts_to_embed(fields, chunks))
+            )
+            kwargs = self._add_embedding_update_fields(kwargs, fields)
 
         super().save(*args, **kwargs)
 
-    async def asave(self, *args, **kwargs):
-        self.text_embeddings = await asyncio.to_thread(calculate_embeddings, self.text)
-        self.summary_embeddings = await asyncio.to_thread(calculate_embeddings, self.summary)
-        self.description_embeddings = await asyncio.to_thread(calculate_embeddings, self.description)
+        # Even if the text has no chunks now, its old ones are out of date.
+        if chunks is not None and 'text' in fields:
+            self.replace_chunks(chunks)
+
+    async def asave(self, *args, recalculate_embeddings=None, **kwargs):
+        """See save.
+
+        The fields (and chunks) are embedded together, and batched with those
+        of other pages being saved at the same time (see EmbeddingBatcher).
+        """
+        fields = self._get_fields_to_embed(recalculate_embeddings, kwargs.get('update_fields'))
+        chunks = None
+        if fields:
+            chunks = self.make_chunks() if 'text' in fields else []
+            self._set_embeddings_and_chunks(
+                fields, chunks, await acalculate_embeddings_batch(self._get_texts_to_embed(fields, chunks))
+            )
+            kwargs = self._add_embedding_update_fields(kwargs, fields)
 
         await super().asave(*args, **kwargs)
 
+        # Even if the text has no chunks now, its old ones are out of date.
+        if chunks is not None and 'text' in fields:
+            await sync_to_async(self.replace_chunks)(chunks)
+
+    def make_chunks(self):
+        """Return new (unsaved, unembedded) PageChunks covering the page's text."""
+        return [
+            PageChunk(index=index, start=start, end=end)
+            for index, (start, end) in enumerate(chunk_text(self.text))
+        ]
+
+    def replace_chunks(self, chunks):
+        """Replace the page's chunks in the DB with chunks (list of PageChunk)."""
+        for chunk in chunks:
+            chunk.page = self
+
+        with transaction.atomic():
+            PageChunk.objects.filter(page=self).delete()
+            PageChunk.objects.bulk_create(chunks)
+
+    def copy_chunks_from(self, other):
+        """Replace the page's chunks with copies of another page's, e.g. one whose contents it copied."""
+        self.replace_chunks([
+            PageChunk(index=chunk.index, start=chunk.start, end=chunk.end, embedding=chunk.embedding)
+            for chunk in PageChunk.objects.filter(page=other)
+        ])
+
+    def _get_texts_to_embed(self, fields, chunks):
+        return (
+            [getattr(self, field) for field in fields]
+            + [self.text[chunk.start:chunk.end] for chunk in chunks]
+        )
+
+    def _set_embeddings_and_chunks(self, fields, chunks, embeddings):
+        self.set_embeddings(embeddings[:len(fields)], fields)
+        for chunk, embedding in zip(chunks, embeddings[len(fields):]):
+            chunk.embedding = embedding
+
+    def get_stale_embedding_fields(self):
+        """Return the PAGE_CONTENT_FIELDS whose text has changed since they were last embedded."""
+        return [
+            field for field in PAGE_CONTENT_FIELDS
+            if self.embedded_text_hashes.get(field, '') != hash_text(getattr(self, field))
+        ]
+
+    def _get_fields_to_embed(self, recalculate_embeddings, update_fields):
+        if recalculate_embeddings is False:
+            return []
+
+        fields = PAGE_CONTENT_FIELDS if recalculate_embeddings else self.get_stale_embedding_fields()
+        if update_fields is not None:
+            # Fields not being saved are left alone.
+            fields = [field for field in fields if field in update_fields]
+
+        return list(fields)
+
+    @staticmethod
+    def _add_embedding_update_fields(kwargs, fields):
+        if kwargs.get('update_fields') is None:
+            return kwargs
+
+        return {
+            **kwargs,
+            'update_fields': [
+                *kwargs['update_fields'],
+                *(f'{field}_embeddings' for field in fields),
+                'embedded_text_hashes',
+            ]
+        }
+
+    def set_embeddings(self, embeddings, fields=PAGE_CONTENT_FIELDS):
+        """Set the embeddings of fields (default PAGE_CONTENT_FIELDS), given in the same order."""
+        for field, embedding in zip(fields, embeddings):
+            setattr(self, f'{field}_embeddings', embedding)
+
+            text = getattr(self, field)
+            if embedding is not None or not text:
+                self.embedded_text_hashes[field] = hash_text(text)
+
+            else:
+                # Failed, so left stale to be tried again on the next save.
+                self.embedded_text_hashes.pop(field, None)
+
+    def copy_contents_from(self, other):
+        """Copy another page's parsed contents and their embeddings onto this one.
+
+        Args:
+            other: Page - The page to copy from, e.g. an identical page in
+                another document.
+        """
+        for field in PAGE_CONTENT_FIELDS:
+            setattr(self, field, getattr(other, field))
+            setattr(self, f'{field}_embeddings', getattr(other, f'{field}_embeddings'))
+
+        self.embedded_text_hashes = dict(other.embedded_text_hashes)
+
+
+class PageChunk(models.Model):
+    """An overlapping span of a page's text, with its own embedding.
+
+    Search matches chunks as well as whole pages, since a long page's text
+    would be truncated by the embedding model, or blurred into one vector.
+    Chunks are replaced whenever the page's text is re-embedded (see
+    Page.save). Their text is page.text[start:end].
+    """
+    page = models.ForeignKey('Page', on_delete=models.CASCADE,
+        related_name='chunks')
+    index = models.IntegerField()
+    # Character offsets into the page's text.
+    start = models.IntegerField()
+    end = models.IntegerField()
+    embedding = VectorField(dimensions=EMBEDDING_DIMENSIONS, blank=True, null=True)
+
+    class Meta:
+        ordering = ['page', 'index']
+        indexes = [
+            HnswIndex(
+                name="page_chunk_embedding_index",
+                fields=["embedding"],
+                m=16,
+                ef_construction=64,
+                # Search ranks by cosine distance.
+                opclasses=["vector_cosine_ops"],
+            )
+        ]
+
+
+class IngestJob(models.Model):
+    """A request to process (ingest) a document, to be picked up by an ingest worker.
+
+    Workers claim jobs by taking a lease on them (see claim_next). A job whose
+    lease runs out without being renewed, e.g. because its worker died, is up
+    for grabs again.
+
+    A document has at most one active (queued or running) job. See enqueue.
+    """
+    ACTIVE_STATUSES = [IngestJobStatusCodes.QUEUED, IngestJobStatusCodes.RUNNING]
+
+    document = models.ForeignKey('Document', on_delete=models.CASCADE,
+        related_name='ingest_jobs')
+    status = models.IntegerField(choices=IngestJobStatusCodes.choices,
+        default=IngestJobStatusCodes.QUEUED)
+    attempts = models.IntegerField(default=0)
+    # Identifies the worker currently holding the lease.
+    worker = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    error_details = models.TextField(null=True, blank=True)
+    time_created = models.DateTimeField(auto_now_add=True)
+    time_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['time_created']
+        indexes = [
+            models.Index(
+                name="ingest_job_claim_index",
+                fields=["status", "lease_expires_at"],
+            )
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                name="ingest_job_one_active_per_document",
+                fields=["document"],
+                condition=Q(status__in=[IngestJobStatusCodes.QUEUED, IngestJobStatusCodes.RUNNING]),
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.document_id} - {self.get_status_display()}'
+
+    @classmethod
+    def enqueue(cls, document):
+        """Queue a document up for processing, unless it already is.
+
+        Args:
+            document: Document - The document to process.
+
+        Returns:
+            IngestJob: The document's queued or running job, whether new or
+                existing.
+        """
+        active_jobs = cls.objects.filter(document=document, status__in=cls.ACTIVE_STATUSES)
+        job = active_jobs.first()
+        if job is not None:
+            return job
+
+        try:
+            with transaction.atomic():
+                return cls.objects.create(document=document)
+
+        except IntegrityError:
+            # Queued up concurrently.
+            return active_jobs.first()
+
+    @classmethod
+    def claim_next(cls, worker, lease_duration, max_attempts):
+        """Claim the oldest available job, taking out a lease on it.
+
+        A job is available if it is queued, or if it is running but its lease
+        has expired. Rows locked by other workers mid-claim are skipped
+        (SELECT ... FOR UPDATE SKIP LOCKED), so any number of workers can poll
+        at once without contending or claiming the same job.
+
+        Args:
+            worker: str - Identifier of the claiming worker.
+            lease_duration: datetime.timedelta - How long the lease lasts
+                unless renewed.
+            max_attempts: int - Jobs that have been claimed this many times
+                are not claimed again.
+
+        Returns:
+            IngestJob or None: The claimed job, or None if none is available.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            job = cls.objects.select_for_update(skip_locked=True).filter(
+                Q(status=IngestJobStatusCodes.QUEUED)
+                | Q(status=IngestJobStatusCodes.RUNNING, lease_expires_at__lt=now),
+                attempts__lt=max_attempts
+            ).order_by('time_created').first()
+
+            if job is None:
+                return None
+
+            job.status = IngestJobStatusCodes.RUNNING
+            job.worker = worker
+            job.attempts = F('attempts') + 1
+            job.lease_expires_at = now + lease_duration
+            job.save(update_fields=['status', 'worker', 'attempts', 'lease_expires_at', 'time_updated'])
+
+        job.refresh_from_db(fields=['attempts'])
+        return job
+
+    @classmethod
+    def fail_exhausted(cls, max_attempts):
+        """Mark jobs that ran out of attempts (and their documents) as failed.
+
+        Args:
+            max_attempts: int - See claim_next.
+
+        Returns:
+            int: The number of jobs marked as failed.
+        """
+        with transaction.atomic():
+            jobs = cls.objects.select_for_update(skip_locked=True).filter(
+                status=IngestJobStatusCodes.RUNNING,
+                lease_expires_at__lt=timezone.now(),
+                attempts__gte=max_attempts
+            )
+            document_ids = list(jobs.values_list('document_id', flat=True))
+            num_failed = jobs.update(
+                status=IngestJobStatusCodes.FAILED,
+                error_details='Lease expired too many times.',
+                time_updated=timezone.now()
+            )
+            Document.objects.filter(id__in=document_ids).update(
+                status=DocumentStatusCodes.ERROR
+            )
+
+        return num_failed
+
+    def renew_lease(self, lease_duration):
+        """Extend the lease on a job held by self.worker.
+
+        Returns:
+            bool: False if the lease has since been lost to another worker.
+        """
+        return IngestJob.objects.filter(
+            pk=self.pk,
+            worker=self.worker,
+            status=IngestJobStatusCodes.RUNNING
+        ).update(lease_expires_at=timezone.now() + lease_duration) == 1
+
+    def finish(self, status, error_details=None):
+        """Record the outcome of a job held by self.worker.
+
+        Returns:
+            bool: False if the lease has since been lost to another worker.
+        """
+        return IngestJob.objects.filter(
+            pk=self.pk,
+            worker=self.worker,
+            status=IngestJobStatusCodes.RUNNING
+        ).update(
+            status=status,
+            error_details=error_details,
+            lease_expires_at=None,
+            time_updated=timezone.now()
+        ) == 1
+
+
+class ParseCacheEntry(models.Model):
+    """A cached, validated result of parsing a page image with an LLM.
+
+    Keyed on everything that determines the result: the image's contents, the
+    prompt, the model and its temperature. See parser.ParseResultCache.
+    """
+    image_hash = models.CharField(max_length=64)
+    prompt_hash = models.CharField(max_length=64)
+    model_name = models.CharField(max_length=255)
+    temperature = models.FloatField()
+    result = models.JSONField()
+    hits = models.IntegerField(default=0)
+    time_created = models.DateTimeField(auto_now_add=True)
+    time_last_used = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="parse_cache_entry_key",
+                fields=["image_hash", "prompt_hash", "model_name", "temperature"],
+            )
+        ]
+
+
+class EmbeddingCacheEntry(models.Model):
+    """A cached embedding of a text.
+
+    Keyed on the embedding model, its dimensions and the SHA-256 of the
+    normalized text. See EmbeddingCache.
+    """
+    model_name = models.CharField(max_length=255)
+    dimensions = models.IntegerField()
+    text_hash = models.CharField(max_length=64)
+    embedding = VectorField()
+    hits = models.IntegerField(default=0)
+    time_created = models.DateTimeField(auto_now_add=True)
+    time_last_used = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="embedding_cache_entry_key",
+                fields=["model_name", "dimensions", "text_hash"],
+            )
+        ]
+
+
+class SearchQuery(models.Model):
+    """A search query, and how often it has been searched.
+
+    A log of popular queries, to precompute embeddings for (see the
+    warm_query_embeddings command). The embeddings themselves are kept in the
+    embedding cache (see EmbeddingCache).
+    """
+    model_name = models.CharField(max_length=255)
+    # Hash of the normalized text (see EmbeddingCache).
+    text_hash = models.CharField(max_length=64)
+    text = models.TextField()
+    searches = models.IntegerField(default=0, db_index=True)
+    time_last_searched = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="search_query_key",
+                fields=["model_name", "text_hash"],
+            )
+        ]
+
 
 class Proposition(models.Model):
     # https://arxiv.org/pdf/2312.06648
@@ -147,20 +597,609 @@ def calculate_embeddings(text):
         list of float - 768-dimensions embeddings for the given text, or None if
             text is None/the empty string.
     """
+    return calculate_embeddings_batch([text])[0]
+
+
+def chunk_text(text, size=PAGE_CHUNK_SIZE, overlap=PAGE_CHUNK_OVERLAP):
+    """Split text into overlapping spans of at most size characters.
+
+    Spans start and end at whitespace where possible, so words aren't cut in
+    half, and each overlaps the previous one by about overlap characters.
+
+    Args:
+        text: str - The text to split.
+        size: int - Optional. Default PAGE_CHUNK_SIZE.
+        overlap: int - Optional. Default PAGE_CHUNK_OVERLAP.
+
+    Returns:
+        list of (int, int): The spans' start and end offsets. Empty if text is
+            None/the empty string.
+    """
     if not text:
-        return None
-    try:
-        # This calls this:
-        # https://github.com/ollama/ollama/blob/main/docs/api.md#generate-embeddings
-        api_response = ollama_client.embed(model="nomic-embed-text", input=text)
-        embeddings_list = api_response.get('embeddings')
-
-    # TODO: Handle more specific exceptions, e.g.
-    # ollama._types.ResponseError: model requires more system memory (284.9 MiB) than is available (71.0 MiB)
-    except Exception as e:
-        print(f"Error generating embeddings for {text}: {e}")
-        return None
+        return []
+
+    spans = []
+    start = 0
+    while True:
+        end = min(start + size, len(text))
+        if end < len(text):
+            # The last whitespace in the second half of the span, if any.
+            boundary = max(text.rfind(character, start + size // 2, end) for character in ' \n')
+            if boundary > start:
+                end = boundary
+
+        spans.append((start, end))
+        if end == len(text):
+            return spans
+
+        next_start = max(end - overlap, start + 1)
+        boundary = min(
+            (index for index in (text.find(character, next_start, end) for character in ' \n') if index != -1),
+            default=-1
+        )
+        start = boundary + 1 if boundary != -1 else next_start
+
+
+def hash_text(text):
+    """Return the SHA-256 (hex) of text, or '' if text is None/the empty string."""
+    return hashlib.sha256(text.encode()).hexdigest() if text else ''
+
+
+def estimate_embedding_tokens(text):
+    """Roughly estimate the tokens in text, at ~4 characters per token."""
+    return len(text) // 4 + 1
+
+
+def batch_texts(texts, batch_size=None, max_tokens=None):
+    """Split texts into batches for the embedding backend.
+
+    Args:
+        texts: list of str - The texts, none empty.
+        batch_size: int - Optional. Maximum texts per batch. Default
+            EMBEDDING_BATCH_SIZE.
+        max_tokens: int - Optional. Maximum estimated tokens per batch. A text
+            longer than this gets a batch of its own. Default
+            EMBEDDING_BATCH_MAX_TOKENS.
+
+    Yields:
+        list of str: Each batch, in order.
+    """
+    batch_size = batch_size or EMBEDDING_BATCH_SIZE
+    max_tokens = max_tokens or EMBEDDING_BATCH_MAX_TOKENS
+
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = estimate_embedding_tokens(text)
+        if batch and (len(batch) == batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+
+        batch.append(text)
+        batch_tokens += tokens
+
+    if batch:
+        yield batch
+
+
+def calculate_embeddings_batch(texts, batch_size=None, max_tokens=None):
+    """Calculate embeddings for many texts, in as few requests as possible.
+
+    Empty texts are skipped, and repeated ones embedded once.
+
+    Args:
+        texts: list of str - The texts to embed. May include None/empty ones.
+        batch_size, max_tokens: int - Optional. See batch_texts.
+
+    Returns:
+        list: An embedding (list of float) per text, in order. None for empty
+            texts, and for texts in batches that failed.
+    """
+    # Texts are cached, and embedded, normalized.
+    normalized_texts = [EmbeddingCache.normalize(text) if text else None for text in texts]
+    unique_texts = list(dict.fromkeys(text for text in normalized_texts if text))
+
+    embeddings = embedding_cache.get_many(unique_texts)
+    uncached_texts = [text for text in unique_texts if text not in embeddings]
+
+    for batch in batch_texts(uncached_texts, batch_size, max_tokens):
+        try:
+            if embedding_backend is not None:
+                vectors = embedding_backend.embed_many(batch)
+
+            else:
+                vectors = _calculate_ollama_embeddings(batch)
+
+        # TODO: Handle more specific exceptions, e.g.
+        # ollama._types.ResponseError: model requires more system memory (284.9 MiB) than is available (71.0 MiB)
+        except Exception as e:
+            print(f"Error generating embeddings for a batch of {len(batch)} texts: {e}")
+            continue
+
+        batch_embeddings = {
+            text: vector for text, vector in zip(batch, vectors) if vector is not None
+        }
+        embedding_cache.put_many(batch_embeddings)
+        embeddings.update(batch_embeddings)
+
+    return [embeddings.get(text) if text else None for text in normalized_texts]
+
+
+def _calculate_ollama_embeddings(texts):
+    # This calls this, with a list of inputs:
+    # https://github.com/ollama/ollama/blob/main/docs/api.md#generate-embeddings
+    with embedding_backend_limits.limit('ollama'):
+        api_response = ollama_client.embed(model=EMBEDDING_MODEL, input=texts)
+    embeddings_list = api_response.get('embeddings') or []
 
     # TODO: Find out if there are any non-error situation where embeddings are
-    # not returned. If not, raise an error here instead of returning None.
-    return embeddings_list[0] if embeddings_list else None
+    # not returned.
+    if len(embeddings_list) != len(texts):
+        raise ValueError(f'Got {len(embeddings_list)} embeddings for {len(texts)} texts.')
+
+    return embeddings_list
+
+
+class EmbeddingCache():
+    """Two-tier cache of embeddings, so the same text is only ever embedded once.
+
+    An in-process LRU of up to memory_entries embeddings sits in front of the
+    EmbeddingCacheEntry table, which is shared by all processes (the app and
+    ingest workers) and survives restarts. Entries are keyed on the model,
+    its dimensions and the hash of the normalized text (see normalize).
+
+    The table holds at most max_entries embeddings, evicting the least
+    recently used ones beyond that. Errors reading or writing it are logged
+    rather than raised (a failed lookup is a miss), so they can't fail an
+    embedding. Thread-safe.
+    """
+    # Eviction needs a count of all entries, so is only checked every so often.
+    EVICTION_CHECK_INTERVAL = 1000
+    # Seconds between recording memory hits in the DB (see _flush_memory_hits).
+    MEMORY_HITS_FLUSH_INTERVAL = 60
+
+    def __init__(self, model_name=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS,
+            max_entries=EMBEDDING_CACHE_MAX_ENTRIES, memory_entries=EMBEDDING_CACHE_MEMORY_ENTRIES):
+        self.model_name = model_name
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        # Keys hit in memory since they were last recorded in the DB.
+        self._memory_hit_keys = set()
+        self._last_memory_hits_flush = time.monotonic()
+        self._puts_since_eviction_check = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        """Return text in normal form: NFC, with runs of whitespace collapsed and the ends stripped.
+
+        Texts that differ only in these ways embed (near enough) the same.
+        """
+        return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+    @staticmethod
+    def make_key(text):
+        """Return the hash a (normalized) text is cached under."""
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get_many(self, texts):
+        """Return the cached embeddings of texts (normalized).
+
+        Returns:
+            dict of str -> list of float: The embeddings found, by text.
+        """
+        keys = {text: self.make_key(text) for text in texts}
+
+        embeddings = {}
+        with self._lock:
+            for text, key in keys.items():
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    self._memory_hit_keys.add(key)
+                    embeddings[text] = self._memory[key]
+
+            self.memory_hits += len(embeddings)
+
+        self._flush_memory_hits()
+
+        remaining = {key: text for text, key in keys.items() if text not in embeddings}
+        if remaining and self.max_entries:
+            try:
+                entries = list(EmbeddingCacheEntry.objects.filter(
+                    model_name=self.model_name, dimensions=self.dimensions,
+                    text_hash__in=list(remaining)
+                ).values_list('id', 'text_hash', 'embedding'))
+
+                if entries:
+                    EmbeddingCacheEntry.objects.filter(id__in=[id for id, _, _ in entries]).update(
+                        hits=F('hits') + 1, time_last_used=timezone.now()
+                    )
+
+            except Exception as e:
+                # Counted as misses. The texts are simply embedded again.
+                print(f'Error reading from the embedding cache: {type(e)}: {e}')
+                entries = []
+
+            for _, key, embedding in entries:
+                embeddings[remaining[key]] = [float(value) for value in embedding]
+
+            self._remember({keys[text]: embeddings[text] for text in embeddings})
+
+            with self._lock:
+                self.db_hits += len(entries)
+
+        with self._lock:
+            self.misses += len(texts) - len(embeddings)
+
+        return embeddings
+
+    def put_many(self, embeddings):
+        """Cache embeddings (dict of normalized text -> list of float), evicting old ones if over capacity."""
+        if not embeddings:
+            return
+
+        keyed_embeddings = {self.make_key(text): embedding for text, embedding in embeddings.items()}
+        self._remember(keyed_embeddings)
+
+        if not self.max_entries:
+            return
+
+        try:
+            # Other processes may have cached the same texts in the meantime.
+            EmbeddingCacheEntry.objects.bulk_create([
+                EmbeddingCacheEntry(
+                    model_name=self.model_name, dimensions=self.dimensions,
+                    text_hash=key, embedding=embedding
+                )
+                for key, embedding in keyed_embeddings.items()
+            ], ignore_conflicts=True)
+
+        except Exception as e:
+            print(f'Error writing to the embedding cache: {type(e)}: {e}')
+            return
+
+        with self._lock:
+            self._puts_since_eviction_check += len(keyed_embeddings)
+            if self._puts_since_eviction_check < self.EVICTION_CHECK_INTERVAL:
+                return
+
+            self._puts_since_eviction_check = 0
+
+        self.evict()
+
+    def _remember(self, keyed_embeddings):
+        with self._lock:
+            for key, embedding in keyed_embeddings.items():
+                self._memory[key] = embedding
+                self._memory.move_to_end(key)
+
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _flush_memory_hits(self, force=False):
+        """Mark entries hit in memory as used in the DB, every MEMORY_HITS_FLUSH_INTERVAL seconds.
+
+        Otherwise the hottest entries, which are served from memory, would look
+        the least recently used in the DB, and be evicted first.
+        """
+        with self._lock:
+            if not self._memory_hit_keys or not self.max_entries:
+                return
+
+            if not force and time.monotonic() - self._last_memory_hits_flush < self.MEMORY_HITS_FLUSH_INTERVAL:
+                return
+
+            keys = list(self._memory_hit_keys)
+            self._memory_hit_keys = set()
+            self._last_memory_hits_flush = time.monotonic()
+
+        try:
+            EmbeddingCacheEntry.objects.filter(
+                model_name=self.model_name, dimensions=self.dimensions, text_hash__in=keys
+            ).update(time_last_used=timezone.now())
+
+        except Exception as e:
+            print(f'Error recording embedding cache hits: {type(e)}: {e}')
+
+    def evict(self):
+        """Delete the least recently used entries beyond max_entries from the DB."""
+        # Entries in use in this process aren't stale.
+        self._flush_memory_hits(force=True)
+        try:
+            stale_ids = list(
+                EmbeddingCacheEntry.objects.filter(model_name=self.model_name, dimensions=self.dimensions)
+                .order_by('-time_last_used').values_list('id', flat=True)[self.max_entries:]
+            )
+
+            if stale_ids:
+                EmbeddingCacheEntry.objects.filter(id__in=stale_ids).delete()
+
+        except Exception as e:
+            print(f'Error evicting from the embedding cache: {type(e)}: {e}')
+            return
+
+        with self._lock:
+            self.evictions += len(stale_ids)
+
+    def stats(self):
+        """Return hit/miss counts and the hit rate, as a dictionary."""
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memory_entries': len(self._memory),
+                'hit_rate': (self.memory_hits + self.db_hits) / lookups if lookups else None,
+            }
+
+
+class QueryEmbeddingCache():
+    """Embeddings of search queries, so repeated searches, e.g. as the user
+    types or adjusts the threshold, don't wait on the embedding model.
+
+    Queries are embedded through the embedding cache, which is shared by all
+    processes and keeps them across restarts (see EmbeddingCache). This keeps
+    the embeddings of up to memory_entries of them in process as well, so the
+    page texts that pass through the embedding cache (e.g. while ingesting)
+    don't push them out of memory. Searches are logged to the SearchQuery
+    table, in the background, for warm_query_embeddings to embed ahead of
+    time. The table holds at most max_entries queries, evicting the least
+    recently searched ones beyond that.
+    """
+    # Eviction needs a count of all entries, so is only checked every so often.
+    EVICTION_CHECK_INTERVAL = 100
+
+    def __init__(self, model_name=EMBEDDING_MODEL, max_entries=SEARCH_QUERY_LOG_MAX_ENTRIES,
+            memory_entries=QUERY_EMBEDDING_MEMORY_ENTRIES):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._records_since_eviction_check = 0
+        self._lock = threading.Lock()
+        # Keeps background writes from being garbage collected.
+        self._tasks = set()
+
+    async def aget(self, text):
+        """Return the embedding of a search query, and log the search.
+
+        Args:
+            text: str - The query.
+
+        Returns:
+            list of float: The embedding, or None if text is empty or it
+                couldn't be calculated.
+        """
+        text = EmbeddingCache.normalize(text or '')
+        if not text:
+            return None
+
+        key = EmbeddingCache.make_key(text)
+        embedding = self._get_from_memory(key)
+
+        if embedding is None:
+            with self._lock:
+                self.misses += 1
+
+            embedding = await sync_to_async(calculate_embeddings)(text)
+            if embedding is not None:
+                self._remember(key, embedding)
+
+        # Off the latency path.
+        task = asyncio.ensure_future(self._arecord_search(key, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return embedding
+
+    def _get_from_memory(self, key):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is None:
+                return None
+
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+
+            return embedding
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._memory[key] = embedding
+            self._memory.move_to_end(key)
+
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    async def _arecord_search(self, key, text):
+        """Log a search of text."""
+        now = timezone.now()
+        values = {'searches': F('searches') + 1, 'time_last_searched': now}
+
+        try:
+            queries = SearchQuery.objects.filter(model_name=self.model_name, text_hash=key)
+            if not await queries.aupdate(**values):
+                try:
+                    await SearchQuery.objects.acreate(
+                        model_name=self.model_name, text_hash=key, text=text,
+                        searches=1, time_last_searched=now
+                    )
+
+                # Another worker logged the same query in the meantime.
+                except IntegrityError:
+                    await queries.aupdate(**values)
+
+            with self._lock:
+                self._records_since_eviction_check += 1
+                if self._records_since_eviction_check < self.EVICTION_CHECK_INTERVAL:
+                    return
+
+                self._records_since_eviction_check = 0
+
+            await self.aevict()
+
+        except Exception as e:
+            print(f'Error logging search query: {e}')
+
+    async def aevict(self):
+        """Delete the least recently searched queries beyond max_entries from the DB."""
+        stale_ids = [
+            id async for id in
+            SearchQuery.objects.filter(model_name=self.model_name)
+            .order_by('-time_last_searched').values_list('id', flat=True)[self.max_entries:]
+        ]
+
+        if stale_ids:
+            await SearchQuery.objects.filter(id__in=stale_ids).adelete()
+
+            with self._lock:
+                self.evictions += len(stale_ids)
+
+    def stats(self):
+        """Return hit/miss counts and the hit rate, as a dictionary.
+
+        Misses are looked up in the embedding cache, which has stats of its
+        own. Evictions are of logged queries.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'db_hits': 0,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memory_entries': len(self._memory),
+                'hit_rate': self.memory_hits / lookups if lookups else None,
+            }
+
+
+class EmbeddingBatcher():
+    """Collects texts to embed from concurrent callers into shared batches.
+
+    A batch is sent as soon as it is full (see batch_texts), or
+    EMBEDDING_BATCH_WAIT_MS after its first text arrived, so pages saved
+    around the same time (e.g. while ingesting a document) share requests to
+    the embedding backend. Batches are embedded in threads, concurrently.
+
+    Futures are bound to the event loop, so there is a batcher per loop (see
+    get_embedding_batcher).
+    """
+    def __init__(self, batch_size=None, max_tokens=None, wait_ms=None):
+        """
+        Args:
+            batch_size, max_tokens: int - Optional. See batch_texts.
+            wait_ms: float - Optional. Default EMBEDDING_BATCH_WAIT_MS.
+        """
+        self.batch_size = batch_size or EMBEDDING_BATCH_SIZE
+        self.max_tokens = max_tokens or EMBEDDING_BATCH_MAX_TOKENS
+        self.wait = (EMBEDDING_BATCH_WAIT_MS if wait_ms is None else wait_ms) / 1000
+
+        # (text, future) pairs waiting to be sent.
+        self._pending = []
+        self._pending_tokens = 0
+        self._flush_handle = None
+        # Keeps running batches from being garbage collected.
+        self._tasks = set()
+
+    async def embed(self, texts):
+        """Return the embeddings of texts. See calculate_embeddings_batch."""
+        loop = asyncio.get_running_loop()
+
+        futures = []
+        for text in texts:
+            if not text:
+                futures.append(None)
+                continue
+
+            tokens = estimate_embedding_tokens(text)
+            if self._pending and self._pending_tokens + tokens > self.max_tokens:
+                self._flush()
+
+            future = loop.create_future()
+            self._pending.append((text, future))
+            self._pending_tokens += tokens
+            futures.append(future)
+
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.wait, self._flush)
+
+        return [None if future is None else await future for future in futures]
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._embed_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch):
+        try:
+            # Looks up the embedding cache, so runs on the thread the ORM's
+            # connections are managed on.
+            embeddings = await sync_to_async(calculate_embeddings_batch)(
+                [text for text, _ in batch], self.batch_size, self.max_tokens
+            )
+
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        # Callers may have been cancelled in the meantime.
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+
+_embedding_batchers = weakref.WeakKeyDictionary()
+
+
+def get_embedding_batcher():
+    """Return the EmbeddingBatcher for the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _embedding_batchers:
+        _embedding_batchers[loop] = EmbeddingBatcher()
+
+    return _embedding_batchers[loop]
+
+
+async def acalculate_embeddings_batch(texts):
+    """Async calculate_embeddings_batch, batched with other callers' texts (see EmbeddingBatcher)."""
+    return await get_embedding_batcher().embed(texts)
+
+
+# Records or replays embeddings in place of calling Ollama directly, if
+# EMBEDDING_BACKEND_MODE says so.
+embedding_backend = None
+if EMBEDDING_BACKEND_MODE != 'live':
+    embedding_backend = ReplayEmbeddings(
+        EMBEDDING_MODEL, EMBEDDING_BACKEND_MODE, embed=_calculate_ollama_embeddings
+    )
+
+# Replayed embeddings may be synthetic, so are kept apart from real ones.
+embedding_cache = EmbeddingCache(
+    EMBEDDING_MODEL if EMBEDDING_BACKEND_MODE != 'replay' else f'{EMBEDDING_MODEL} (replay)'
+)
+llm_metrics.add_cache('embedding', embedding_cache)
+
+query_embedding_cache = QueryEmbeddingCache(embedding_cache.model_name)
+llm_metrics.add_cache('query_embedding', query_embedding_cache)
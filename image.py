@@ -1,10 +1,24 @@
 import base64
+import hashlib
 from io import BytesIO
 
 import requests
 import numpy as np
 from PIL import Image as PILImage
 
+# See Image.is_grayscale.
+GRAYSCALE_TOLERANCE = 24
+
+# Range of JPEG qualities Image.normalized picks from, and how it shrinks
+# images that don't fit their byte budget even at the lowest quality.
+MIN_JPEG_QUALITY = 40
+MAX_JPEG_QUALITY = 90
+FIT_DOWNSCALE_FACTOR = 0.8
+MAX_FIT_DOWNSCALES = 4
+
+# Maximum number of encodings (format/quality combinations) cached per Image.
+ENCODED_CACHE_MAX_ENTRIES = 4
+
 
 class Image():
     """
@@ -45,6 +59,34 @@ class Image():
         else:
             raise ValueError("Unsupported data type.")
 
+        # Quality to encode the image at when converting it to JPEG, unless
+        # one is asked for explicitly. None means Pillow's default (75). Set
+        # by normalized to fit a byte budget.
+        self.jpeg_quality = None
+
+    @property
+    def image(self):
+        """The underlying PIL image."""
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """Drop cached encodings and normalized copies of the image.
+
+        Happens automatically when the image is replaced (self.image = ...).
+        Call this after modifying the underlying PIL image in place, e.g. with
+        ImageDraw, which can't be detected.
+        """
+        # Encoded payloads keyed on (format, quality, size). See _encode.
+        self._encoded_cache = {}
+        self._base64_cache = {}
+        # Results of normalized, which is called on every prompt (and retry).
+        self._normalized_cache = {}
+
     def _load_from_numpy_array(self, data):
         if data.ndim == 2:  # grayscale
             mode = "L"
@@ -91,7 +133,173 @@ class Image():
 
         return Image(self.image.convert("L"))
 
-    def to_base64(self, format=None):
+    def content_hash(self):
+        """Return a SHA-256 hash of the image's contents.
+
+        The hash is calculated from the decoded pixels (along with the mode and
+        dimensions), so identical images hash the same regardless of the file
+        format or encoder settings they were saved with.
+
+        Returns:
+            str - Hex digest of the hash.
+        """
+        digest = hashlib.sha256(f'{self.mode}:{self.width}x{self.height}:'.encode())
+        digest.update(self.image.tobytes())
+
+        return digest.hexdigest()
+
+    def is_grayscale(self, tolerance=GRAYSCALE_TOLERANCE):
+        """Check whether the image is (near enough) grayscale.
+
+        A downscaled copy is checked so this is cheap even for large images.
+
+        Args:
+            tolerance: int - How far apart (0-255) a pixel's channels may be
+                for the pixel to still count as gray. Allows for scanner and
+                compression noise. Default GRAYSCALE_TOLERANCE.
+
+        Returns:
+            bool - True if converting the image to grayscale would lose no
+                meaningful colour, e.g. a scan of black text on white paper.
+        """
+        if self.mode in ("L", "1", "LA"):
+            return True
+
+        thumbnail = self.image.convert("RGB")
+        thumbnail.thumbnail((256, 256))
+        pixels = np.asarray(thumbnail, dtype=np.int16)
+        chroma = pixels.max(axis=2) - pixels.min(axis=2)
+
+        # A percentile rather than the max, so a few stray coloured pixels
+        # don't count.
+        return np.percentile(chroma, 99.5) <= tolerance
+
+    def normalized(self, max_long_side=None, max_short_side=None, max_bytes=None,
+            allow_grayscale=True):
+        """Return a copy of the Image fit for sending to a model.
+
+        The copy is:
+        1. Scaled down (never up) to fit within the given dimensions.
+        2. Converted to grayscale if that loses no meaningful colour (see
+           is_grayscale) and allow_grayscale is set.
+        3. Given the highest jpeg_quality at which its JPEG encoding fits in
+           max_bytes, scaling it down further if even low quality doesn't fit.
+
+        Args:
+            max_long_side: int - Optional. Maximum length of the longer side,
+                in pixels.
+            max_short_side: int - Optional. Maximum length of the shorter side,
+                in pixels.
+            max_bytes: int - Optional. Maximum size of the JPEG encoding.
+            allow_grayscale: bool - Optional. Default True.
+
+        Returns:
+            Image - The normalized copy.
+        """
+        cache_key = (max_long_side, max_short_side, max_bytes, allow_grayscale)
+        if cache_key not in self._normalized_cache:
+            self._normalized_cache[cache_key] = self._normalize(*cache_key)
+
+        return self._normalized_cache[cache_key]
+
+    def _normalize(self, max_long_side, max_short_side, max_bytes, allow_grayscale):
+        image = self.image
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        long_side, short_side = max(image.size), min(image.size)
+        scale = 1.0
+        if max_long_side and long_side > max_long_side:
+            scale = max_long_side / long_side
+
+        if max_short_side and short_side * scale > max_short_side:
+            scale = max_short_side / short_side
+
+        if scale < 1.0:
+            image = self._scaled(image, scale)
+
+        normalized = Image(image)
+        if allow_grayscale and normalized.mode != "L" and normalized.is_grayscale():
+            normalized = Image(image.convert("L"))
+
+        if max_bytes:
+            normalized._fit_jpeg_quality(max_bytes)
+
+        return normalized
+
+    def _fit_jpeg_quality(self, max_bytes):
+        """Set jpeg_quality to the highest quality whose encoding fits in max_bytes.
+
+        Scales the image down if it doesn't fit even at MIN_JPEG_QUALITY.
+        """
+        for _ in range(MAX_FIT_DOWNSCALES):
+            # Binary search over qualities, for the highest that fits.
+            low, high = MIN_JPEG_QUALITY, MAX_JPEG_QUALITY
+            best = None
+            while low <= high:
+                quality = (low + high) // 2
+                # Uncached, so the trial encodings aren't kept around.
+                if len(self._encode_uncached("JPEG", quality)) <= max_bytes:
+                    best = quality
+                    low = quality + 1
+                else:
+                    high = quality - 1
+
+            if best is not None:
+                self.jpeg_quality = best
+                return
+
+            self.image = self._scaled(self.image, FIT_DOWNSCALE_FACTOR)
+
+        self.jpeg_quality = MIN_JPEG_QUALITY
+
+    @staticmethod
+    def _scaled(image, scale):
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(size, PILImage.LANCZOS)
+
+    def _resolve_encoding(self, format=None, quality=None):
+        format = (format or self.image.format or "PNG").upper()
+        if format == "JPG":
+            format = "JPEG"
+
+        if format != "JPEG":
+            quality = None
+        elif quality is None:
+            quality = self.jpeg_quality
+
+        return format, quality
+
+    def _encode_uncached(self, format, quality):
+        options = {} if quality is None else {"quality": quality}
+
+        buffer = BytesIO()
+        self.image.save(buffer, format=format, **options)
+
+        return buffer.getvalue()
+
+    def _encode(self, format=None, quality=None):
+        """Encode the image, reusing the result of any identical previous encoding.
+
+        Encodings are cached on (format, quality, size) until the image changes
+        (see invalidate_cache), so prompts, retries and conversation history
+        that send the same image don't re-encode it.
+        """
+        format, quality = self._resolve_encoding(format, quality)
+        cache_key = (format, quality, self.image.size)
+
+        if cache_key not in self._encoded_cache:
+            if len(self._encoded_cache) >= ENCODED_CACHE_MAX_ENTRIES:
+                # Dicts are ordered, so this drops the oldest.
+                oldest_key = next(iter(self._encoded_cache))
+                del self._encoded_cache[oldest_key]
+                self._base64_cache.pop(oldest_key, None)
+
+            self._encoded_cache[cache_key] = self._encode_uncached(format, quality)
+
+        return cache_key, self._encoded_cache[cache_key]
+
+    def to_base64(self, format=None, quality=None):
         """Return a base64 representation of the Image.
 
         Args:
@@ -101,15 +309,18 @@ class Image():
                 Example options: "JPEG", "PNG", "WebP", and more.
                 See below for all possible options.
                 https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html
+            quality - int - (default None). JPEG quality (1-95). If no value is
+                provided, the Image's jpeg_quality is used.
 
         Returns:
             str - A base64 representation of the image (in the supplied format
             if one is provided).
         """
-        buffer = BytesIO()
-        self.image.save(buffer, format=format or self.image.format)
+        cache_key, encoded = self._encode(format, quality)
+        if cache_key not in self._base64_cache:
+            self._base64_cache[cache_key] = base64.b64encode(encoded).decode('utf-8')
 
-        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        return self._base64_cache[cache_key]
 
     def to_numpy_array(self):
         return np.array(self.image)
@@ -117,12 +328,13 @@ class Image():
     def to_pil_image(self):
         return self.image
 
-    def to_bytes(self, format=None):
+    def to_bytes(self, format=None, quality=None):
         """Return a bytes representation of the Image.
 
         Args:
             format - str - (default None). The format to represent the
                 image in. If no value is provided, the Image's format is used.
+            quality - int - (default None). JPEG quality.
 
                 See to_base64 for details.
 
@@ -130,10 +342,19 @@ class Image():
             bytes - A bytes representation of the image (in the supplied format
             if one is provided).
         """
-        buffer = BytesIO()
-        self.image.save(buffer, format=format or self.image.format)
+        return self._encode(format, quality)[1]
 
-        return buffer.getvalue()
+    def to_memoryview(self, format=None, quality=None):
+        """Return a read-only view of the Image's encoding, without copying it.
+
+        Args:
+            format - str - (default None). See to_base64.
+            quality - int - (default None). See to_base64.
+
+        Returns:
+            memoryview - A view of the (cached) encoded bytes.
+        """
+        return memoryview(self._encode(format, quality)[1])
 
     def save(self, path):
         """Save the Image to the given path. Format is inferred from the file extension."""
@@ -1,18 +1,45 @@
+import asyncio
+from email.utils import parsedate_to_datetime
 import json
 import os
 import time
+import weakref
 
+import httpx
 import requests
 
 import env
+from llm.scheduler import scheduler
+
+# Rough number of tokens an image counts for, for rate limiting purposes.
+# Varies by provider and image size (OpenAI: up to ~1100, Gemini: 258).
+IMAGE_TOKEN_ESTIMATE = 1000
+
+# Maximum number of (kept alive) connections to the Ollama server per process,
+# for each of the sync and async clients.
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get('OLLAMA_MAX_CONNECTIONS', 32))
+
 
 class LLMAPIException(Exception):
     """Generic exception type for LLM API issues."""
-    pass
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
 
 
 class BaseAPI():
-    """Base class for LLM APIs."""
+    """Base class for LLM APIs.
+
+    Subclasses should send all requests through _schedule (or _aschedule),
+    which paces them to the provider's rate limits and retries transient
+    failures. See llm.scheduler.
+
+    Besides run_prompt, subclasses implement arun_prompt, which does the same
+    on the event loop, using an async client with pooled connections (see
+    _get_async_client). Many requests can then be in flight at once without a
+    thread each.
+    """
 
     def __init__(self, name):
         self.name = name
@@ -23,6 +50,142 @@ class BaseAPI():
     def run_prompt(self, *args, **kwargs):
         raise NotImplementedError()
 
+    async def arun_prompt(self, *args, **kwargs):
+        """Async version of run_prompt. Returns an async generator if streaming."""
+        raise NotImplementedError()
+
+    def _create_async_client(self):
+        raise NotImplementedError()
+
+    def _get_async_client(self):
+        """Return this API's async client for the running event loop.
+
+        Async clients' connections are tied to the event loop they were made
+        on, so one is kept per loop (e.g. the app's and each ingest worker's).
+        """
+        if getattr(self, '_async_clients', None) is None:
+            self._async_clients = weakref.WeakKeyDictionary()
+
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            self._async_clients[loop] = self._create_async_client()
+
+        return self._async_clients[loop]
+
+    def count_tokens_locally(self, string, model_name):
+        """Return the number of tokens in string, or None if it can't be counted locally.
+
+        Unlike num_tokens, never makes a request, so is cheap enough to use on
+        every call (e.g. for metrics).
+        """
+        return None
+
+    @staticmethod
+    def estimate_tokens(user_prompt, images=None, system_prompt=None, messages=None, max_tokens=0):
+        """Roughly estimate the tokens a prompt will use, for rate limiting.
+
+        Counts ~4 characters per token for text, IMAGE_TOKEN_ESTIMATE per image
+        and all of max_tokens for the response, as providers do when enforcing
+        limits.
+        """
+        characters = len(user_prompt or '') + len(system_prompt or '')
+        num_images = len(images or [])
+        for message in messages or []:
+            characters += len(getattr(message, 'text', '') or '')
+            num_images += len(getattr(message, 'images', None) or [])
+
+        return characters // 4 + num_images * IMAGE_TOKEN_ESTIMATE + (max_tokens or 0)
+
+    @staticmethod
+    def _parse_retry_after(value):
+        """Parse a Retry-After header value (seconds or HTTP date) into seconds."""
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+
+        except (TypeError, ValueError):
+            return None
+
+    def classify_error(self, error):
+        """Decide whether a failed request should be retried.
+
+        Rate limited (429) and server (5xx) errors, connection errors and
+        timeouts are retried. Works with the exceptions raised by requests and
+        the OpenAI, Groq and Google client libraries, which all carry an HTTP
+        status code one way or another.
+
+        Args:
+            error: Exception - The exception the request raised.
+
+        Returns:
+            tuple of (bool, float or None): Whether to retry, and how many
+                seconds the provider asked us to wait first (if it did).
+        """
+        response = getattr(error, 'response', None)
+        status_code = (
+            getattr(error, 'status_code', None)
+            or getattr(response, 'status_code', None)
+            or getattr(error, 'code', None)
+        )
+
+        retry_after = getattr(error, 'retry_after', None)
+        headers = getattr(response, 'headers', None)
+        if retry_after is None and headers is not None:
+            retry_after = self._parse_retry_after(headers.get('retry-after'))
+
+        if isinstance(status_code, int):
+            return status_code == 429 or status_code >= 500, retry_after
+
+        if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+            return True, None
+
+        # e.g. openai.APIConnectionError, openai.APITimeoutError
+        error_type = type(error).__name__
+        return 'Connection' in error_type or 'Timeout' in error_type, None
+
+    def _schedule(self, model_name, request, estimated_tokens=0, stream=False):
+        """Send a request through the shared scheduler.
+
+        Args:
+            model_name: str - The model the request is for.
+            request: callable - Sends the request and returns the response, or
+                a generator of chunks if stream is True.
+            estimated_tokens: int - Optional. See estimate_tokens.
+            stream: bool - Optional. Whether request returns a stream. Streams
+                are only retried until their first chunk arrives.
+
+        Returns:
+            The response, or a generator of chunks if stream is True.
+        """
+        run = scheduler.run_streaming if stream else scheduler.run
+
+        return run(self.name, model_name, request, estimated_tokens, self.classify_error)
+
+    def _aschedule(self, model_name, request, estimated_tokens=0, stream=False):
+        """Async version of _schedule.
+
+        Args:
+            request: callable - Returns an awaitable that sends the request and
+                returns the response, or an async generator of chunks if stream
+                is True.
+            See _schedule for the rest.
+
+        Returns:
+            An awaitable of the response, or an async generator of chunks if
+            stream is True.
+        """
+        run = scheduler.arun_streaming if stream else scheduler.arun
+
+        return run(self.name, model_name, request, estimated_tokens, self.classify_error)
+
 
 class OpenAIAPI(BaseAPI):
     """Interface to the OpenAI API."""
@@ -50,6 +213,12 @@ class OpenAIAPI(BaseAPI):
         except Exception:
             return False
 
+    def _create_async_client(self):
+        from openai import AsyncOpenAI
+
+        # Pools and keeps alive connections (via httpx).
+        return AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
     def list_models(self):
         return set([model.id for model in self._client.models.list()])
 
@@ -59,6 +228,18 @@ class OpenAIAPI(BaseAPI):
 
         return len(encoding.encode(string))
 
+    def count_tokens_locally(self, string, model_name):
+        # Subclasses (Groq, Ollama) don't have tiktoken, and it doesn't know
+        # every model.
+        if not hasattr(self, '_tiktoken_encoding_for_model'):
+            return None
+
+        try:
+            return self.num_tokens(string, model_name)
+
+        except KeyError:
+            return None
+
     def generate_message_history(self, messages=None):
         if messages is None:
            return []
@@ -143,38 +324,120 @@ class OpenAIAPI(BaseAPI):
             **options
         )
 
-        for chunk in response:
-            # The first and last chunk seem to contain '' and None resp. Ignore those.
-            chunk_text = chunk.choices[0].delta.content
-            if chunk_text:
-                yield chunk_text
+        # Closing the response early (e.g. if the caller stops reading) stops
+        # the generation.
+        try:
+            for chunk in response:
+                # The first and last chunk seem to contain '' and None resp. Ignore those.
+                chunk_text = chunk.choices[0].delta.content
+                if chunk_text:
+                    yield chunk_text
+
+        finally:
+            response.close()
 
     def run_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
 
         messages_to_send = self._package_messages_to_send(user_prompt, images, system_prompt, messages)
+        estimated_tokens = self.estimate_tokens(user_prompt, images, system_prompt, messages, max_tokens)
 
         options = {}
         if response_format == "json":
             options['response_format'] = {"type": "json_object"}
 
         if stream:
-            return self._run_prompt_streaming(
+            return self._schedule(
+                model_name,
+                lambda: self._run_prompt_streaming(
+                    model=model_name,
+                    messages=messages_to_send,
+                    max_tokens=max_tokens,
+                    response_format=response_format,
+                    temperature=temperature
+                ),
+                estimated_tokens,
+                stream=True
+            )
+
+        response = self._schedule(
+            model_name,
+            lambda: self._client.chat.completions.create(
                 model=model_name,
                 messages=messages_to_send,
                 max_tokens=max_tokens,
-                response_format=response_format,
-                temperature=temperature
-            )
+                stream=False,
+                temperature=temperature,
+                **options
+            ),
+            estimated_tokens
+        )
 
-        response = self._client.chat.completions.create(
-            model=model_name,
-            messages=messages_to_send,
+        return response.choices[0].message.content
+
+    async def _arun_prompt_streaming(self, model, messages, max_tokens, response_format, temperature):
+        """Async version of _run_prompt_streaming."""
+        options = {}
+        if response_format == "json":
+            options['response_format'] = {"type": "json_object"}
+
+        response = await self._get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
             max_tokens=max_tokens,
-            stream=False,
+            stream=True,
             temperature=temperature,
             **options
         )
 
+        try:
+            async for chunk in response:
+                chunk_text = chunk.choices[0].delta.content
+                if chunk_text:
+                    yield chunk_text
+
+        finally:
+            await response.close()
+
+    async def arun_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+        """Async version of run_prompt.
+
+        Returns:
+            str, or an async generator of str chunks if stream is True.
+        """
+        messages_to_send = self._package_messages_to_send(user_prompt, images, system_prompt, messages)
+        estimated_tokens = self.estimate_tokens(user_prompt, images, system_prompt, messages, max_tokens)
+
+        options = {}
+        if response_format == "json":
+            options['response_format'] = {"type": "json_object"}
+
+        if stream:
+            return self._aschedule(
+                model_name,
+                lambda: self._arun_prompt_streaming(
+                    model=model_name,
+                    messages=messages_to_send,
+                    max_tokens=max_tokens,
+                    response_format=response_format,
+                    temperature=temperature
+                ),
+                estimated_tokens,
+                stream=True
+            )
+
+        response = await self._aschedule(
+            model_name,
+            lambda: self._get_async_client().chat.completions.create(
+                model=model_name,
+                messages=messages_to_send,
+                max_tokens=max_tokens,
+                stream=False,
+                temperature=temperature,
+                **options
+            ),
+            estimated_tokens
+        )
+
         return response.choices[0].message.content
 
 
@@ -187,6 +450,11 @@ class GroqAPI(OpenAIAPI):
         self._client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
         self.name = name
 
+    def _create_async_client(self):
+        from groq import AsyncGroq
+
+        return AsyncGroq(api_key=os.environ.get("GROQ_API_KEY"))
+
     def list_models(self):
         return set([model.id for model in self._client.models.list().data])
 
@@ -195,6 +463,8 @@ class OllamaAPI(OpenAIAPI):
     """Interface to the Ollama API. Borrows some functionality from the OpenAI API."""
 
     def __init__(self, name='Ollama'):
+        self.name = name
+
         host = os.environ.get('OLLAMA_CLIENT_HOST', 'http://localhost:11434')
         if host[-1] == '/':
             host = host[:-1]
@@ -203,8 +473,27 @@ class OllamaAPI(OpenAIAPI):
         self.model_list_endpoint = f"{host}/api/tags"
         self.model_pull_endpoint = f"{host}/api/pull"
 
+        # Reuse connections across requests rather than opening one for each.
+        self._session = requests.Session()
+        self._session.mount(
+            host,
+            requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=OLLAMA_MAX_CONNECTIONS
+            )
+        )
+
+    def _create_async_client(self):
+        return httpx.AsyncClient(
+            # Generation can take minutes, as with the sync client.
+            timeout=None,
+            limits=httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_CONNECTIONS
+            )
+        )
+
     def list_models(self):
-        response = requests.get(self.model_list_endpoint)
+        response = self._session.get(self.model_list_endpoint)
         response_data = json.loads(response.content)
 
         return set(
@@ -225,7 +514,7 @@ class OllamaAPI(OpenAIAPI):
             bool - True if pull successful. False otherwise.
         """
         try:
-            response = requests.post(self.model_pull_endpoint,
+            response = self._session.post(self.model_pull_endpoint,
                 json={"name": name, "stream": False}, stream=False)
 
             response_data = json.loads(response.content)
@@ -278,7 +567,7 @@ class OllamaAPI(OpenAIAPI):
         chunks so the calling code only need expect text chunks.
         """
 
-        response = requests.post(
+        response = self._session.post(
             self.chat_endpoint,
             json=self._generate_request_payload(model, messages, True, response_format, temperature),
             # Important to have this here (in addition to stream in the payload)!
@@ -286,39 +575,149 @@ class OllamaAPI(OpenAIAPI):
             # https://requests.readthedocs.io/en/latest/user/advanced/#streaming-requests
             stream=True
         )
+        # Closing the response early (e.g. if the caller stops reading) stops
+        # the generation.
+        try:
+            self._raise_for_status(response)
+
+            for chunk in response.iter_lines():
+                body = json.loads(chunk)
+                if "error" in body:
+                    raise LLMAPIException(body["error"])
+
+                # Phrasing it like this because we want "done" to be in body and
+                # be equal to False (i.e. we don't want to evaluate block if
+                # "done" is not in body, which would return the Falsy None).
+                if body.get("done") is False:
+                    message = body.get("message", "")
+                    content = message.get("content", "")
+
+                    yield content
+
+        finally:
+            response.close()
+
+    def _raise_for_status(self, response):
+        """Raise an LLMAPIException (carrying the status code) if a request failed.
+
+        Ollama puts error details in the body of failed responses, so this is
+        used in place of response.raise_for_status.
+        """
+        if response.status_code < 400:
+            return
 
-        for chunk in response.iter_lines():
-            body = json.loads(chunk)
-            if "error" in body:
-                raise LLMAPIException(body["error"])
+        # requests and httpx responses respectively.
+        reason = getattr(response, 'reason', None) or getattr(response, 'reason_phrase', '')
+        try:
+            error = json.loads(response.content).get('error', reason)
 
-            # Phrasing it like this because we want "done" to be in body and
-            # be equal to False (i.e. we don't want to evaluate block if
-            # "done" is not in body, which would return the Falsy None).
-            if body.get("done") is False:
-                message = body.get("message", "")
-                content = message.get("content", "")
+        except ValueError:
+            error = reason
 
-                yield content
+        raise LLMAPIException(
+            error,
+            status_code=response.status_code,
+            retry_after=self._parse_retry_after(response.headers.get('retry-after'))
+        )
 
     def run_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
 
         messages_to_send = self._package_messages_to_send(user_prompt, images, system_prompt, messages)
+        estimated_tokens = self.estimate_tokens(user_prompt, images, system_prompt, messages, max_tokens)
 
         if stream:
-            return self._run_prompt_streaming(
-                model=model_name,
-                messages=messages_to_send,
-                max_tokens=max_tokens,
-                response_format=response_format,
-                temperature=temperature
+            return self._schedule(
+                model_name,
+                lambda: self._run_prompt_streaming(
+                    model=model_name,
+                    messages=messages_to_send,
+                    max_tokens=max_tokens,
+                    response_format=response_format,
+                    temperature=temperature
+                ),
+                estimated_tokens,
+                stream=True
             )
 
-        response = requests.post(
+        def send_request():
+            response = self._session.post(
+                self.chat_endpoint,
+                json=self._generate_request_payload(model_name, messages_to_send, False, response_format, temperature),
+            )
+            self._raise_for_status(response)
+
+            return response
+
+        response = self._schedule(model_name, send_request, estimated_tokens)
+        response_data = json.loads(response.content)
+
+        if 'error' in response_data:
+            raise LLMAPIException(response_data['error'])
+
+        return response_data['message']['content']
+
+    async def _arun_prompt_streaming(self, model, messages, max_tokens, response_format, temperature):
+        """Async version of _run_prompt_streaming.
+
+        The response is closed on leaving the with block, including when the
+        caller stops reading early.
+        """
+        async with self._get_async_client().stream(
+            'POST',
             self.chat_endpoint,
-            json=self._generate_request_payload(model_name, messages_to_send, False, response_format, temperature),
-        )
+            json=self._generate_request_payload(model, messages, True, response_format, temperature)
+        ) as response:
+            if response.status_code >= 400:
+                await response.aread()
+            self._raise_for_status(response)
+
+            async for chunk in response.aiter_lines():
+                if not chunk:
+                    continue
+
+                body = json.loads(chunk)
+                if "error" in body:
+                    raise LLMAPIException(body["error"])
+
+                if body.get("done") is False:
+                    message = body.get("message", "")
+                    content = message.get("content", "")
+
+                    yield content
 
+    async def arun_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+        """Async version of run_prompt.
+
+        Returns:
+            str, or an async generator of str chunks if stream is True.
+        """
+        messages_to_send = self._package_messages_to_send(user_prompt, images, system_prompt, messages)
+        estimated_tokens = self.estimate_tokens(user_prompt, images, system_prompt, messages, max_tokens)
+
+        if stream:
+            return self._aschedule(
+                model_name,
+                lambda: self._arun_prompt_streaming(
+                    model=model_name,
+                    messages=messages_to_send,
+                    max_tokens=max_tokens,
+                    response_format=response_format,
+                    temperature=temperature
+                ),
+                estimated_tokens,
+                stream=True
+            )
+
+        async def send_request():
+            response = await self._get_async_client().post(
+                self.chat_endpoint,
+                json=self._generate_request_payload(model_name, messages_to_send, False, response_format, temperature),
+            )
+            self._raise_for_status(response)
+
+            return response
+
+        response = await self._aschedule(model_name, send_request, estimated_tokens)
         response_data = json.loads(response.content)
 
         if 'error' in response_data:
@@ -429,10 +828,13 @@ class GoogleAPI(BaseAPI):
     def _run_prompt_streaming(self, model, messages_to_send):
         response = model.generate_content(messages_to_send, stream=True)
 
+        # Abandoning the response's iterator (when the caller stops reading
+        # early) cancels the underlying gRPC stream.
         for chunk in response:
             yield chunk.text
 
-    def run_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+    def _prepare_request(self, model_name, user_prompt, images, system_prompt, messages, max_tokens, response_format, temperature):
+        """Return the GenerativeModel to prompt and the messages to send it."""
         generation_config = {
             "temperature": temperature,
             "top_p": 0.95,
@@ -459,10 +861,72 @@ class GoogleAPI(BaseAPI):
             self.generate_message("user", user_prompt, images)
         )
 
+        return model, messages_to_send
+
+    def run_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+        model, messages_to_send = self._prepare_request(
+            model_name, user_prompt, images, system_prompt, messages, max_tokens,
+            response_format, temperature
+        )
+        estimated_tokens = self.estimate_tokens(user_prompt, images, system_prompt, messages, max_tokens)
+
+        if stream:
+            return self._schedule(
+                model_name,
+                lambda: self._run_prompt_streaming(model, messages_to_send),
+                estimated_tokens,
+                stream=True
+            )
+
+        response = self._schedule(
+            model_name,
+            lambda: model.generate_content(messages_to_send),
+            estimated_tokens
+        )
+        return response.candidates[0].content.parts[0].text
+
+    async def _arun_prompt_streaming(self, model, messages_to_send):
+        """Async version of _run_prompt_streaming."""
+        response = await model.generate_content_async(messages_to_send, stream=True)
+
+        chunks = aiter(response)
+        try:
+            async for chunk in chunks:
+                yield chunk.text
+
+        finally:
+            await chunks.aclose()
+            # Unlike the sync one, the async gRPC stream isn't cancelled by
+            # abandoning the response, so cancel it to stop the generation.
+            stream = getattr(response, '_iterator', None)
+            if hasattr(stream, 'cancel'):
+                stream.cancel()
+
+    async def arun_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+        """Async version of run_prompt.
+
+        Returns:
+            str, or an async generator of str chunks if stream is True.
+        """
+        model, messages_to_send = self._prepare_request(
+            model_name, user_prompt, images, system_prompt, messages, max_tokens,
+            response_format, temperature
+        )
+        estimated_tokens = self.estimate_tokens(user_prompt, images, system_prompt, messages, max_tokens)
+
         if stream:
-            return self._run_prompt_streaming(model, messages_to_send)
+            return self._aschedule(
+                model_name,
+                lambda: self._arun_prompt_streaming(model, messages_to_send),
+                estimated_tokens,
+                stream=True
+            )
 
-        response = model.generate_content(messages_to_send)
+        response = await self._aschedule(
+            model_name,
+            lambda: model.generate_content_async(messages_to_send),
+            estimated_tokens
+        )
         return response.candidates[0].content.parts[0].text
 
 
@@ -513,6 +977,14 @@ class TestAPI():
 
         return ''.join([word for word in response_generator])
 
+    async def arun_prompt(self, prompt=None, *args, stream=False, **kwargs):
+        """Async version of run_prompt."""
+        response_generator = self._astream_text_chunks()
+        if stream:
+            return response_generator
+
+        return ''.join([word async for word in response_generator])
+
     def _stream_text_chunks(self, num_words=20, delay_ms=100):
         """Streams a piece of text in chunks with a configurable delay.
 
@@ -533,3 +1005,15 @@ class TestAPI():
 
             yield padding + word
             padding = ' '
+
+    async def _astream_text_chunks(self, num_words=20, delay_ms=100):
+        """Async version of _stream_text_chunks."""
+        words = self.LOREM_IPSUM.split(' ')
+        num_words = min(num_words, len(words))
+
+        padding = ''
+        for word in words[:num_words]:
+            await asyncio.sleep(delay_ms / 1000)
+
+            yield padding + word
+            padding = ' '
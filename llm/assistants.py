@@ -58,10 +58,16 @@ class Assistant():
             max_tokens=max_tokens
         )
 
+        # Close the model's response if we're closed before the end, so the
+        # generation is stopped rather than left running.
         all_chunks = []
-        for chunk in response:
-            all_chunks.append(chunk)
-            yield chunk
+        try:
+            for chunk in response:
+                all_chunks.append(chunk)
+                yield chunk
+
+        finally:
+            response.close()
 
         user_message = Message(sender="user", text=user_prompt, images=images)
         ai_message = Message(sender="assistant", text=''.join(all_chunks))
@@ -75,6 +81,32 @@ class Assistant():
             conversation.messages.append(user_message)
             conversation.messages.append(ai_message)
 
+    async def _aprompt_streaming(self, user_prompt, images, system_prompt, messages, response_format, conversation, max_tokens):
+        """Async version of _prompt_streaming."""
+        response = await self.model.arun_prompt(
+            user_prompt=user_prompt,
+            images=images,
+            system_prompt=system_prompt,
+            messages=messages,
+            stream=True,
+            response_format=response_format,
+            temperature=self.temperature,
+            max_tokens=max_tokens
+        )
+
+        all_chunks = []
+        try:
+            async for chunk in response:
+                all_chunks.append(chunk)
+                yield chunk
+
+        finally:
+            await response.aclose()
+
+        if conversation is not None:
+            conversation.messages.append(Message(sender="user", text=user_prompt, images=images))
+            conversation.messages.append(Message(sender="assistant", text=''.join(all_chunks)))
+
     def prompt(self, prompt, *, images=None, conversation=None, stream=False,
                response_format="text", system_prompt_context=None, max_tokens=500):
         """Send the assistant a prompt/message.
@@ -138,6 +170,52 @@ class Assistant():
         return response
 
 
+    async def aprompt(self, prompt, *, images=None, conversation=None, stream=False,
+               response_format="text", system_prompt_context=None, max_tokens=500):
+        """Async version of prompt. Takes the same arguments.
+
+        Returns:
+            str or async str generator: The assistant's response. If
+                stream=True, an async generator is returned.
+        """
+        messages = []
+        if conversation is not None:
+            messages = conversation.messages
+
+        if images is None or not self.model.supports_vision:
+            images = []
+
+        system_prompt = self.generate_system_prompt(system_prompt_context)
+
+        if stream:
+            return self._aprompt_streaming(
+                user_prompt=prompt,
+                images=images,
+                system_prompt=system_prompt,
+                messages=messages,
+                response_format=response_format,
+                conversation=conversation,
+                max_tokens=max_tokens
+            )
+
+        response = await self.model.arun_prompt(
+            user_prompt=prompt,
+            images=images,
+            system_prompt=system_prompt,
+            messages=messages,
+            stream=False,
+            response_format=response_format,
+            temperature=self.temperature,
+            max_tokens=max_tokens
+        )
+
+        if conversation is not None:
+            conversation.messages.append(Message(sender="user", text=prompt, images=images))
+            conversation.messages.append(Message(sender="assistant", text=response))
+
+        return response
+
+
 class Conversation():
     """Should be possible to rebuild (initialize) based on external e.g. db data."""
     def __init__(self, participants=None, messages=None):
@@ -0,0 +1,253 @@
+"""Incremental validation of JSON objects streamed from an LLM.
+
+Lets a caller abort a streamed response as soon as it can no longer be valid,
+rather than paying for the full generation before finding out, e.g.
+
+    validator = IncrementalJSONValidator({'text': {'string', 'null'}})
+    for chunk in response:
+        validator.feed(chunk)  # Raises JSONStreamError on bad input.
+
+    validator.finish()
+"""
+import re
+import string
+
+# JSON value types, keyed on the character each starts with.
+VALUE_START_TYPES = {
+    '{': 'object',
+    '[': 'array',
+    '"': 'string',
+    't': 'boolean',
+    'f': 'boolean',
+    'n': 'null',
+    '-': 'number',
+    **{digit: 'number' for digit in string.digits},
+}
+
+LITERALS = {'t': 'true', 'f': 'false', 'n': 'null'}
+
+NUMBER_CHARACTERS = set(string.digits + '+-.eE')
+NUMBER_PATTERN = re.compile(r'-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?')
+
+WHITESPACE = set(' \t\r\n')
+
+
+class JSONStreamError(ValueError):
+    """Raised when streamed JSON is malformed or doesn't match the expected types.
+
+    Attributes:
+        position: int - Index of the offending character in the stream.
+        response: str - The response received up to the point of failure, if
+            set by the caller.
+    """
+    def __init__(self, message, position=None):
+        super().__init__(message if position is None else f'{message} (at character {position})')
+        self.position = position
+        self.response = None
+
+
+class IncrementalJSONValidator():
+    """Validates a JSON object chunk by chunk, as it is streamed.
+
+    Checks the syntax, and the types of the object's top level fields. Fields
+    not in field_types are allowed, of any type. Required fields aren't
+    checked, since whether a field is missing is only known at the end, when
+    the full response can simply be validated as usual.
+    """
+    def __init__(self, field_types=None):
+        """
+        Args:
+            field_types: dict of str -> set of str - Optional. Allowed JSON
+                types ('object', 'array', 'string', 'number', 'boolean' or
+                'null') of the object's top level fields, by name.
+        """
+        self.field_types = field_types or {}
+        self.position = 0
+        self.complete = False
+
+        # Containers ('object' or 'array') the parser is currently inside.
+        self._stack = []
+        # The next thing expected (outside of any string/number/literal).
+        self._expect = 'value'
+        # The string, number or literal currently being read, if any.
+        self._token = None
+        # The top level field whose value is being read.
+        self._field = None
+
+    def feed(self, chunk):
+        """Validate the next chunk of the stream.
+
+        Args:
+            chunk: str - The next chunk.
+
+        Raises:
+            JSONStreamError: If the stream so far can't be the start of a
+                valid object.
+        """
+        for character in chunk:
+            self._feed_character(character)
+            self.position += 1
+
+    def finish(self):
+        """Check that the stream ended with a complete object.
+
+        Raises:
+            JSONStreamError: If it didn't.
+        """
+        if not self.complete:
+            raise JSONStreamError('Response ended before the JSON object was complete', self.position)
+
+    def _fail(self, message):
+        raise JSONStreamError(message, self.position)
+
+    def _feed_character(self, character):
+        if self._token is not None:
+            kind = self._token['kind']
+            if kind == 'string':
+                self._feed_string_character(character)
+                return
+
+            if kind == 'literal':
+                word, index = self._token['word'], self._token['index']
+                if character != word[index]:
+                    self._fail(f'Invalid literal (expected "{word}")')
+
+                self._token['index'] += 1
+                if self._token['index'] == len(word):
+                    self._token = None
+                    self._end_value()
+
+                return
+
+            # A number, which only ends when something else starts.
+            if character in NUMBER_CHARACTERS:
+                self._token['characters'].append(character)
+                return
+
+            if not NUMBER_PATTERN.fullmatch(''.join(self._token['characters'])):
+                self._fail('Invalid number')
+
+            self._token = None
+            self._end_value()
+
+        if character in WHITESPACE:
+            return
+
+        if self._expect == 'end':
+            self._fail('Unexpected data after the end of the JSON object')
+
+        if self._expect in ('value', 'value_or_end'):
+            if self._expect == 'value_or_end' and character == ']':
+                self._stack.pop()
+                self._end_value()
+
+            else:
+                self._start_value(character)
+
+        elif self._expect in ('key', 'key_or_end'):
+            if self._expect == 'key_or_end' and character == '}':
+                self._stack.pop()
+                self._end_value()
+
+            elif character == '"':
+                self._token = {'kind': 'string', 'is_key': True, 'escape': False, 'characters': []}
+
+            else:
+                self._fail('Expected a key')
+
+        elif self._expect == 'colon':
+            if character != ':':
+                self._fail('Expected ":"')
+
+            self._expect = 'value'
+
+        elif self._expect == 'comma_or_end':
+            container = self._stack[-1]
+            if character == ',':
+                self._expect = 'key' if container == 'object' else 'value'
+
+            elif character == ('}' if container == 'object' else ']'):
+                self._stack.pop()
+                self._end_value()
+
+            else:
+                self._fail('Expected "," or the end of the ' + container)
+
+    def _start_value(self, character):
+        value_type = VALUE_START_TYPES.get(character)
+        if value_type is None:
+            self._fail('Expected a value')
+
+        if not self._stack and value_type != 'object':
+            self._fail('Expected a JSON object')
+
+        if len(self._stack) == 1 and self._field in self.field_types:
+            allowed_types = self.field_types[self._field]
+            if value_type not in allowed_types:
+                self._fail(
+                    f'"{self._field}" should be {" or ".join(sorted(allowed_types))}, not {value_type}'
+                )
+
+        if value_type in ('object', 'array'):
+            self._stack.append(value_type)
+            self._expect = 'key_or_end' if value_type == 'object' else 'value_or_end'
+
+        elif value_type == 'string':
+            self._token = {'kind': 'string', 'is_key': False, 'escape': False, 'characters': []}
+
+        elif value_type == 'number':
+            self._token = {'kind': 'number', 'characters': [character]}
+
+        else:
+            self._token = {'kind': 'literal', 'word': LITERALS[character], 'index': 1}
+
+    def _feed_string_character(self, character):
+        token = self._token
+        # escape is True just after a backslash, or the number of hex digits
+        # left in a \uXXXX escape.
+        if token['escape'] is True:
+            if character == 'u':
+                token['escape'] = 4
+
+            elif character in '"\\/bfnrt':
+                token['escape'] = False
+
+            else:
+                self._fail('Invalid escape in string')
+
+        elif token['escape']:
+            if character not in string.hexdigits:
+                self._fail('Invalid unicode escape in string')
+
+            token['escape'] = token['escape'] - 1 or False
+
+        elif character == '\\':
+            token['escape'] = True
+
+        elif character == '"':
+            self._token = None
+            if token['is_key']:
+                if len(self._stack) == 1:
+                    self._field = ''.join(token['characters'])
+
+                self._expect = 'colon'
+
+            else:
+                self._end_value()
+
+            return
+
+        elif character < ' ':
+            self._fail('Unescaped control character in string')
+
+        # Only top level keys are needed.
+        if token['is_key'] and len(self._stack) == 1:
+            token['characters'].append(character)
+
+    def _end_value(self):
+        if self._stack:
+            self._expect = 'comma_or_end'
+
+        else:
+            self._expect = 'end'
+            self.complete = True
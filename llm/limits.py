@@ -0,0 +1,250 @@
+"""Caps on the number of calls in flight at once to LLM providers and embedding backends.
+
+Limits are configured per provider/backend name through environment variables
+holding comma-separated name=limit pairs, e.g.
+
+    LLM_CONCURRENCY_LIMITS="google=8,openai=16,ollama=2"
+    EMBEDDING_CONCURRENCY_LIMITS="ollama=4"
+
+Names are case-insensitive and match the API's name (see llm.apis). Names
+without a limit fall back to the *_DEFAULT_CONCURRENCY_LIMIT variables, or are
+unlimited if those aren't set.
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import os
+import threading
+
+
+def parse_limits(spec):
+    """Parse a limits spec string into a dictionary.
+
+    Args:
+        spec: str - Comma-separated name=limit pairs, e.g. "google=8,ollama=2".
+
+    Returns:
+        dict of str -> int: Lowercased names mapped to their limits.
+
+    Raises:
+        ValueError: If the spec is malformed.
+    """
+    limits = {}
+    for pair in spec.split(','):
+        if not pair.strip():
+            continue
+
+        name, _, limit = pair.partition('=')
+        if not name.strip() or not limit.strip():
+            raise ValueError(f'Malformed concurrency limit: "{pair}". Expected name=limit.')
+
+        limits[name.strip().lower()] = int(limit)
+
+    return limits
+
+
+class Slots():
+    """A counting semaphore that threads and coroutines (on any event loop) can wait on alike.
+
+    Freed slots are handed straight to the longest waiting caller, whether a
+    thread or a coroutine, so neither has to poll for them.
+    """
+    def __init__(self, limit):
+        """
+        Args:
+            limit: int - Number of slots.
+        """
+        self._available = limit
+        # Callables that hand a slot to a waiting caller, returning False if
+        # it can no longer take it.
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a slot, blocking until one is free."""
+        with self._lock:
+            if self._available and not self._waiters:
+                self._available -= 1
+                return
+
+            event = threading.Event()
+
+            def wake():
+                event.set()
+                return True
+
+            self._waiters.append(wake)
+
+        event.wait()
+
+    async def aacquire(self):
+        """Take a slot, waiting until one is free without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._available and not self._waiters:
+                self._available -= 1
+                return
+
+            future = loop.create_future()
+
+            def wake():
+                try:
+                    loop.call_soon_threadsafe(
+                        lambda: future.done() or future.set_result(None)
+                    )
+                    return True
+
+                except RuntimeError:
+                    # The loop has been closed.
+                    return False
+
+            self._waiters.append(wake)
+
+        try:
+            await future
+
+        except asyncio.CancelledError:
+            with self._lock:
+                if wake in self._waiters:
+                    self._waiters.remove(wake)
+                    raise
+
+            # A slot was handed over in the meantime. Pass it on.
+            self.release()
+            raise
+
+    def release(self):
+        """Free a slot, handing it to the longest waiting caller if there is one."""
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._available += 1
+                    return
+
+                wake = self._waiters.popleft()
+
+            if wake():
+                return
+
+
+class ConcurrencyLimiter():
+    """Per-name caps on concurrent calls, shared by all threads in the process.
+
+    Slots are shared between threads and coroutines (see Slots), so async
+    callers (see alimit) and threaded callers count against the same limits.
+
+    Example:
+        with llm_provider_limits.limit('Google'):
+            response = model.generate_content(...)
+
+        async with llm_provider_limits.alimit('Google'):
+            response = await model.generate_content_async(...)
+    """
+    def __init__(self, limits=None, default=None):
+        """
+        Args:
+            limits: dict of str -> int - Optional. Maximum concurrent calls per
+                name.
+            default: int - Optional. Limit for names not in limits. Default
+                None, i.e. unlimited.
+        """
+        self.limits = {name.lower(): limit for name, limit in (limits or {}).items()}
+        self.default = default
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _get_slots(self, name):
+        name = name.lower()
+        with self._lock:
+            if name not in self._slots:
+                limit = self.limits.get(name, self.default)
+                self._slots[name] = Slots(limit) if limit else None
+
+            return self._slots[name]
+
+    @contextmanager
+    def limit(self, name):
+        """Context manager that holds one of name's slots for its duration.
+
+        Blocks until a slot is free.
+
+        Args:
+            name: str - The provider/backend name.
+        """
+        slots = self._get_slots(name)
+        if slots is None:
+            yield
+            return
+
+        slots.acquire()
+        try:
+            yield
+
+        finally:
+            slots.release()
+
+    def limit_stream(self, name, chunks):
+        """Hold one of name's slots for as long as a streamed response is consumed.
+
+        Args:
+            name: str - The provider/backend name.
+            chunks: generator - The streamed response.
+
+        Yields:
+            Chunks from chunks.
+        """
+        with self.limit(name):
+            yield from chunks
+
+    @asynccontextmanager
+    async def alimit(self, name):
+        """Async version of limit. Waits for a slot without blocking the event loop.
+
+        Args:
+            name: str - The provider/backend name.
+        """
+        slots = self._get_slots(name)
+        if slots is None:
+            yield
+            return
+
+        await slots.aacquire()
+        try:
+            yield
+
+        finally:
+            slots.release()
+
+    async def alimit_stream(self, name, chunks):
+        """Async version of limit_stream.
+
+        Args:
+            name: str - The provider/backend name.
+            chunks: async generator - The streamed response.
+
+        Yields:
+            Chunks from chunks.
+        """
+        async with self.alimit(name):
+            try:
+                async for chunk in chunks:
+                    yield chunk
+
+            finally:
+                await chunks.aclose()
+
+
+def _default_limit(variable):
+    value = os.environ.get(variable, '').strip()
+    return int(value) if value else None
+
+
+llm_provider_limits = ConcurrencyLimiter(
+    parse_limits(os.environ.get('LLM_CONCURRENCY_LIMITS', '')),
+    default=_default_limit('LLM_DEFAULT_CONCURRENCY_LIMIT')
+)
+
+embedding_backend_limits = ConcurrencyLimiter(
+    parse_limits(os.environ.get('EMBEDDING_CONCURRENCY_LIMITS', '')),
+    default=_default_limit('EMBEDDING_DEFAULT_CONCURRENCY_LIMIT')
+)
@@ -0,0 +1,267 @@
+"""Metrics on calls to LLMs: latency, tokens, bytes and cost.
+
+Every Model.run_prompt/arun_prompt call is recorded in llm_metrics (see
+llm.models.Model). Caches in front of models (e.g. db.models.EmbeddingCache)
+can be added to llm_metrics too, to report their hit rates.
+
+Metrics are aggregated per process. Processes other than the web app (e.g.
+ingest workers) periodically write snapshots of theirs to METRICS_DIR (see
+write_snapshot), so that render_prometheus can report on all of them, with a
+process label to tell them apart.
+"""
+import json
+import math
+import os
+import socket
+import threading
+import time
+
+from .scheduler import scheduler
+
+
+METRICS_DIR = os.environ.get(
+    'LLM_METRICS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metrics')
+)
+
+# Snapshots not updated for this long are from processes that have gone away,
+# and are ignored (and cleaned up).
+SNAPSHOT_MAX_AGE_SECONDS = 15 * 60
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, math.inf)
+
+
+def get_process_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class LLMMetrics():
+    """In-process aggregate metrics on LLM calls, per provider, model and outcome. Thread-safe."""
+
+    COUNTERS = (
+        'calls', 'input_tokens', 'output_tokens', 'request_bytes',
+        'response_bytes', 'cost_dollars',
+    )
+
+    def __init__(self):
+        self._series = {}
+        self._latencies = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def add_cache(self, name, cache):
+        """Include a cache's stats in snapshots.
+
+        Args:
+            name: str - The cache's name, e.g. 'embedding'.
+            cache: object - Has a stats() method returning a dictionary of
+                memory_hits, db_hits, misses, evictions and memory_entries.
+        """
+        with self._lock:
+            self._caches[name] = cache
+
+    def record_call(self, provider, model, status, duration, time_to_first_chunk=None,
+            input_tokens=0, output_tokens=0, request_bytes=0, response_bytes=0,
+            cost=0.0):
+        """Record a call.
+
+        Args:
+            provider: str - The API's name.
+            model: str - The model's name.
+            status: str - 'ok', 'error' or 'cancelled'.
+            duration: float - Wall time (seconds) of the whole call, including
+                reading any streamed response.
+            time_to_first_chunk: float - Optional. For streamed responses,
+                seconds until the first chunk arrived.
+            input_tokens, output_tokens: int - Optional. Tokens sent/received.
+            request_bytes, response_bytes: int - Optional. Bytes of text and
+                images sent, and of text received.
+            cost: float - Optional. Estimated cost in dollars.
+        """
+        key = (provider, model, status)
+        with self._lock:
+            series = self._series.setdefault(key, dict.fromkeys(self.COUNTERS, 0))
+            series['calls'] += 1
+            series['input_tokens'] += input_tokens
+            series['output_tokens'] += output_tokens
+            series['request_bytes'] += request_bytes
+            series['response_bytes'] += response_bytes
+            series['cost_dollars'] += cost
+
+            self._observe((provider, model, 'duration'), duration)
+            if time_to_first_chunk is not None:
+                self._observe((provider, model, 'time_to_first_chunk'), time_to_first_chunk)
+
+    def _observe(self, key, value):
+        histogram = self._latencies.setdefault(
+            key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0}
+        )
+        histogram['sum'] += value
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+
+    def snapshot(self):
+        """Return this process's metrics as a JSON-serializable dictionary."""
+        with self._lock:
+            snapshot = {
+                'process': get_process_name(),
+                'time': time.time(),
+                'calls': [
+                    {'provider': provider, 'model': model, 'status': status, **series}
+                    for (provider, model, status), series in self._series.items()
+                ],
+                'latencies': [
+                    {
+                        'provider': provider, 'model': model, 'metric': metric,
+                        'buckets': list(histogram['buckets']), 'sum': histogram['sum']
+                    }
+                    for (provider, model, metric), histogram in self._latencies.items()
+                ],
+            }
+
+            caches = dict(self._caches)
+
+        snapshot['scheduler'] = scheduler.stats()
+        snapshot['caches'] = {name: cache.stats() for name, cache in caches.items()}
+        return snapshot
+
+    def write_snapshot(self, metrics_dir=METRICS_DIR):
+        """Write a snapshot to metrics_dir for render_prometheus to pick up."""
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, f'{get_process_name()}.json')
+
+        # Write then rename, so readers never see a partial file.
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+
+        os.replace(f'{path}.tmp', path)
+
+
+def read_snapshots(metrics_dir=METRICS_DIR, max_age=SNAPSHOT_MAX_AGE_SECONDS):
+    """Return the recent snapshots written by other processes, deleting stale ones."""
+    snapshots = []
+    if not os.path.isdir(metrics_dir):
+        return snapshots
+
+    own_snapshot = f'{get_process_name()}.json'
+    for filename in os.listdir(metrics_dir):
+        if not filename.endswith('.json') or filename == own_snapshot:
+            continue
+
+        path = os.path.join(metrics_dir, filename)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                continue
+
+            with open(path) as f:
+                snapshots.append(json.load(f))
+
+        except (OSError, ValueError) as e:
+            print(f'Could not read metrics snapshot {path}: {e}')
+
+    return snapshots
+
+
+def _labels(**labels):
+    escaped = {
+        name: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for name, value in labels.items()
+    }
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+
+def render_prometheus(snapshots):
+    """Render snapshots in the Prometheus text exposition format.
+
+    Args:
+        snapshots: list of dict - See LLMMetrics.snapshot.
+
+    Returns:
+        str
+    """
+    counters = {
+        'calls': ('llm_calls_total', 'LLM calls.'),
+        'input_tokens': ('llm_input_tokens_total', 'Tokens sent to LLMs (counted locally or estimated).'),
+        'output_tokens': ('llm_output_tokens_total', 'Tokens received from LLMs (counted locally or estimated).'),
+        'request_bytes': ('llm_request_bytes_total', 'Bytes of text and images sent to LLMs.'),
+        'response_bytes': ('llm_response_bytes_total', 'Bytes of text received from LLMs.'),
+        'cost_dollars': ('llm_cost_dollars_total', 'Estimated cost of LLM calls in US dollars.'),
+    }
+    histograms = {
+        'duration': ('llm_call_duration_seconds', 'Wall time of LLM calls.'),
+        'time_to_first_chunk': ('llm_time_to_first_chunk_seconds', 'Time to the first chunk of streamed LLM responses.'),
+    }
+    scheduler_metrics = {
+        'queue_depth': ('llm_scheduler_queue_depth', 'gauge', 'LLM requests waiting on rate limits or backoff.'),
+        'requests': ('llm_scheduler_requests_total', 'counter', 'LLM requests sent, retries included.'),
+        'retries': ('llm_scheduler_retries_total', 'counter', 'LLM requests retried.'),
+        'failures': ('llm_scheduler_failures_total', 'counter', 'LLM requests that failed for good.'),
+        'wait_seconds': ('llm_scheduler_wait_seconds_total', 'counter', 'Time LLM requests spent waiting on rate limits or backoff.'),
+    }
+    cache_metrics = {
+        'misses': ('cache_misses_total', 'counter', 'Cache lookups that missed both tiers.'),
+        'evictions': ('cache_evictions_total', 'counter', 'Entries evicted from the shared (DB) tier.'),
+        'memory_entries': ('cache_memory_entries', 'gauge', 'Entries in the in-process tier.'),
+    }
+
+    lines = []
+    for counter, (name, description) in counters.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+        for snapshot in snapshots:
+            for series in snapshot['calls']:
+                labels = _labels(
+                    process=snapshot['process'], provider=series['provider'],
+                    model=series['model'], status=series['status']
+                )
+                lines.append(f'{name}{labels} {series[counter]}')
+
+    for metric, (name, description) in histograms.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+        for snapshot in snapshots:
+            for series in snapshot['latencies']:
+                if series['metric'] != metric:
+                    continue
+
+                labels = dict(
+                    process=snapshot['process'], provider=series['provider'], model=series['model']
+                )
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, series['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else bound
+                    lines.append(f'{name}_bucket{_labels(**labels, le=le)} {cumulative}')
+
+                lines.append(f'{name}_sum{_labels(**labels)} {series["sum"]}')
+                lines.append(f'{name}_count{_labels(**labels)} {cumulative}')
+
+    for stat, (name, metric_type, description) in scheduler_metrics.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+        for snapshot in snapshots:
+            for key, stats in snapshot.get('scheduler', {}).items():
+                provider, _, model = key.partition('/')
+                labels = _labels(process=snapshot['process'], provider=provider, model=model)
+                lines.append(f'{name}{labels} {stats.get(stat, 0)}')
+
+    name = 'cache_hits_total'
+    lines += [f'# HELP {name} Cache lookups that hit, by tier.', f'# TYPE {name} counter']
+    for snapshot in snapshots:
+        for cache, stats in snapshot.get('caches', {}).items():
+            for tier in ('memory', 'db'):
+                labels = _labels(process=snapshot['process'], cache=cache, tier=tier)
+                lines.append(f'{name}{labels} {stats.get(f"{tier}_hits", 0)}')
+
+    for stat, (name, metric_type, description) in cache_metrics.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+        for snapshot in snapshots:
+            for cache, stats in snapshot.get('caches', {}).items():
+                labels = _labels(process=snapshot['process'], cache=cache)
+                lines.append(f'{name}{labels} {stats.get(stat, 0)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+llm_metrics = LLMMetrics()
@@ -1,6 +1,23 @@
+import asyncio
 import os
+import time
 
-from .apis import GoogleAPI, OpenAIAPI, OllamaAPI, GroqAPI
+from .apis import IMAGE_TOKEN_ESTIMATE, GoogleAPI, OpenAIAPI, OllamaAPI, GroqAPI
+from .limits import llm_provider_limits
+from .metrics import llm_metrics
+from .replay import ReplayAPI, get_backend_mode
+
+
+# Default byte budget for each image sent to a model. See Model.prepare_image.
+DEFAULT_IMAGE_MAX_BYTES = int(os.environ.get('LLM_IMAGE_MAX_KB', 400)) * 1024
+
+# Pages parsed per request by models that support batching. See
+# Model.page_batch_size.
+GEMINI_PAGE_BATCH_SIZE = int(os.environ.get('GEMINI_PAGE_BATCH_SIZE', 4))
+
+# 'live', or 'record'/'replay' to record real responses or serve recorded ones
+# in their place. See llm.replay.
+LLM_BACKEND_MODE = get_backend_mode('LLM_BACKEND_MODE')
 
 
 class Model():
@@ -8,7 +25,9 @@ class Model():
 
     def __init__(self, name, api, input_token_limit=1024, output_token_limit=1024,
             supports_vision=False, uncensored=False, supports_system_message=True,
-            supports_json_mode=True):
+            supports_json_mode=True, image_max_long_side=2048,
+            image_max_short_side=None, image_max_bytes=DEFAULT_IMAGE_MAX_BYTES,
+            page_batch_size=1, input_token_price=0.0, output_token_price=0.0):
 
         self.name = name
         self.api = api
@@ -19,6 +38,18 @@ class Model():
         self.uncensored = uncensored
         self.supports_system_message = supports_system_message
         self.supports_json_mode = supports_json_mode
+        # Images are normalized to these before being sent (see prepare_image).
+        # Beyond the model's own limits, larger images cost more upload bytes
+        # (and for some providers, tokens) without helping it read them.
+        self.image_max_long_side = image_max_long_side
+        self.image_max_short_side = image_max_short_side
+        self.image_max_bytes = image_max_bytes
+        # Number of page images to parse per request. Only worth raising above
+        # 1 for long-context models. See parser.parse_page_images.
+        self.page_batch_size = page_batch_size
+        # Dollars per million tokens, for cost estimates (see llm.metrics).
+        self.input_token_price = input_token_price
+        self.output_token_price = output_token_price
 
     @property
     def censored(self):
@@ -37,23 +68,138 @@ class Model():
 
         return self.name in self.api.list_models()
 
-    def run_prompt(self, user_prompt, images=None, system_prompt=None,
-            messages=None, stream=False, response_format="text",
-            temperature=0.0, max_tokens=500):
-        # TODO: Decide whether to raise an error if images are provided but model
-        # does not support vision. Think about possible scenarios where images
-        # may be present (non-accidentally) as an argument for keeping things
-        # as they are now.
-        if images is None or not self.supports_vision:
-            images = []
+    def prepare_image(self, image):
+        """Normalize an image to the size, colour and byte budget that suit this model.
+
+        Args:
+            image: image.Image - The image to prepare.
+
+        Returns:
+            image.Image - A normalized copy of image (see Image.normalized).
+        """
+        return image.normalized(
+            max_long_side=self.image_max_long_side,
+            max_short_side=self.image_max_short_side,
+            max_bytes=self.image_max_bytes
+        )
+
+    def count_tokens(self, text):
+        """Count the tokens in text, locally if the API can, otherwise estimate."""
+        num_tokens = self.api.count_tokens_locally(text, self.name)
+        if num_tokens is None:
+            num_tokens = len(text) // 4
+
+        return num_tokens
+
+    def estimate_cost(self, input_tokens, output_tokens):
+        """Return the estimated cost of a call in dollars."""
+        return (
+            input_tokens * self.input_token_price
+            + output_tokens * self.output_token_price
+        ) / 1_000_000
+
+    def _record_call(self, prompt_args, start_time, response_text, error=None,
+            time_to_first_chunk=None):
+        """Record a call's metrics in llm_metrics. See llm.metrics."""
+        messages = prompt_args['messages'] or []
+        input_text = ''.join(
+            [prompt_args['system_prompt'] or '', prompt_args['user_prompt'] or '']
+            + [message.text or '' for message in messages]
+        )
+        images = list(prompt_args['images']) + [
+            image for message in messages for image in (message.images or [])
+        ]
+
+        try:
+            input_tokens = self.count_tokens(input_text) + len(images) * IMAGE_TOKEN_ESTIMATE
+            output_tokens = self.count_tokens(response_text)
+            status = 'ok'
+            if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+                # e.g. the losing side of a hedged request, or a streamed
+                # response abandoned by the caller.
+                status = 'cancelled'
+
+            elif error is not None:
+                status = 'error'
+
+            llm_metrics.record_call(
+                self.api.name,
+                self.name,
+                status,
+                time.monotonic() - start_time,
+                time_to_first_chunk=time_to_first_chunk,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                request_bytes=len(input_text.encode()) + sum(
+                    len(image.to_bytes(format='JPEG')) for image in images
+                ),
+                response_bytes=len(response_text.encode()),
+                cost=self.estimate_cost(input_tokens, output_tokens)
+            )
+
+        except Exception as e:
+            # Metrics should never break a call.
+            print(f'Error recording metrics for {self.name}: {type(e)}: {e}')
+
+    def _measure_stream(self, prompt_args, start_time, chunks):
+        """Pass a streamed response through, recording its metrics once it's done."""
+        all_chunks = []
+        time_to_first_chunk = None
+        error = None
+        try:
+            for chunk in chunks:
+                if time_to_first_chunk is None:
+                    time_to_first_chunk = time.monotonic() - start_time
+
+                all_chunks.append(chunk)
+                yield chunk
+
+        except BaseException as e:
+            error = e
+            raise
+
+        finally:
+            chunks.close()
+            self._record_call(
+                prompt_args, start_time, ''.join(all_chunks), error, time_to_first_chunk
+            )
+
+    async def _ameasure_stream(self, prompt_args, start_time, chunks):
+        """Async version of _measure_stream."""
+        all_chunks = []
+        time_to_first_chunk = None
+        error = None
+        try:
+            async for chunk in chunks:
+                if time_to_first_chunk is None:
+                    time_to_first_chunk = time.monotonic() - start_time
+
+                all_chunks.append(chunk)
+                yield chunk
+
+        except BaseException as e:
+            error = e
+            raise
+
+        finally:
+            await chunks.aclose()
+            self._record_call(
+                prompt_args, start_time, ''.join(all_chunks), error, time_to_first_chunk
+            )
+
+    def _generate_prompt_args(self, user_prompt, images, system_prompt,
+            messages, stream, response_format, temperature, max_tokens):
+        """Check and package up the arguments to the API's run_prompt.
 
+        Images should already have been prepared (see prepare_image).
+        """
         if max_tokens > self.output_token_limit:
             raise ValueError(
                 f"max_tokens cannot be greater than model\'s' output token "
                 f"limit ({self.output_token_limit})."
             )
 
-        return self.api.run_prompt(
+        prompt_args = dict(
             model_name=self.name,
             user_prompt=user_prompt,
             images=images,
@@ -66,56 +212,218 @@ class Model():
             max_tokens=max_tokens
         )
 
+        return prompt_args
+
+    def run_prompt(self, user_prompt, images=None, system_prompt=None,
+            messages=None, stream=False, response_format="text",
+            temperature=0.0, max_tokens=500):
+        # TODO: Decide whether to raise an error if images are provided but model
+        # does not support vision. Think about possible scenarios where images
+        # may be present (non-accidentally) as an argument for keeping things
+        # as they are now.
+        if images is None or not self.supports_vision:
+            images = []
+
+        images = [self.prepare_image(image) for image in images]
+        prompt_args = self._generate_prompt_args(
+            user_prompt, images, system_prompt, messages, stream,
+            response_format, temperature, max_tokens
+        )
+
+        # Calls are capped per provider (see llm.limits). For streamed
+        # responses the slot is held until the stream has been consumed.
+        start_time = time.monotonic()
+        if stream:
+            return self._measure_stream(
+                prompt_args,
+                start_time,
+                llm_provider_limits.limit_stream(
+                    self.api.name, self.api.run_prompt(**prompt_args)
+                )
+            )
+
+        response = ''
+        error = None
+        try:
+            with llm_provider_limits.limit(self.api.name):
+                response = self.api.run_prompt(**prompt_args)
+
+            return response
+
+        except BaseException as e:
+            error = e
+            raise
+
+        finally:
+            self._record_call(prompt_args, start_time, response or '', error)
+
+    async def arun_prompt(self, user_prompt, images=None, system_prompt=None,
+            messages=None, stream=False, response_format="text",
+            temperature=0.0, max_tokens=500):
+        """Async version of run_prompt. Returns an async generator if streaming."""
+        if images is None or not self.supports_vision:
+            images = []
+
+        # Resizing/encoding images is CPU-bound, so keep it off the event loop.
+        images = await asyncio.gather(*[
+            asyncio.to_thread(self.prepare_image, image) for image in images
+        ])
+        prompt_args = self._generate_prompt_args(
+            user_prompt, images, system_prompt, messages, stream,
+            response_format, temperature, max_tokens
+        )
+
+        start_time = time.monotonic()
+        if stream:
+            return self._ameasure_stream(
+                prompt_args,
+                start_time,
+                llm_provider_limits.alimit_stream(
+                    self.api.name, await self.api.arun_prompt(**prompt_args)
+                )
+            )
+
+        response = ''
+        error = None
+        try:
+            async with llm_provider_limits.alimit(self.api.name):
+                response = await self.api.arun_prompt(**prompt_args)
+
+            return response
+
+        except BaseException as e:
+            error = e
+            raise
+
+        finally:
+            self._record_call(prompt_args, start_time, response or '', error)
+
+
+def get_model(name):
+    """Return the model with the given name, or None if it isn't configured.
+
+    Only models whose APIs have been configured (see below) are defined.
+    """
+    for value in globals().values():
+        if isinstance(value, Model) and value.name == name:
+            return value
+
+    return None
+
+
+def configure_api(api_class, name, variable):
+    """Return the API to use for a provider, or None if it isn't configured.
+
+    A provider is configured by setting an environment variable (its API key
+    or host). In replay mode (see LLM_BACKEND_MODE), all providers are, with
+    recorded responses standing in for them.
+
+    Args:
+        api_class: type - The provider's API class (see llm.apis).
+        name: str - The API's name.
+        variable: str - The environment variable that configures it.
+    """
+    if LLM_BACKEND_MODE == 'replay':
+        return ReplayAPI(name)
+
+    if not os.environ.get(variable, '').strip():
+        return None
+
+    api = api_class(name)
+    if LLM_BACKEND_MODE == 'record':
+        return ReplayAPI(name, 'record', wrapped=api)
+
+    return api
+
 
-if os.environ.get('OPENAI_API_KEY', '').strip():
-    openai_api = OpenAIAPI()
+openai_api = configure_api(OpenAIAPI, 'OpenAI', 'OPENAI_API_KEY')
+if openai_api is not None:
     # Token limits and other info here: https://platform.openai.com/docs/models
-    # Pricing: https://openai.com/api/pricing/
-    gpt_3_5_turbo = Model('gpt-3.5-turbo', openai_api, 16385, 4096)
-    gpt_4_turbo = Model('gpt-4-turbo', openai_api, 128000, 4096, supports_vision=True)
+    # Pricing (dollars per million input/output tokens): https://openai.com/api/pricing/
+    gpt_3_5_turbo = Model('gpt-3.5-turbo', openai_api, 16385, 4096,
+        input_token_price=0.5, output_token_price=1.5)
+    # OpenAI scales images down to fit 2048x2048 and then to 768px on the
+    # shorter side before tiling them, so anything bigger is wasted bytes.
+    # https://platform.openai.com/docs/guides/vision#calculating-costs
+    openai_image_size = dict(image_max_long_side=2048, image_max_short_side=768)
+    gpt_4_turbo = Model('gpt-4-turbo', openai_api, 128000, 4096, supports_vision=True,
+        input_token_price=10, output_token_price=30,
+        **openai_image_size)
     # This snapshot is currently (Aug 23, 2024) 1/2 the price of vanilla gpt-4o, with 16k vs 4k output tokens.
-    gpt_4o = Model('gpt-4o-2024-08-06', openai_api, 128000, 16384, supports_vision=True)
-    gpt_4o_mini = Model('gpt-4o-mini', openai_api, 128000, 16384, supports_vision=True)
-    o1_preview = Model('o1-preview', openai_api, 128000, 32768)
-    o1_mini = Model('o1-mini', openai_api, 128000, 65536)
+    gpt_4o = Model('gpt-4o-2024-08-06', openai_api, 128000, 16384, supports_vision=True,
+        input_token_price=2.5, output_token_price=10,
+        **openai_image_size)
+    gpt_4o_mini = Model('gpt-4o-mini', openai_api, 128000, 16384, supports_vision=True,
+        input_token_price=0.15, output_token_price=0.6,
+        **openai_image_size)
+    o1_preview = Model('o1-preview', openai_api, 128000, 32768,
+        input_token_price=15, output_token_price=60)
+    o1_mini = Model('o1-mini', openai_api, 128000, 65536,
+        input_token_price=3, output_token_price=12)
 
-if os.environ.get('GROQ_API_KEY', '').strip():
-    groq_api = GroqAPI()
-    mixtral_groq = Model('mixtral-8x7b-32768', groq_api, 32768)
-    llama3_8b_groq = Model('llama3-8b-8192', groq_api, 8192)
-    llama3_70b_groq = Model('llama3-70b-8192', groq_api, 8192)
+groq_api = configure_api(GroqAPI, 'Groq', 'GROQ_API_KEY')
+if groq_api is not None:
+    # Pricing: https://groq.com/pricing/
+    mixtral_groq = Model('mixtral-8x7b-32768', groq_api, 32768,
+        input_token_price=0.24, output_token_price=0.24)
+    llama3_8b_groq = Model('llama3-8b-8192', groq_api, 8192,
+        input_token_price=0.05, output_token_price=0.08)
+    llama3_70b_groq = Model('llama3-70b-8192', groq_api, 8192,
+        input_token_price=0.59, output_token_price=0.79)
 
-    llama3_8b_tool_use_groq = Model('llama3-groq-8b-8192-tool-use-preview', groq_api, 8192)
-    llama3_70b_tool_use_groq = Model('llama3-groq-70b-8192-tool-use-preview', groq_api, 8192)
+    llama3_8b_tool_use_groq = Model('llama3-groq-8b-8192-tool-use-preview', groq_api, 8192,
+        input_token_price=0.19, output_token_price=0.19)
+    llama3_70b_tool_use_groq = Model('llama3-groq-70b-8192-tool-use-preview', groq_api, 8192,
+        input_token_price=0.89, output_token_price=0.89)
 
     # Note (July '24): These are intrinsically 131072 input tokens, but limited during preview
     # https://console.groq.com/docs/models
-    llama_3_1_8b_groq = Model('llama-3.1-8b-instant', groq_api, 8000)
-    llama_3_1_70b_groq = Model('llama-3.1-70b-versatile', groq_api, 8000)
+    llama_3_1_8b_groq = Model('llama-3.1-8b-instant', groq_api, 8000,
+        input_token_price=0.05, output_token_price=0.08)
+    llama_3_1_70b_groq = Model('llama-3.1-70b-versatile', groq_api, 8000,
+        input_token_price=0.59, output_token_price=0.79)
     llama_3_1_405b_groq = Model('llama-3.1-405b-reasoning', groq_api, 16000)
 
-    llama_3_2_11b_vision_groq = Model('llama-3.2-11b-vision-preview', groq_api, 8000)
-    llama_3_2_90b_vision_groq = Model('llama-3.2-90b-vision-preview', groq_api, 8000)
+    llama_3_2_11b_vision_groq = Model('llama-3.2-11b-vision-preview', groq_api, 8000,
+        input_token_price=0.18, output_token_price=0.18,
+        image_max_long_side=1120)
+    llama_3_2_90b_vision_groq = Model('llama-3.2-90b-vision-preview', groq_api, 8000,
+        input_token_price=0.9, output_token_price=0.9,
+        image_max_long_side=1120)
 
-if os.environ.get('OLLAMA_CLIENT_HOST', '').strip():
+ollama_api = configure_api(OllamaAPI, 'Ollama', 'OLLAMA_CLIENT_HOST')
+if ollama_api is not None:
     # Ollama models have a default context window of 2048 (as of Aug 2024),
     # to save on GPU memory
     # https://youtu.be/QfFRNF5AhME?si=ysBMQQc1uiGWU9Da&t=154
     # but this can be adjusted:
     # https://github.com/ollama/ollama/blob/main/docs/faq.md#how-can-i-specify-the-context-window-size
-    ollama_api = OllamaAPI()
     # TODO: Download models if not available?
     # Should ask user if they want to -- perhaps do this with all models, along
     # with the disk space required.
     llama3_8b_ollama = Model('llama3', ollama_api, 8192)
-    llava_1_6 = Model('llava:latest', ollama_api, 2048, supports_vision=True)
-    llava_1_6_13b = Model('llava:13b', ollama_api, 2048, supports_vision=True)
+    # LLaVA 1.6 works at up to 672x672 (or 336x1344).
+    llava_1_6 = Model('llava:latest', ollama_api, 2048, supports_vision=True,
+        image_max_long_side=1344)
+    llava_1_6_13b = Model('llava:13b', ollama_api, 2048, supports_vision=True,
+        image_max_long_side=1344)
     # Context length below is guessed.
-    moondream = Model('moondream:1.8b-v2-fp16', ollama_api, 2048, supports_vision=True)
+    moondream = Model('moondream:1.8b-v2-fp16', ollama_api, 2048, supports_vision=True,
+        image_max_long_side=756)
 
-if os.environ.get('GOOGLE_API_KEY', '').strip():
-    google_api = GoogleAPI()
+google_api = configure_api(GoogleAPI, 'Google', 'GOOGLE_API_KEY')
+if google_api is not None:
+    # Gemini bills a flat number of tokens per image, so size only costs
+    # upload bytes. 1600px keeps small print on a letter page legible.
+    # With a 1M token context window, pages can be parsed several at a time.
+    # The batch size is bounded by the output token limit (8192) rather than
+    # the context window.
+    # Pricing (for prompts up to 128k tokens): https://ai.google.dev/pricing
     gemini_1_5_pro = Model('gemini-1.5-pro-latest', google_api, 1_048_576, 8192,
-        supports_vision=True)
+        supports_vision=True, image_max_long_side=1600,
+        page_batch_size=GEMINI_PAGE_BATCH_SIZE,
+        input_token_price=1.25, output_token_price=5)
     gemini_1_5_flash = Model('gemini-1.5-flash-latest', google_api, 1_048_576, 8192,
-        supports_vision=True)
+        supports_vision=True, image_max_long_side=1600,
+        page_batch_size=GEMINI_PAGE_BATCH_SIZE,
+        input_token_price=0.075, output_token_price=0.3)
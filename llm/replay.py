@@ -0,0 +1,430 @@
+"""Record/replay backends for LLMs and embeddings.
+
+Lets the ingest pipeline run (e.g. for benchmarks and regression tests)
+without the LLM providers or Ollama. In record mode, real responses (prompt
+responses and embedding vectors) are captured into a FixtureStore. In replay
+mode they are served back from it, deterministically, after a configurable
+synthetic latency.
+
+Modes are selected with environment variables:
+
+    LLM_BACKEND_MODE=live|record|replay        (see llm.models)
+    EMBEDDING_BACKEND_MODE=live|record|replay  (see db.models.calculate_embeddings)
+
+Replay latency is configured with REPLAY_LATENCY_MS, either a number of
+milliseconds or "recorded" to wait as long as the recorded call took, plus up
+to REPLAY_LATENCY_JITTER_MS more. The jitter is derived from the request, so
+is the same on every run.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from .apis import BaseAPI, LLMAPIException
+
+
+BACKEND_MODES = {'live', 'record', 'replay'}
+
+FIXTURES_DIR = os.environ.get(
+    'REPLAY_FIXTURES_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'replay')
+)
+
+REPLAY_LATENCY_MS = os.environ.get('REPLAY_LATENCY_MS', '0').strip().lower()
+REPLAY_LATENCY_JITTER_MS = float(os.environ.get('REPLAY_LATENCY_JITTER_MS', 0))
+
+# Replayed streams are split into chunks of this many characters.
+REPLAY_CHUNK_SIZE = 16
+
+
+def get_backend_mode(variable):
+    """Return the backend mode ('live', 'record' or 'replay') set in an environment variable.
+
+    Raises:
+        ValueError: If the variable holds anything else.
+    """
+    mode = os.environ.get(variable, 'live').strip().lower() or 'live'
+    if mode not in BACKEND_MODES:
+        raise ValueError(f'{variable} must be one of {sorted(BACKEND_MODES)}, not "{mode}".')
+
+    return mode
+
+
+class FixtureStore():
+    """Recorded responses, stored as one JSON file per request. Thread-safe.
+
+    Files are named after a hash of the request (see make_key), in a folder per
+    kind of request (e.g. 'prompt', 'embedding').
+    """
+    def __init__(self, path=FIXTURES_DIR):
+        self.path = path
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """Return a key for a request, from the parts (JSON-serializable) that identify it."""
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _get_path(self, kind, key):
+        return os.path.join(self.path, kind, f'{key}.json')
+
+    def get(self, kind, key):
+        """Return the fixture (a dictionary) recorded for a request, or None."""
+        with self._lock:
+            if (kind, key) in self._cache:
+                return self._cache[(kind, key)]
+
+        try:
+            with open(self._get_path(kind, key)) as f:
+                fixture = json.load(f)
+
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._cache[(kind, key)] = fixture
+
+        return fixture
+
+    def put(self, kind, key, fixture):
+        """Record a fixture (a JSON-serializable dictionary) for a request."""
+        path = self._get_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename, so readers never see a partial file.
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(fixture, f)
+
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._cache[(kind, key)] = fixture
+
+    def list(self, kind):
+        """Return all fixtures of a kind."""
+        folder = os.path.join(self.path, kind)
+        if not os.path.isdir(folder):
+            return []
+
+        fixtures = []
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith('.json'):
+                fixture = self.get(kind, filename[:-len('.json')])
+                if fixture is not None:
+                    fixtures.append(fixture)
+
+        return fixtures
+
+
+def get_replay_latency(key, recorded_latency=None, latency_ms=None):
+    """Return the synthetic latency (seconds) for replaying a request.
+
+    See the module docstring for configuration. latency_ms, if given,
+    overrides REPLAY_LATENCY_MS (e.g. to replay LLMs and embeddings at
+    different speeds).
+    """
+    latency_ms = REPLAY_LATENCY_MS if latency_ms is None else str(latency_ms)
+    if latency_ms == 'recorded':
+        latency = recorded_latency or 0.0
+
+    else:
+        latency = float(latency_ms) / 1000
+
+    if REPLAY_LATENCY_JITTER_MS:
+        # Deterministic per request: the key is a hex digest.
+        fraction = int(key[:8], 16) / 0xFFFFFFFF
+        latency += fraction * REPLAY_LATENCY_JITTER_MS / 1000
+
+    return latency
+
+
+def synthetic_embedding(text, dimensions=768):
+    """Return a deterministic, unit length pseudo-random embedding for text.
+
+    For stand-in backends (e.g. benchmarks) where no recording exists. Equal
+    texts get equal vectors, and different ones unrelated vectors.
+    """
+    seed = int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+
+    return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+
+class ReplayAPI(BaseAPI):
+    """Records or replays an LLM API's responses. See the module docstring.
+
+    In record mode, calls go to the wrapped API and its responses are saved.
+    In replay mode, responses are served from the store, and requests with no
+    recording raise an LLMAPIException, or get a response from fallback if
+    one is given.
+    """
+    def __init__(self, name, mode='replay', store=None, wrapped=None, fallback=None, latency_ms=None):
+        """
+        Args:
+            name: str - The name of the API stood in for (e.g. 'Google'), so
+                rate limits, metrics etc. apply as for the real thing.
+            mode: str - Optional. 'record' or 'replay'. Default 'replay'.
+            store: FixtureStore - Optional. Default: one at FIXTURES_DIR.
+            wrapped: BaseAPI - The real API. Required to record.
+            fallback: callable - Optional. Takes the request (a dictionary of
+                run_prompt's arguments) and returns a response (str), for
+                requests with no recording.
+            latency_ms: float or str - Optional. Replay latency, in place of
+                REPLAY_LATENCY_MS.
+        """
+        if mode == 'record' and wrapped is None:
+            raise ValueError('Recording needs an API to record.')
+
+        self.name = name
+        self.mode = mode
+        self.store = store or FixtureStore()
+        self.wrapped = wrapped
+        self.fallback = fallback
+        self.latency_ms = latency_ms
+
+    @property
+    def available(self):
+        return True
+
+    def list_models(self):
+        if self.mode == 'record':
+            return self.wrapped.list_models()
+
+        return {
+            fixture['request']['model_name'] for fixture in self.store.list('prompt')
+            if fixture['api'] == self.name
+        }
+
+    def count_tokens_locally(self, string, model_name):
+        if self.wrapped is not None:
+            return self.wrapped.count_tokens_locally(string, model_name)
+
+        return None
+
+    def _describe_request(self, model_name, user_prompt, images, system_prompt, messages, response_format):
+        """Return the parts of a request that identify it, as a dictionary."""
+        return {
+            'model_name': model_name,
+            'user_prompt': user_prompt,
+            # Images are sent normalized (see Model.prepare_image), so the same
+            # source image always hashes the same.
+            'images': [image.content_hash() for image in images or []],
+            'system_prompt': system_prompt,
+            'messages': [
+                {
+                    'sender': message.sender,
+                    'text': message.text,
+                    'images': [image.content_hash() for image in message.images or []]
+                }
+                for message in messages or []
+            ],
+            'response_format': response_format,
+        }
+
+    def _get_recording(self, key, request):
+        """Return the recorded response and latency for a request (replay mode)."""
+        fixture = self.store.get('prompt', key)
+        if fixture is not None:
+            return fixture['response'], fixture.get('latency')
+
+        if self.fallback is not None:
+            return self.fallback(request), None
+
+        raise LLMAPIException(
+            f'No recorded {self.name} response for this {request["model_name"]} request ({key}).'
+        )
+
+    def _save_recording(self, key, request, response, latency):
+        self.store.put('prompt', key, {
+            'api': self.name,
+            'request': request,
+            'response': response,
+            'latency': latency,
+        })
+
+    @staticmethod
+    def _split_chunks(response):
+        return [
+            response[i:i + REPLAY_CHUNK_SIZE] for i in range(0, len(response), REPLAY_CHUNK_SIZE)
+        ]
+
+    def _replay_stream(self, key, request):
+        response, recorded_latency = self._get_recording(key, request)
+        time.sleep(get_replay_latency(key, recorded_latency, self.latency_ms))
+
+        yield from self._split_chunks(response)
+
+    def _record_stream(self, key, request, chunks):
+        start_time = time.monotonic()
+        all_chunks = []
+        for chunk in chunks:
+            all_chunks.append(chunk)
+            yield chunk
+
+        # Only complete responses are recorded.
+        self._save_recording(key, request, ''.join(all_chunks), time.monotonic() - start_time)
+
+    def run_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+        request = self._describe_request(model_name, user_prompt, images, system_prompt, messages, response_format)
+        key = FixtureStore.make_key(self.name, request)
+
+        if self.mode == 'replay':
+            if stream:
+                return self._replay_stream(key, request)
+
+            response, recorded_latency = self._get_recording(key, request)
+            time.sleep(get_replay_latency(key, recorded_latency, self.latency_ms))
+            return response
+
+        start_time = time.monotonic()
+        response = self.wrapped.run_prompt(
+            model_name, user_prompt, images=images, system_prompt=system_prompt,
+            messages=messages, stream=stream, max_tokens=max_tokens,
+            response_format=response_format, temperature=temperature
+        )
+        if stream:
+            return self._record_stream(key, request, response)
+
+        self._save_recording(key, request, response, time.monotonic() - start_time)
+        return response
+
+    async def _areplay_stream(self, key, request):
+        response, recorded_latency = self._get_recording(key, request)
+        await asyncio.sleep(get_replay_latency(key, recorded_latency, self.latency_ms))
+
+        for chunk in self._split_chunks(response):
+            yield chunk
+
+    async def _arecord_stream(self, key, request, chunks):
+        start_time = time.monotonic()
+        all_chunks = []
+        try:
+            async for chunk in chunks:
+                all_chunks.append(chunk)
+                yield chunk
+
+        finally:
+            await chunks.aclose()
+
+        await asyncio.to_thread(
+            self._save_recording, key, request, ''.join(all_chunks), time.monotonic() - start_time
+        )
+
+    async def arun_prompt(self, model_name, user_prompt, images=None, system_prompt=None, messages=None, stream=False, max_tokens=500, response_format="text", temperature=0.0):
+        """Async version of run_prompt."""
+        request = self._describe_request(model_name, user_prompt, images, system_prompt, messages, response_format)
+        key = FixtureStore.make_key(self.name, request)
+
+        if self.mode == 'replay':
+            if stream:
+                return self._areplay_stream(key, request)
+
+            response, recorded_latency = await asyncio.to_thread(self._get_recording, key, request)
+            await asyncio.sleep(get_replay_latency(key, recorded_latency, self.latency_ms))
+            return response
+
+        start_time = time.monotonic()
+        response = await self.wrapped.arun_prompt(
+            model_name, user_prompt, images=images, system_prompt=system_prompt,
+            messages=messages, stream=stream, max_tokens=max_tokens,
+            response_format=response_format, temperature=temperature
+        )
+        if stream:
+            return self._arecord_stream(key, request, response)
+
+        await asyncio.to_thread(
+            self._save_recording, key, request, response, time.monotonic() - start_time
+        )
+        return response
+
+
+class ReplayEmbeddings():
+    """Records or replays an embedding backend's vectors. See the module docstring.
+
+    Example:
+        embeddings = ReplayEmbeddings('nomic-embed-text', 'record', embed=live_embed)
+        vector = embeddings.embed('Some text')
+        vectors = embeddings.embed_many(['Some text', 'Some more text'])
+    """
+    def __init__(self, model_name, mode='replay', store=None, embed=None, fallback=None, latency_ms=None):
+        """
+        Args:
+            model_name: str - The embedding model's name.
+            mode: str - Optional. 'record' or 'replay'. Default 'replay'.
+            store: FixtureStore - Optional. Default: one at FIXTURES_DIR.
+            embed: callable - Takes a list of texts and returns their
+                embeddings from the real backend, in one request. Required to
+                record.
+            fallback: callable - Optional. Takes text and returns an embedding
+                (e.g. synthetic_embedding), for texts with no recording.
+            latency_ms: float or str - Optional. Replay latency, in place of
+                REPLAY_LATENCY_MS.
+        """
+        if mode == 'record' and embed is None:
+            raise ValueError('Recording needs an embedding function to record.')
+
+        self.model_name = model_name
+        self.mode = mode
+        self.store = store or FixtureStore()
+        self._embed = embed
+        self.fallback = fallback
+        self.latency_ms = latency_ms
+
+    def embed(self, text):
+        """Return text's embedding (list of float). See embed_many."""
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts):
+        """Return the embeddings (list of float) of texts, as one round trip.
+
+        Raises:
+            LookupError: In replay mode, if there's no recording for a text
+                and no fallback.
+        """
+        if not texts:
+            return []
+
+        keys = [FixtureStore.make_key(self.model_name, text) for text in texts]
+
+        if self.mode == 'replay':
+            vectors, recorded_latencies = [], []
+            for key, text in zip(keys, texts):
+                fixture = self.store.get('embedding', key)
+                if fixture is not None:
+                    vectors.append(fixture['response'])
+                    recorded_latencies.append(fixture.get('latency') or 0.0)
+
+                elif self.fallback is not None:
+                    vectors.append(self.fallback(text))
+
+                else:
+                    raise LookupError(f'No recorded {self.model_name} embedding ({key}).')
+
+            # A batch is a single request, which takes as long as its slowest
+            # recorded one.
+            time.sleep(get_replay_latency(keys[0], max(recorded_latencies, default=None), self.latency_ms))
+            return vectors
+
+        start_time = time.monotonic()
+        vectors = self._embed(texts)
+        latency = time.monotonic() - start_time
+
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is not None:
+                self.store.put('embedding', key, {
+                    'model_name': self.model_name,
+                    'text': text,
+                    'response': [float(value) for value in vector],
+                    'latency': latency,
+                })
+
+        return vectors
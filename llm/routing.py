@@ -0,0 +1,600 @@
+"""Routing of prompts across several models, with hedging and failover.
+
+A ModelRouter stands in for a Model (e.g. as an Assistant's model) and sends
+each prompt to the first of an ordered list of models. If that model hasn't
+responded by the time most of its responses have (a latency percentile), a
+hedged duplicate request is sent to the next model, and whichever valid
+response comes first is used. Errors and invalid responses fail over to the
+next model straight away.
+
+Latencies are kept per model, and per number of images sent (a multi-page
+request takes far longer than a single page), in histograms (see
+latency_histograms), which set the hedging delays.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import CancelledError, FIRST_COMPLETED, ThreadPoolExecutor, wait
+import math
+import os
+import threading
+import time
+
+from .json_stream import JSONStreamError
+
+
+# Percentile of a model's latency after which a hedged request is sent.
+HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95))
+# Hedging delay (seconds) used until a model has HEDGE_MIN_SAMPLES latencies
+# recorded.
+HEDGE_DEFAULT_DELAY = float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY_SECONDS', 30))
+HEDGE_MIN_SAMPLES = 20
+# Maximum number of requests in flight (the original plus hedges) per prompt.
+MAX_REQUESTS_IN_FLIGHT = int(os.environ.get('LLM_MAX_REQUESTS_IN_FLIGHT', 2))
+
+# The model whose response was used for the last prompt routed in the current
+# context (thread or task), e.g. to record which model a result came from.
+routed_model = contextvars.ContextVar('routed_model', default=None)
+
+# Threads for sync routed requests, which each wait on one request.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('LLM_ROUTER_THREADS', 32)),
+    thread_name_prefix='model-router'
+)
+
+
+class LatencyHistogram():
+    """Histogram of request latencies, in exponentially sized buckets. Thread-safe.
+
+    Buckets grow by GROWTH_FACTOR from MIN_LATENCY (seconds), so percentiles
+    are accurate to within that factor however long requests take.
+    """
+    MIN_LATENCY = 0.05
+    GROWTH_FACTOR = 1.25
+    NUM_BUCKETS = 48  # Up to ~2 hours.
+
+    def __init__(self):
+        self.bucket_bounds = [
+            self.MIN_LATENCY * self.GROWTH_FACTOR ** i for i in range(self.NUM_BUCKETS)
+        ]
+        self.counts = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """Record a successful request's latency (seconds)."""
+        index = 0
+        if latency > self.MIN_LATENCY:
+            index = min(
+                self.NUM_BUCKETS - 1,
+                math.ceil(math.log(latency / self.MIN_LATENCY, self.GROWTH_FACTOR))
+            )
+
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += latency
+
+    def record_error(self):
+        """Record a failed request."""
+        with self._lock:
+            self.errors += 1
+
+    def percentile(self, percentile):
+        """Return (the upper bound of) the given latency percentile, or None if empty.
+
+        Args:
+            percentile: float - Between 0 and 100.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+
+            target = self.count * percentile / 100
+            cumulative = 0
+            for bound, count in zip(self.bucket_bounds, self.counts):
+                cumulative += count
+                if cumulative >= target:
+                    return bound
+
+            return self.bucket_bounds[-1]
+
+    def snapshot(self):
+        """Return the histogram's counts and summary statistics as a dictionary."""
+        with self._lock:
+            snapshot = {
+                'count': self.count,
+                'errors': self.errors,
+                'mean': self.total / self.count if self.count else None,
+                'buckets': [
+                    (bound, count)
+                    for bound, count in zip(self.bucket_bounds, self.counts) if count
+                ],
+            }
+
+        for percentile in (50, 90, 95, 99):
+            snapshot[f'p{percentile}'] = self.percentile(percentile)
+
+        return snapshot
+
+
+class LatencyHistograms():
+    """Latency histograms per model, request kind and number of images, shared across routers."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name, kind, num_images=0):
+        """Return the histogram for a model and kind of request.
+
+        Args:
+            model_name: str - The model's name.
+            kind: str - 'response' (time to a full response) or 'first_chunk'
+                (time to the first chunk of a streamed response).
+            num_images: int - Optional. The number of images sent with the
+                request. Default 0.
+        """
+        key = (model_name, kind, num_images)
+        with self._lock:
+            return self._histograms.setdefault(key, LatencyHistogram())
+
+    def snapshot(self):
+        """Return snapshots of all histograms, keyed on 'model/kind/num_images'."""
+        with self._lock:
+            histograms = dict(self._histograms)
+
+        return {
+            f'{model_name}/{kind}/{num_images}': histogram.snapshot()
+            for (model_name, kind, num_images), histogram in histograms.items()
+        }
+
+
+latency_histograms = LatencyHistograms()
+
+
+class ModelRouter():
+    """Routes prompts across an ordered list of models. Can be used in place of a Model.
+
+    Example:
+        router = ModelRouter([models.gemini_1_5_pro, models.gpt_4o_mini])
+        assistant = Assistant(name="Parser", model=router)
+
+    The model whose response was used is set in routed_model.
+
+    Each model is only sent prompts it can take: max_tokens is capped at its
+    output token limit, and models that take fewer images per request than a
+    prompt has (see Model.page_batch_size) are skipped.
+
+    Streamed prompts are hedged/failed over until the first chunk arrives,
+    after which the stream is committed to. The validator isn't applied to
+    them, as they're only complete once the caller has read them. Given a
+    stream_validator though, streams are read (and validated) in full by the
+    router, so that one going wrong fails over at its first invalid chunk.
+    """
+    def __init__(self, models, validator=None, stream_validator=None,
+            hedge_percentile=HEDGE_PERCENTILE,
+            max_requests_in_flight=MAX_REQUESTS_IN_FLIGHT):
+        """
+        Args:
+            models: list of Model - Models in order of preference.
+            validator: callable - Optional. Takes a response and raises an
+                exception if it isn't valid, in which case the next model is
+                tried.
+            stream_validator: callable - Optional. Returns a new incremental
+                validator (e.g. llm.json_stream.IncrementalJSONValidator) for
+                a streamed response. If given, streamed responses are fed to
+                it as they arrive, and abandoned (failing over, or leaving it
+                to a hedged request) as soon as it raises. They're then
+                checked with validator, and returned as a single chunk.
+            hedge_percentile: float - Optional. Percentile (0-100) of a model's
+                latency after which a hedged request is sent to the next
+                model.
+            max_requests_in_flight: int - Optional. Maximum number of requests
+                sent at once for a prompt. 1 disables hedging (but not
+                failover).
+        """
+        if not models:
+            raise ValueError('A ModelRouter needs at least one model.')
+
+        self.models = list(models)
+        self.validator = validator
+        self.stream_validator = stream_validator
+        self.hedge_percentile = hedge_percentile
+        self.max_requests_in_flight = max(1, max_requests_in_flight)
+
+    @property
+    def name(self):
+        return ','.join(model.name for model in self.models)
+
+    @property
+    def api(self):
+        return self.models[0].api
+
+    @property
+    def supports_vision(self):
+        return self.models[0].supports_vision
+
+    @property
+    def supports_json_mode(self):
+        return self.models[0].supports_json_mode
+
+    @property
+    def input_token_limit(self):
+        return min(model.input_token_limit for model in self.models)
+
+    @property
+    def output_token_limit(self):
+        # max_tokens is capped per model (see _call).
+        return max(model.output_token_limit for model in self.models)
+
+    @property
+    def page_batch_size(self):
+        # Models that take fewer pages are skipped for larger batches (see
+        # _get_models).
+        return self.models[0].page_batch_size
+
+    @property
+    def available(self):
+        return any(model.available for model in self.models)
+
+    def hedge_delay(self, model, kind, num_images=0):
+        """Return how long to wait for model before hedging, in seconds."""
+        histogram = latency_histograms.get(model.name, kind, num_images)
+        if histogram.count < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+
+        return histogram.percentile(self.hedge_percentile)
+
+    def _get_models(self, prompt_args):
+        """Return the models that can take a prompt, in order of preference."""
+        num_images = _count_images(prompt_args)
+        models = [
+            model for model in self.models
+            if num_images <= max(1, model.page_batch_size)
+        ]
+        if not models:
+            raise ValueError(f'None of {self.name} take {num_images} images per request.')
+
+        return models
+
+    def _call(self, model, kind, request, **prompt_args):
+        """Send a prompt to a model, timing it and validating the response."""
+        histogram = latency_histograms.get(model.name, kind, _count_images(prompt_args))
+        prompt_args['max_tokens'] = min(prompt_args['max_tokens'], model.output_token_limit)
+        start_time = time.monotonic()
+        try:
+            response = request(model, **prompt_args)
+            if kind == 'response' and self.validator is not None:
+                self.validator(response)
+
+        except CancelledError:
+            raise
+
+        except Exception:
+            histogram.record_error()
+            raise
+
+        histogram.record(time.monotonic() - start_time)
+        return response
+
+    async def _acall(self, model, kind, request, **prompt_args):
+        """Async version of _call."""
+        histogram = latency_histograms.get(model.name, kind, _count_images(prompt_args))
+        prompt_args['max_tokens'] = min(prompt_args['max_tokens'], model.output_token_limit)
+        start_time = time.monotonic()
+        try:
+            response = await request(model, **prompt_args)
+            if kind == 'response' and self.validator is not None:
+                self.validator(response)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            histogram.record_error()
+            raise
+
+        histogram.record(time.monotonic() - start_time)
+        return response
+
+    def _race(self, kind, request, discard=None, **prompt_args):
+        """Send a prompt to models in turn, hedging and failing over, until one succeeds.
+
+        Args:
+            kind: str - See LatencyHistograms.get.
+            request: callable - Takes a model and prompt_args, and returns the
+                response.
+            discard: callable - Optional. Called with the responses of
+                requests that lose the race, e.g. to close them.
+
+        Returns:
+            The first successful response.
+
+        Raises:
+            Exception: The last model's error if all of them failed.
+        """
+        remaining_models = self._get_models(prompt_args)
+        in_flight = {}
+        last_error = None
+
+        def start_next():
+            model = remaining_models.pop(0)
+            future = _executor.submit(self._call, model, kind, request, **prompt_args)
+            in_flight[future] = model
+
+        start_next()
+        while in_flight:
+            timeout = None
+            if remaining_models and len(in_flight) < self.max_requests_in_flight:
+                latest_model = list(in_flight.values())[-1]
+                timeout = self.hedge_delay(latest_model, kind, _count_images(prompt_args))
+
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                print(f'{latest_model.name} is slow to respond. Hedging with {remaining_models[0].name}.')
+                start_next()
+                continue
+
+            for future in done:
+                model = in_flight.pop(future)
+                if future.exception() is None:
+                    # Threads can't be stopped, so losers already running
+                    # are discarded once they finish.
+                    for loser in in_flight:
+                        loser.cancel()
+                        if discard is not None:
+                            loser.add_done_callback(
+                                lambda f: not f.cancelled() and f.exception() is None
+                                    and discard(f.result())
+                            )
+
+                    routed_model.set(model)
+                    return future.result()
+
+                last_error = future.exception()
+                print(f'{model.name} failed ({type(last_error).__name__}: {last_error}).')
+
+            while remaining_models and len(in_flight) < self.max_requests_in_flight:
+                start_next()
+
+        raise last_error
+
+    async def _arace(self, kind, request, discard=None, **prompt_args):
+        """Async version of _race.
+
+        Args:
+            request: callable - Takes a model and prompt_args, and returns an
+                awaitable of the response.
+            discard: callable - Optional. Returns an awaitable, e.g. that
+                closes the response.
+            See _race for the rest.
+        """
+        remaining_models = self._get_models(prompt_args)
+        in_flight = {}
+        last_error = None
+
+        def start_next():
+            model = remaining_models.pop(0)
+            task = asyncio.create_task(self._acall(model, kind, request, **prompt_args))
+            in_flight[task] = model
+
+        start_next()
+        try:
+            while in_flight:
+                timeout = None
+                if remaining_models and len(in_flight) < self.max_requests_in_flight:
+                    latest_model = list(in_flight.values())[-1]
+                    timeout = self.hedge_delay(latest_model, kind, _count_images(prompt_args))
+
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    print(f'{latest_model.name} is slow to respond. Hedging with {remaining_models[0].name}.')
+                    start_next()
+                    continue
+
+                winner = None
+                for task in done:
+                    model = in_flight.pop(task)
+                    if task.exception() is None:
+                        if winner is None:
+                            winner = task
+                            routed_model.set(model)
+
+                        elif discard is not None:
+                            await discard(task.result())
+
+                        continue
+
+                    last_error = task.exception()
+                    print(f'{model.name} failed ({type(last_error).__name__}: {last_error}).')
+
+                if winner is not None:
+                    return winner.result()
+
+                while remaining_models and len(in_flight) < self.max_requests_in_flight:
+                    start_next()
+
+            raise last_error
+
+        finally:
+            # Stop the losers, discarding any that finished in the meantime.
+            for task in in_flight:
+                if not task.done():
+                    task.cancel()
+
+                elif discard is not None and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    def run_prompt(self, user_prompt, images=None, system_prompt=None,
+            messages=None, stream=False, response_format="text",
+            temperature=0.0, max_tokens=500):
+        """Route a prompt. See Model.run_prompt."""
+        prompt_args = dict(
+            user_prompt=user_prompt,
+            images=images,
+            system_prompt=system_prompt,
+            messages=messages,
+            response_format=response_format,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+
+        if not stream:
+            return self._race(
+                'response',
+                lambda model, **kwargs: model.run_prompt(stream=False, **kwargs),
+                **prompt_args
+            )
+
+        if self.stream_validator is not None:
+            # Lets losing streams, which can't be cancelled in their threads,
+            # stop reading.
+            race_over = threading.Event()
+
+            def read_stream(model, **kwargs):
+                validator = self.stream_validator()
+                chunks = []
+                response = model.run_prompt(stream=True, **kwargs)
+                try:
+                    for chunk in response:
+                        if race_over.is_set():
+                            raise CancelledError()
+
+                        chunks.append(chunk)
+                        validator.feed(chunk)
+
+                    validator.finish()
+
+                except JSONStreamError as e:
+                    e.response = ''.join(chunks)
+                    raise
+
+                finally:
+                    response.close()
+
+                return ''.join(chunks)
+
+            try:
+                return _yield_response(self._race('response', read_stream, **prompt_args))
+
+            finally:
+                race_over.set()
+
+        def open_stream(model, **kwargs):
+            chunks = model.run_prompt(stream=True, **kwargs)
+            try:
+                return next(chunks), chunks
+
+            except StopIteration:
+                return None, chunks
+
+        first_chunk, chunks = self._race(
+            'first_chunk',
+            open_stream,
+            discard=lambda response: response[1].close(),
+            **prompt_args
+        )
+
+        return _prepend_chunk(first_chunk, chunks)
+
+    async def arun_prompt(self, user_prompt, images=None, system_prompt=None,
+            messages=None, stream=False, response_format="text",
+            temperature=0.0, max_tokens=500):
+        """Async version of run_prompt."""
+        prompt_args = dict(
+            user_prompt=user_prompt,
+            images=images,
+            system_prompt=system_prompt,
+            messages=messages,
+            response_format=response_format,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+
+        if not stream:
+            return await self._arace(
+                'response',
+                lambda model, **kwargs: model.arun_prompt(stream=False, **kwargs),
+                **prompt_args
+            )
+
+        if self.stream_validator is not None:
+            async def read_stream(model, **kwargs):
+                validator = self.stream_validator()
+                chunks = []
+                response = await model.arun_prompt(stream=True, **kwargs)
+                try:
+                    async for chunk in response:
+                        chunks.append(chunk)
+                        validator.feed(chunk)
+
+                    validator.finish()
+
+                except JSONStreamError as e:
+                    e.response = ''.join(chunks)
+                    raise
+
+                finally:
+                    await response.aclose()
+
+                return ''.join(chunks)
+
+            return _ayield_response(await self._arace('response', read_stream, **prompt_args))
+
+        async def open_stream(model, **kwargs):
+            chunks = await model.arun_prompt(stream=True, **kwargs)
+            try:
+                return await anext(chunks), chunks
+
+            except StopAsyncIteration:
+                return None, chunks
+
+            except asyncio.CancelledError:
+                await chunks.aclose()
+                raise
+
+        first_chunk, chunks = await self._arace(
+            'first_chunk',
+            open_stream,
+            discard=lambda response: response[1].aclose(),
+            **prompt_args
+        )
+
+        return _aprepend_chunk(first_chunk, chunks)
+
+
+def _count_images(prompt_args):
+    return len(prompt_args.get('images') or [])
+
+
+def _yield_response(response):
+    yield response
+
+
+async def _ayield_response(response):
+    yield response
+
+
+def _prepend_chunk(first_chunk, chunks):
+    try:
+        if first_chunk is not None:
+            yield first_chunk
+
+        yield from chunks
+
+    finally:
+        chunks.close()
+
+
+async def _aprepend_chunk(first_chunk, chunks):
+    try:
+        if first_chunk is not None:
+            yield first_chunk
+
+        async for chunk in chunks:
+            yield chunk
+
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,424 @@
+"""Rate-limit-aware scheduling of requests to LLM providers.
+
+Every request made by an API class (see llm.apis.BaseAPI) goes through the
+shared scheduler below, which:
+
+1. Paces requests to stay under each provider/model's requests per minute
+   (RPM) and tokens per minute (TPM) limits, using token buckets.
+2. Retries rate limited (429) and transient (5xx, connection) errors with
+   jittered exponential backoff, honouring any Retry-After the provider sends.
+3. Keeps count of how many requests are waiting, retried, etc.
+
+Limits are configured with the LLM_RATE_LIMITS environment variable, holding
+semicolon-separated entries of the form provider[/model]=rpm,tpm e.g.
+
+    LLM_RATE_LIMITS="google=360,4000000;openai/gpt-4o-mini=500,200000"
+
+A model's own entry takes precedence over its provider's. Either limit can be
+left empty (e.g. "ollama=60,") for none. Requests to providers/models without
+an entry are not paced, but are still retried.
+"""
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import random
+import threading
+import time
+
+
+class TokenBucket():
+    """A token bucket. Thread-safe.
+
+    Holds up to `capacity` tokens, refilled at `capacity` per `period` seconds.
+    Callers reserve tokens and are told how long to wait before going ahead,
+    so waits are fair (first come, first served) and don't need polling.
+    """
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.refill_rate = capacity / period
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount tokens from the bucket, going into debt if need be.
+
+        Args:
+            amount: float - The number of tokens to take. Capped at the
+                bucket's capacity, so oversized requests don't wait forever.
+
+        Returns:
+            float: Seconds to wait before going ahead, i.e. until the debt has
+                been paid off. 0 if there were enough tokens.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate
+            )
+            self.last_refill = now
+            self.tokens -= min(amount, self.capacity)
+
+            return max(0.0, -self.tokens / self.refill_rate)
+
+
+def parse_rate_limits(spec):
+    """Parse a rate limits spec string (see module docstring) into a dictionary.
+
+    Args:
+        spec: str - e.g. "google=360,4000000;openai/gpt-4o-mini=500,200000"
+
+    Returns:
+        dict of str -> (int or None, int or None): Lowercased provider or
+            provider/model keys mapped to their (RPM, TPM) limits.
+
+    Raises:
+        ValueError: If the spec is malformed.
+    """
+    limits = {}
+    for entry in spec.split(';'):
+        if not entry.strip():
+            continue
+
+        key, _, values = entry.partition('=')
+        rpm, _, tpm = values.partition(',')
+        if not key.strip() or not values.strip():
+            raise ValueError(f'Malformed rate limit: "{entry}". Expected provider[/model]=rpm,tpm.')
+
+        limits[key.strip().lower()] = (
+            int(rpm) if rpm.strip() else None,
+            int(tpm) if tpm.strip() else None,
+        )
+
+    return limits
+
+
+class RequestScheduler():
+    """Paces and retries requests to LLM providers. Shared across threads.
+
+    Example:
+        response = scheduler.run(
+            'OpenAI', 'gpt-4o-mini', lambda: client.chat.completions.create(...),
+            estimated_tokens=1500, classify_error=api.classify_error
+        )
+    """
+    def __init__(self, limits=None, max_retries=5, base_delay=1.0, max_delay=60.0):
+        """
+        Args:
+            limits: dict - Optional. See parse_rate_limits.
+            max_retries: int - Optional. Times to retry a failed request.
+                Default 5.
+            base_delay: float - Optional. Backoff (in seconds) before the first
+                retry. Doubles with every retry. Default 1.
+            max_delay: float - Optional. Cap on the backoff. Default 60.
+        """
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._waiting = defaultdict(int)
+        self._counters = defaultdict(lambda: defaultdict(float))
+
+    def _get_buckets(self, provider, model):
+        """Return the (RPM, TPM) buckets for a provider/model. Either may be None."""
+        for key in (f'{provider}/{model}'.lower(), provider.lower()):
+            if key in self.limits:
+                break
+        else:
+            return None, None
+
+        with self._lock:
+            if key not in self._buckets:
+                rpm, tpm = self.limits[key]
+                self._buckets[key] = (
+                    TokenBucket(rpm) if rpm else None,
+                    TokenBucket(tpm) if tpm else None,
+                )
+
+            return self._buckets[key]
+
+    def reserve(self, provider, model, estimated_tokens):
+        """Reserve capacity for a request.
+
+        Returns:
+            float: Seconds to wait before sending the request.
+        """
+        requests_bucket, tokens_bucket = self._get_buckets(provider, model)
+        delay = 0.0
+        if requests_bucket is not None:
+            delay = max(delay, requests_bucket.reserve(1))
+
+        if tokens_bucket is not None:
+            delay = max(delay, tokens_bucket.reserve(estimated_tokens))
+
+        return delay
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Return how long to wait before retry number attempt (1-based)."""
+        if retry_after is not None:
+            # A little jitter on top, so waiting requests don't all go at once.
+            return retry_after + random.uniform(0, self.base_delay)
+
+        # "Full jitter": https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    @contextmanager
+    def _waiting_on(self, key, delay):
+        """Count a caller as queued for the duration of the block."""
+        with self._lock:
+            self._waiting[key] += 1
+            self._counters[key]['wait_seconds'] += delay
+
+        try:
+            yield
+
+        finally:
+            with self._lock:
+                self._waiting[key] -= 1
+
+    def _wait(self, key, delay):
+        if delay > 0:
+            with self._waiting_on(key, delay):
+                time.sleep(delay)
+
+    async def _await(self, key, delay):
+        if delay > 0:
+            with self._waiting_on(key, delay):
+                await asyncio.sleep(delay)
+
+    def _count(self, key, counter, amount=1):
+        with self._lock:
+            self._counters[key][counter] += amount
+
+    def run(self, provider, model, request, estimated_tokens=0, classify_error=None):
+        """Send a request, paced to the provider/model's limits and retried on failure.
+
+        Args:
+            provider: str - The provider's (API's) name.
+            model: str - The model's name.
+            request: callable - Sends the request and returns the response.
+            estimated_tokens: int - Optional. Tokens the request is expected to
+                use (input and output), counted against the TPM limit.
+            classify_error: callable - Optional. Takes an exception raised by
+                request and returns a (retryable, retry_after) tuple, where
+                retry_after is in seconds or None. Nothing is retried if not
+                provided.
+
+        Returns:
+            The response returned by request.
+
+        Raises:
+            Exception: Whatever request raised, if it isn't retryable or retries
+                ran out.
+        """
+        key = f'{provider}/{model}'
+        attempt = 0
+        while True:
+            self._wait(key, self.reserve(provider, model, estimated_tokens))
+            self._count(key, 'requests')
+
+            try:
+                return request()
+
+            except Exception as e:
+                attempt += 1
+                retry_delay = self._get_retry_delay(key, e, attempt, classify_error)
+                if retry_delay is None:
+                    raise
+
+                self._wait(key, retry_delay)
+
+    def _get_retry_delay(self, key, error, attempt, classify_error):
+        """Return how long to wait before retrying a failed request, or None not to."""
+        retryable, retry_after = (
+            classify_error(error) if classify_error else (False, None)
+        )
+        if not retryable or attempt > self.max_retries:
+            self._count(key, 'failures')
+            return None
+
+        self._count(key, 'retries')
+        print(f'{key} request failed ({type(error).__name__}: {error}). Retry {attempt} of {self.max_retries}.')
+
+        return self.backoff_delay(attempt, retry_after)
+
+    def run_streaming(self, provider, model, request, estimated_tokens=0, classify_error=None):
+        """Like run, for streamed responses. Only retried until the first chunk arrives.
+
+        Args:
+            request: callable - Sends the request and returns a generator of
+                chunks.
+            See run for the rest.
+
+        Yields:
+            Chunks of the response.
+        """
+        chunks = self.run(
+            provider,
+            model,
+            lambda: _first_chunk_and_rest(request()),
+            estimated_tokens,
+            classify_error
+        )
+
+        yield from chunks
+
+    async def arun(self, provider, model, request, estimated_tokens=0, classify_error=None):
+        """Async version of run. Waits without blocking the event loop.
+
+        Args:
+            request: callable - Returns an awaitable that sends the request
+                and returns the response.
+            See run for the rest.
+
+        Returns:
+            The response returned by request.
+        """
+        key = f'{provider}/{model}'
+        attempt = 0
+        while True:
+            await self._await(key, self.reserve(provider, model, estimated_tokens))
+            self._count(key, 'requests')
+
+            try:
+                return await request()
+
+            except Exception as e:
+                attempt += 1
+                retry_delay = self._get_retry_delay(key, e, attempt, classify_error)
+                if retry_delay is None:
+                    raise
+
+                await self._await(key, retry_delay)
+
+    async def arun_streaming(self, provider, model, request, estimated_tokens=0, classify_error=None):
+        """Async version of run_streaming.
+
+        Args:
+            request: callable - Sends the request and returns an async
+                generator of chunks.
+            See run for the rest.
+
+        Yields:
+            Chunks of the response.
+        """
+        async def first_chunk_and_rest():
+            return await _afirst_chunk_and_rest(request())
+
+        chunks = await self.arun(provider, model, first_chunk_and_rest, estimated_tokens, classify_error)
+
+        try:
+            async for chunk in chunks:
+                yield chunk
+
+        finally:
+            await chunks.aclose()
+
+    def stats(self):
+        """Return queue depths and counters per provider/model.
+
+        Returns:
+            dict of str -> dict: 'provider/model' keys mapped to the number of
+                requests currently waiting (queue_depth), and totals of requests,
+                retries, failures and wait_seconds.
+        """
+        with self._lock:
+            return {
+                key: {'queue_depth': self._waiting.get(key, 0), **counters}
+                for key, counters in self._counters.items()
+            }
+
+
+def _first_chunk_and_rest(chunks):
+    """Pull the first chunk out of a stream now, so that errors surface eagerly.
+
+    Returns:
+        iterator - The whole stream, first chunk included. Closing it closes
+            the stream, even before it has been read from.
+    """
+    chunks = iter(chunks)
+    try:
+        first_chunk = next(chunks)
+
+    except StopIteration:
+        return _PrependedChunks([], chunks)
+
+    except BaseException:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+        raise
+
+    return _PrependedChunks([first_chunk], chunks)
+
+
+async def _afirst_chunk_and_rest(chunks):
+    """Async version of _first_chunk_and_rest."""
+    chunks = aiter(chunks)
+    try:
+        first_chunk = await anext(chunks)
+
+    except StopAsyncIteration:
+        return _APrependedChunks([], chunks)
+
+    except BaseException:
+        if hasattr(chunks, 'aclose'):
+            await chunks.aclose()
+
+        raise
+
+    return _APrependedChunks([first_chunk], chunks)
+
+
+class _PrependedChunks():
+    """A stream with the chunks already read from it put back in front."""
+
+    def __init__(self, read_chunks, chunks):
+        self._read_chunks = list(read_chunks)
+        self._chunks = chunks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._read_chunks:
+            return self._read_chunks.pop(0)
+
+        return next(self._chunks)
+
+    def close(self):
+        self._read_chunks = []
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
+
+class _APrependedChunks():
+    """Async version of _PrependedChunks."""
+
+    def __init__(self, read_chunks, chunks):
+        self._read_chunks = list(read_chunks)
+        self._chunks = chunks
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._read_chunks:
+            return self._read_chunks.pop(0)
+
+        return await anext(self._chunks)
+
+    async def aclose(self):
+        self._read_chunks = []
+        if hasattr(self._chunks, 'aclose'):
+            await self._chunks.aclose()
+
+
+scheduler = RequestScheduler(
+    parse_rate_limits(os.environ.get('LLM_RATE_LIMITS', '')),
+    max_retries=int(os.environ.get('LLM_MAX_RETRIES', 5)),
+)
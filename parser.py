@@ -1,19 +1,47 @@
+import asyncio
+import hashlib
 import json
+import os
+import threading
 from typing import Optional
 
+from asgiref.sync import sync_to_async
+from django.db.models import F
+from django.utils import timezone
 from pydantic import BaseModel, ValidationError
 
+from db.models import ParseCacheEntry
 from llm.assistants import Assistant
+from llm.json_stream import IncrementalJSONValidator, JSONStreamError
 from llm import models
+from llm.apis import OllamaAPI
+from llm.metrics import llm_metrics
+from llm.routing import ModelRouter, routed_model
 from utils import read_text_file
 
 MAX_PROMPT_RETRIES = 3
 
-page_image_parser = Assistant(
-    name="Page Image Parser",
-    model=models.gemini_1_5_pro,
-    system_template=read_text_file("prompts/page_parser.md"),
-)
+# Maximum number of parse results kept in the parse result cache. The least
+# recently used ones are evicted past this.
+PARSE_CACHE_MAX_ENTRIES = int(os.environ.get('PARSE_CACHE_MAX_ENTRIES', 50000))
+
+# Output tokens allowed per page when parsing pages in batches.
+BATCH_MAX_TOKENS_PER_PAGE = 1024
+
+# Whether to stream page parse responses, validating them as they arrive so
+# malformed ones are abandoned early instead of paid for in full. See
+# parse_page_image.
+PARSE_STREAMING = os.environ.get('PARSE_STREAMING', '1').strip().lower() in ('1', 'true', 'yes')
+
+# Vision models to parse pages with, in order of preference. Requests that are
+# slow or fail go to the next (see llm.routing). Models that aren't configured
+# (see llm.models) are skipped.
+PAGE_PARSER_MODELS = [
+    name.strip() for name in os.environ.get(
+        'PAGE_PARSER_MODELS',
+        'gemini-1.5-pro-latest,gemini-1.5-flash-latest,gpt-4o-mini,llava:latest'
+    ).split(',') if name.strip()
+]
 
 
 class ParserResponseModel(BaseModel):
@@ -23,56 +51,640 @@ class ParserResponseModel(BaseModel):
     requestNextPage: Optional[bool] = None
 
 
-def parse_page_image(page_image):
+def get_page_parser_models():
+    """Return the configured vision models among PAGE_PARSER_MODELS, in order.
+
+    Ollama models are only included if they've been pulled, as they aren't by
+    default (they're large, and only needed as a fallback).
+    """
+    page_parser_models = []
+    for name in PAGE_PARSER_MODELS:
+        model = models.get_model(name)
+        if model is None or not model.supports_vision:
+            print(f'Page parser model {name} is not a configured vision model. Skipping.')
+            continue
+
+        if isinstance(model.api, OllamaAPI) and not _is_model_pulled(model):
+            print(f'Page parser model {name} has not been pulled into Ollama. Skipping.')
+            continue
+
+        page_parser_models.append(model)
+
+    return page_parser_models
+
+
+def _is_model_pulled(model):
+    try:
+        return model.available
+
+    except Exception as e:
+        print(f'Error listing Ollama models: {e}')
+        return False
+
+
+# JSON types allowed for each of ParserResponseModel's fields, for validating
+# streamed responses before they're complete.
+PARSER_RESPONSE_FIELD_TYPES = {
+    'text': {'string', 'null'},
+    'summary': {'string', 'null'},
+    'description': {'string'},
+    'requestNextPage': {'boolean', 'null'},
+}
+
+
+def _validate_batch_response_format(response_json):
+    pages = json.loads(response_json).get('pages')
+    if not isinstance(pages, list):
+        raise ValueError('Batch parse response has no list of pages.')
+
+
+page_image_parser = Assistant(
+    name="Page Image Parser",
+    model=ModelRouter(
+        get_page_parser_models(),
+        validator=lambda response_json: ParserResponseModel(**json.loads(response_json)),
+        stream_validator=lambda: IncrementalJSONValidator(PARSER_RESPONSE_FIELD_TYPES)
+    ),
+    system_template=read_text_file("prompts/page_parser.md"),
+)
+
+# Parses several consecutive pages per request, on the page parser models that
+# support it (if any). See parse_page_images.
+page_batch_parser_models = [
+    model for model in page_image_parser.model.models if model.page_batch_size > 1
+]
+page_batch_parser = None
+if page_batch_parser_models:
+    page_batch_parser = Assistant(
+        name="Page Batch Parser",
+        model=ModelRouter(
+            page_batch_parser_models,
+            validator=_validate_batch_response_format
+        ),
+        system_template=read_text_file("prompts/page_batch_parser.md"),
+    )
+
+
+class ParseResultCache():
+    """Persistent cache of page parse results.
+
+    Results are keyed on the image's contents, the prompt (system and user),
+    the model and temperature, so a page image is only ever sent to a given
+    model with a given prompt once, across reprocessing, restarts and workers.
+
+    The cache holds at most max_entries results, evicting the least recently
+    used ones beyond that. Errors reading or writing it are logged rather than
+    raised, so they can't fail a parse.
+
+    Its hit rates are reported in llm_metrics.
+    """
+    # Eviction needs a count of all entries, so is only checked every so often.
+    EVICTION_CHECK_INTERVAL = 100
+
+    def __init__(self, max_entries=PARSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # All entries are in the DB. There's no in-process tier.
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts_since_eviction_check = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_hash, prompt, system_prompt, temperature):
+        """Return the cache key (as keyword arguments) for a parse request.
+
+        Results are also keyed on the model that produced them (see get and
+        put), as a request may be answered by any of several models (see
+        llm.routing.ModelRouter).
+        """
+        prompt_hash = hashlib.sha256(
+            f'{system_prompt}\n---\n{prompt}'.encode()
+        ).hexdigest()
+
+        return {
+            'image_hash': image_hash,
+            'prompt_hash': prompt_hash,
+            'temperature': temperature,
+        }
+
+    def get(self, key, model_names):
+        """Return the cached result for key, or None if there isn't one.
+
+        Args:
+            key: dict - See make_key.
+            model_names: list of str - Names of the models whose results can
+                be used, in order of preference.
+        """
+        try:
+            entries = {
+                entry.model_name: entry
+                for entry in ParseCacheEntry.objects.filter(**key, model_name__in=model_names)
+            }
+            entry = next((entries[name] for name in model_names if name in entries), None)
+
+            if entry is not None:
+                ParseCacheEntry.objects.filter(id=entry.id).update(
+                    hits=F('hits') + 1, time_last_used=timezone.now()
+                )
+
+        except Exception as e:
+            print(f'Error reading from the parse result cache: {type(e)}: {e}')
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.db_hits += 1
+
+        return entry.result
+
+    def put(self, key, model_name, result):
+        """Cache a result under key, evicting old results if over capacity.
+
+        Args:
+            key: dict - See make_key.
+            model_name: str - Name of the model that produced the result.
+            result: dict - The parse result.
+        """
+        try:
+            ParseCacheEntry.objects.update_or_create(
+                **key,
+                model_name=model_name,
+                defaults={'result': result, 'time_last_used': timezone.now()}
+            )
+
+            with self._lock:
+                self._puts_since_eviction_check += 1
+                if self._puts_since_eviction_check < self.EVICTION_CHECK_INTERVAL:
+                    return
+
+                self._puts_since_eviction_check = 0
+
+            self.evict()
+
+        except Exception as e:
+            print(f'Error writing to the parse result cache: {type(e)}: {e}')
+
+    def evict(self):
+        """Delete the least recently used entries beyond max_entries."""
+        stale_ids = list(
+            ParseCacheEntry.objects.order_by('-time_last_used')
+            .values_list('id', flat=True)[self.max_entries:]
+        )
+
+        if stale_ids:
+            ParseCacheEntry.objects.filter(id__in=stale_ids).delete()
+
+            with self._lock:
+                self.evictions += len(stale_ids)
+
+    async def aget(self, key, model_names):
+        """Async version of get."""
+        return await sync_to_async(self.get)(key, model_names)
+
+    async def aput(self, key, model_name, result):
+        """Async version of put."""
+        await sync_to_async(self.put)(key, model_name, result)
+
+    def stats(self):
+        """Return hit/miss counts (for this process) and the hit rate, as a dictionary.
+
+        In the same form as db.models.EmbeddingCache.stats, for llm_metrics.
+        """
+        with self._lock:
+            lookups = self.db_hits + self.misses
+            return {
+                'memory_hits': 0,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memory_entries': 0,
+                'hit_rate': self.db_hits / lookups if lookups else None,
+            }
+
+
+parse_result_cache = ParseResultCache()
+llm_metrics.add_cache('parse', parse_result_cache)
+
+PAGE_PROMPT = 'Please process the given image as requested.'
+# Independent of the number of pages so results are cached the same way
+# whatever batch a page ends up in.
+PAGE_BATCH_PROMPT = 'Please process the given page images as requested.'
+
+
+def _make_cache_key(assistant, prompt, page_image, image_hash=None):
+    return ParseResultCache.make_key(
+        image_hash or page_image.content_hash(),
+        prompt,
+        assistant.generate_system_prompt({}),
+        assistant.temperature
+    )
+
+
+def _get_model_names(assistant):
+    """Return the names of the models that may answer an assistant's prompts."""
+    return [model.name for model in getattr(assistant.model, 'models', [assistant.model])]
+
+
+def _get_responding_model_name(assistant):
+    """Return the name of the model that answered the assistant's last prompt.
+
+    Only valid right after the prompt, in the same thread or task.
+    """
+    if isinstance(assistant.model, ModelRouter):
+        return routed_model.get().name
+
+    return assistant.model.name
+
+
+def _prompt_page_parser(prompt, page_image):
+    """Prompt the page parser, streaming the response if PARSE_STREAMING is set.
+
+    A streamed response is validated as it arrives, and abandoned (stopping the
+    generation) as soon as it can no longer be a valid ParserResponseModel, in
+    which case the next model is tried (see llm.routing.ModelRouter).
+
+    Returns:
+        str: The response.
+
+    Raises:
+        JSONStreamError: If every model's streamed response was abandoned. Its
+            response attribute holds the last one received until then.
+    """
+    response = page_image_parser.prompt(
+        prompt,
+        images=[page_image],
+        response_format='json',
+        conversation=None,
+        system_prompt_context={},
+        stream=PARSE_STREAMING
+    )
+    if not PARSE_STREAMING:
+        return response
+
+    try:
+        return ''.join(response)
+
+    finally:
+        response.close()
+
+
+async def _aprompt_page_parser(prompt, page_image):
+    """Async version of _prompt_page_parser."""
+    response = await page_image_parser.aprompt(
+        prompt,
+        images=[page_image],
+        response_format='json',
+        conversation=None,
+        system_prompt_context={},
+        stream=PARSE_STREAMING
+    )
+    if not PARSE_STREAMING:
+        return response
+
+    chunks = []
+    try:
+        async for chunk in response:
+            chunks.append(chunk)
+
+    finally:
+        await response.aclose()
+
+    return ''.join(chunks)
+
+
+def _validate_page_response(response_json):
+    """Validate a parser response, returning its contents as a dictionary.
+
+    Raises:
+        json.JSONDecodeError, ValidationError: If the response is invalid.
+    """
+    validated_data = ParserResponseModel(**json.loads(response_json))
+    print("Validated Data:", validated_data)
+
+    return validated_data.dict()
+
+
+def _generate_retry_prompt(response_json, error):
+    """Return a prompt asking the model to try again after an invalid response."""
+    print("Error:", error)
+    print('')
+    print("Response:")
+    print("---------")
+    print(response_json)
+
+    return (
+        'Please process the given image as requested. '
+        'Your last response below resulted in the following error: '
+        '\nResponse: \n'
+        f'{response_json}'
+        f'\nError:{error} \n'
+    )
+
+
+def _validate_batch_response(response_json, num_pages):
+    """Validate a batch parser response page by page.
+
+    Args:
+        response_json: str - The response, or None if the request failed.
+        num_pages: int - The number of pages in the request.
+
+    Returns:
+        list: A dictionary per page (see parse_page_image), or None for pages
+            whose results are missing or invalid.
+    """
+    results = [None] * num_pages
+    if response_json is None:
+        return results
+
+    try:
+        page_results = json.loads(response_json).get('pages') or []
+
+    except (json.JSONDecodeError, AttributeError) as e:
+        print("Batch parse error:", e)
+        return results
+
+    if len(page_results) != num_pages:
+        # Can't tell which result goes with which page.
+        print(f"Batch parse returned {len(page_results)} results for {num_pages} pages.")
+        return results
+
+    for i, page_result in enumerate(page_results):
+        try:
+            results[i] = ParserResponseModel(**page_result).dict()
+
+        except (TypeError, ValidationError) as e:
+            print(f"Batch parse error for page {i + 1} of the batch:", e)
+
+    return results
+
+
+def parse_page_image(page_image, image_hash=None, use_cache=True):
     """Parse a page and return its contents and other useful metadata.
 
+    Results are cached (see ParseResultCache), so the same image is not sent
+    to the model again with the same prompt.
+
     Args:
         page_image: image.Image - Image object representing the page.
+        image_hash: str - Optional. The image's content hash if already known
+            (see image.Image.content_hash). Calculated if not provided.
+        use_cache: bool - Optional. Whether to look up and store the result in
+            the parse result cache. Default True.
 
     Returns:
         dict: A dictionary with the above metadata.
     """
-    # To prevent errors caused by presence of an alpha channel.
-    # TODO: We should probably do this at the LLM API level
-    page_image.image = page_image.image.convert('RGB')
+    prompt = PAGE_PROMPT
+
+    if use_cache:
+        cache_key = _make_cache_key(page_image_parser, prompt, page_image, image_hash)
+
+        cached_result = parse_result_cache.get(
+            cache_key, _get_model_names(page_image_parser)
+        )
+        if cached_result is not None:
+            return cached_result
+
+    # No need to convert/resize the image here. Models normalize the images
+    # sent to them (incl. dropping any alpha channel). See Model.prepare_image.
     errors_so_far = 0
 
-    prompt = 'Please process the given image as requested.'
     while errors_so_far <= MAX_PROMPT_RETRIES:
-        response_json = page_image_parser.prompt(
-            prompt,
-            images=[page_image],
-            response_format='json',
-            conversation=None,
-            system_prompt_context={}
+        try:
+            response_json = _prompt_page_parser(prompt, page_image)
+            result = _validate_page_response(response_json)
+
+            if use_cache:
+                parse_result_cache.put(
+                    cache_key, _get_responding_model_name(page_image_parser), result
+                )
+
+            return result
+
+        except (json.JSONDecodeError, JSONStreamError, ValidationError) as e:
+            if isinstance(e, JSONStreamError):
+                response_json = e.response
+
+            errors_so_far += 1
+
+            if errors_so_far == MAX_PROMPT_RETRIES:
+                raise
+
+            prompt = _generate_retry_prompt(response_json, e)
+
+
+async def aparse_page_image(page_image, image_hash=None, use_cache=True):
+    """Async version of parse_page_image. Takes the same arguments.
+
+    The request is made on the event loop (see llm.apis.BaseAPI.arun_prompt),
+    so many pages can be parsed at once without a thread each.
+    """
+    prompt = PAGE_PROMPT
+
+    if use_cache:
+        cache_key = _make_cache_key(page_image_parser, prompt, page_image, image_hash)
+
+        cached_result = await parse_result_cache.aget(
+            cache_key, _get_model_names(page_image_parser)
         )
+        if cached_result is not None:
+            return cached_result
 
+    errors_so_far = 0
+
+    while errors_so_far <= MAX_PROMPT_RETRIES:
         try:
-            response_dict = json.loads(response_json)
-            parsed_json = json.loads(response_json)
-            validated_data = ParserResponseModel(**parsed_json)
-            print("Validated Data:", validated_data)
-
-            return validated_data.dict()
-
-        except (json.JSONDecodeError, ValidationError) as e:
-            print("Error:", e)
-            print('')
-            print("Response:")
-            print("---------")
-            print(response_json)
+            response_json = await _aprompt_page_parser(prompt, page_image)
+            result = _validate_page_response(response_json)
+
+            if use_cache:
+                await parse_result_cache.aput(
+                    cache_key, _get_responding_model_name(page_image_parser), result
+                )
+
+            return result
+
+        except (json.JSONDecodeError, JSONStreamError, ValidationError) as e:
+            if isinstance(e, JSONStreamError):
+                response_json = e.response
+
             errors_so_far += 1
 
             if errors_so_far == MAX_PROMPT_RETRIES:
                 raise
 
-            prompt = (
-                'Please process the given image as requested. '
-                'Your last response below resulted in the following error: '
-                '\nResponse: \n'
-                f'{response_json}'
-                '\nError:{e} \n'
+            prompt = _generate_retry_prompt(response_json, e)
+
+
+def get_page_batch_size():
+    """Return the number of pages to parse per request (see parse_page_images).
+
+    This is configured per model (see llm.models.Model.page_batch_size), and
+    is that of the preferred model that supports batching. Models that take
+    fewer pages aren't sent larger batches (see llm.routing.ModelRouter).
+    """
+    if page_batch_parser is None:
+        return 1
+
+    return max(1, page_batch_parser.model.page_batch_size)
+
+
+def _get_batch_max_tokens(num_pages):
+    # Capped at the output token limit of whichever model the batch is sent
+    # to (see llm.routing.ModelRouter).
+    return BATCH_MAX_TOKENS_PER_PAGE * num_pages
+
+
+def parse_page_images(page_images, image_hashes=None, use_cache=True,
+        return_exceptions=False):
+    """Parse several consecutive pages in one request.
+
+    This saves sending the system prompt, and the overhead of a request, for
+    every page, and lets the model see text that runs from one page on to the
+    next. It's meant for long-context models (see get_page_batch_size).
+
+    The response is validated page by page. Pages whose results are missing or
+    invalid are parsed again individually with parse_page_image.
+
+    Args:
+        page_images: list of image.Image - Images of consecutive pages, in order.
+        image_hashes: list of str - Optional. The images' content hashes if
+            already known. See parse_page_image.
+        use_cache: bool - Optional. See parse_page_image. Default True.
+        return_exceptions: bool - Optional. If True, a page whose fallback,
+            individual parse fails gets the exception in place of its result,
+            instead of it being raised. Default False.
+
+    Returns:
+        list of dict: A dictionary of metadata per page, in the same order as
+            page_images. See parse_page_image.
+
+    Raises:
+        Exception: If a page's fallback, individual parse fails (unless
+            return_exceptions is set).
+    """
+    if image_hashes is None:
+        image_hashes = [None] * len(page_images)
+
+    results = [None] * len(page_images)
+
+    # A single page is simply parsed on its own (below), as is every page if no
+    # model supports batching.
+    batch = page_batch_parser is not None and len(page_images) > 1
+
+    if use_cache and batch:
+        cache_keys = [
+            _make_cache_key(page_batch_parser, PAGE_BATCH_PROMPT, page_image, image_hash)
+            for page_image, image_hash in zip(page_images, image_hashes)
+        ]
+        model_names = _get_model_names(page_batch_parser)
+        results = [parse_result_cache.get(cache_key, model_names) for cache_key in cache_keys]
+
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    # Only worth a batch request if more than one page is left to parse.
+    if batch and len(pending) > 1:
+        try:
+            response_json = page_batch_parser.prompt(
+                PAGE_BATCH_PROMPT,
+                images=[page_images[i] for i in pending],
+                response_format='json',
+                conversation=None,
+                system_prompt_context={},
+                max_tokens=_get_batch_max_tokens(len(pending))
+            )
+            model_name = _get_responding_model_name(page_batch_parser)
+
+        except Exception as e:
+            # Every page falls back to being parsed on its own.
+            print("Batch parse error:", e)
+            response_json = None
+
+        for i, result in zip(pending, _validate_batch_response(response_json, len(pending))):
+            if result is not None:
+                results[i] = result
+                if use_cache:
+                    parse_result_cache.put(cache_keys[i], model_name, result)
+
+    # Fall back to parsing pages one by one.
+    for i, result in enumerate(results):
+        if result is None:
+            try:
+                results[i] = parse_page_image(page_images[i], image_hashes[i], use_cache)
+
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+
+                results[i] = e
+
+    return results
+
+
+async def aparse_page_images(page_images, image_hashes=None, use_cache=True,
+        return_exceptions=False):
+    """Async version of parse_page_images. Takes the same arguments.
+
+    Pages that fall back to being parsed individually are parsed concurrently.
+    """
+    if image_hashes is None:
+        image_hashes = [None] * len(page_images)
+
+    results = [None] * len(page_images)
+    batch = page_batch_parser is not None and len(page_images) > 1
+
+    if use_cache and batch:
+        cache_keys = [
+            _make_cache_key(page_batch_parser, PAGE_BATCH_PROMPT, page_image, image_hash)
+            for page_image, image_hash in zip(page_images, image_hashes)
+        ]
+        model_names = _get_model_names(page_batch_parser)
+        results = list(await asyncio.gather(
+            *[parse_result_cache.aget(cache_key, model_names) for cache_key in cache_keys]
+        ))
+
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if batch and len(pending) > 1:
+        try:
+            response_json = await page_batch_parser.aprompt(
+                PAGE_BATCH_PROMPT,
+                images=[page_images[i] for i in pending],
+                response_format='json',
+                conversation=None,
+                system_prompt_context={},
+                max_tokens=_get_batch_max_tokens(len(pending))
             )
+            model_name = _get_responding_model_name(page_batch_parser)
+
+        except Exception as e:
+            print("Batch parse error:", e)
+            response_json = None
+
+        for i, result in zip(pending, _validate_batch_response(response_json, len(pending))):
+            if result is not None:
+                results[i] = result
+                if use_cache:
+                    await parse_result_cache.aput(cache_keys[i], model_name, result)
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    fallback_results = await asyncio.gather(
+        *[aparse_page_image(page_images[i], image_hashes[i], use_cache) for i in pending],
+        return_exceptions=True
+    )
+    for i, result in zip(pending, fallback_results):
+        # Cancellation (a BaseException) is always passed on.
+        if isinstance(result, BaseException) and (
+                not return_exceptions or not isinstance(result, Exception)):
+            raise result
+
+        results[i] = result
+
+    return results
 
 
 if __name__ == '__main__':
@@ -1,13 +1,20 @@
 import asyncio
+import datetime
+import hashlib
 import os
+import socket
 import uuid
 
 import aiofiles
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, transaction
 import magic
 
-from db.models import Document, Page
+from db.models import (Document, DocumentStatusCodes, IngestJob,
+    IngestJobStatusCodes, Page, PageChunk, PageStatusCodes)
 from image import Image
-from parser import parse_page_image
+from llm.metrics import llm_metrics
+from parser import aparse_page_images, get_page_batch_size
 from sockets import broadcast_document_update
 import utils
 
@@ -17,21 +24,53 @@ UPLOAD_FOLDER = os.path.join(
     'media/'
 )
 
+# Uploads are streamed to disk in chunks of this many bytes.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE_MB', 50)) * 1024 * 1024
+
+# Maximum number of pages of a single document being parsed at once. Each page
+# in flight means an LLM call, embedding calls and DB writes.
+PAGE_PARSE_CONCURRENCY = int(os.environ.get('PAGE_PARSE_CONCURRENCY', 4))
+
+# Number of documents processed at once by each ingest worker. Calls to LLM
+# providers and embedding backends are capped separately across all of them
+# within a process (see llm.limits).
+DOCUMENT_QUEUE_WORKERS = int(os.environ.get('DOCUMENT_QUEUE_WORKERS', 2))
+
+# How long an ingest worker's claim on a job lasts unless renewed. A job whose
+# worker dies becomes available to others once this runs out.
+INGEST_JOB_LEASE_SECONDS = int(os.environ.get('INGEST_JOB_LEASE_SECONDS', 120))
+INGEST_JOB_MAX_ATTEMPTS = int(os.environ.get('INGEST_JOB_MAX_ATTEMPTS', 3))
+INGEST_POLL_INTERVAL_SECONDS = float(os.environ.get('INGEST_POLL_INTERVAL_SECONDS', 2))
+# How often ingest workers write out their LLM metrics for the app to report
+# (see llm.metrics).
+METRICS_SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get('METRICS_SNAPSHOT_INTERVAL_SECONDS', 15))
+
 
 class UnsupportedFileType(Exception):
     """Exception type for uploaded files that are not of a supported type."""
     pass
 
 
-# These are separate from the async processor because
-# the file pointer gets lost somehow if they're in the DocumentProcessor class.
-# In any case this is pre-processing...
-async def get_file_type(file):
-    """Figure out file type."""
+class FileTooLarge(Exception):
+    """Exception type for uploaded files over the size limit."""
+    pass
+
+
+def get_buffer_file_type(buffer):
+    """Figure out file type from the first few bytes of a file.
+
+    Args:
+        buffer: bytes - The start of the file. 2048 bytes is plenty.
+
+    Returns:
+        str: 'pdf' or 'image'.
+
+    Raises:
+        UnsupportedFileType: If the file is neither.
+    """
     mime = magic.Magic(mime=True)
-    # Read small chunk to detect mimetype
-    file_type = mime.from_buffer(file.read(1024))
-    file.seek(0)
+    file_type = mime.from_buffer(buffer)
 
     if file_type == 'application/pdf':
         return 'pdf'
@@ -45,23 +84,70 @@ async def get_file_type(file):
         raise UnsupportedFileType('File must be a pdf or image.')
 
 
-async def save_file(file):
-    """Asynchronously save a file to the filesystem.
+# These are separate from the async processor because
+# the file pointer gets lost somehow if they're in the DocumentProcessor class.
+# In any case this is pre-processing...
+async def save_file(file, max_size=None):
+    """Asynchronously stream an uploaded file to the filesystem.
+
+    The file is copied over in chunks of UPLOAD_CHUNK_SIZE bytes so it is never
+    held in memory in full. Along the way its type is sniffed from the first
+    chunk and it is hashed. Unsupported or oversized files are rejected as soon
+    as that is apparent, and whatever had been written of them is removed.
 
     Args:
         file: File - The file to save.
+        max_size: int - Optional. Maximum file size in bytes. Default
+            MAX_UPLOAD_SIZE.
 
     Returns:
-        dict: Dictionary with filename and path
-    """
-    # TODO: Take care of filename collisions in the filesystem.
-    filename = file.filename
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+        dict: Dictionary with filename, path, type ('pdf' or 'image'), size
+            and SHA-256 hash of the contents.
 
-    async with aiofiles.open(filepath, 'wb') as f:
-        await f.write(file.read())
-
-    return {'filename': filename, 'filepath': filepath}
+    Raises:
+        UnsupportedFileType: If the file is not a pdf or image.
+        FileTooLarge: If the file is over max_size.
+    """
+    max_size = max_size or MAX_UPLOAD_SIZE
+    # Only the name, in case the client sent a path.
+    filename = os.path.basename(file.filename or '') or 'upload'
+    # Prefixed with a unique id so uploads with the same name don't overwrite
+    # each other.
+    filepath = os.path.join(UPLOAD_FOLDER, f'{uuid.uuid4().hex}_{filename}')
+
+    file_type = None
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        async with aiofiles.open(filepath, 'wb') as f:
+            while chunk := await asyncio.to_thread(file.stream.read, UPLOAD_CHUNK_SIZE):
+                if file_type is None:
+                    file_type = get_buffer_file_type(chunk)
+
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLarge(
+                        f'File must be at most {max_size // (1024 * 1024)} MB.'
+                    )
+
+                digest.update(chunk)
+                await f.write(chunk)
+
+        if file_type is None:
+            raise UnsupportedFileType('File is empty.')
+
+    except Exception:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        raise
+
+    return {
+        'filename': filename,
+        'filepath': filepath,
+        'type': file_type,
+        'size': size,
+        'sha256': digest.hexdigest(),
+    }
 
 
 class DocumentProcessor():
@@ -70,13 +156,15 @@ class DocumentProcessor():
     A document processor instance takes a single document and sees it through
     the entire processing pipeline.
     """
-    def __init__(self, document):
+    def __init__(self, document, concurrency=None):
         """
         Args:
-            file: file - A file to process.
             document: models.Document - The document to process.
+            concurrency: int - Optional. Maximum number of pages to parse at
+                once. Default PAGE_PARSE_CONCURRENCY.
         """
         self.document = document
+        self.concurrency = concurrency or PAGE_PARSE_CONCURRENCY
 
     async def process(self):
         """
@@ -85,97 +173,312 @@ class DocumentProcessor():
         1. Split file into pages if necessary
         2. Save pages to DB
         3. Parse pages
+
+        The stages are pipelined: each page is handed on to be parsed as soon
+        as it has been split out and saved, so splitting, parsing (LLM calls),
+        embedding and DB writes overlap across pages.
         """
-        if self.document.type == 1:  # 'pdf'
-            pages_info = await self.split_pdf(self.document.filepath)
-            await self.save_pages_to_db(pages_info)
+        if await self.copy_identical_document():
+            await broadcast_document_update(self.document)
+            return
 
-        elif self.document.type == 2:  # 'image'
-            pages_info = [
-                {'number': 1, 'filepath': self.document.filepath}
-            ]
-            _ = await Page.objects.acreate(
+        await self.parse_pages(self.iter_pages())
+        await broadcast_document_update(self.document)
+
+    async def copy_identical_document(self):
+        """Reuse the pages of an identical document that has been processed already.
+
+        This saves parsing and embedding the same file over again, e.g. when
+        the same handout is uploaded more than once.
+
+        Returns:
+            bool: True if an identical document was found and its pages copied,
+                in which case this document is done. False otherwise.
+        """
+        if not self.document.sha256:
+            return False
+
+        original = await Document.objects.filter(
+            sha256=self.document.sha256, status=DocumentStatusCodes.READY
+        ).exclude(id=self.document.id).afirst()
+
+        if original is None or await Page.objects.filter(document=self.document).aexists():
+            return False
+
+        # The page images are shared with the original rather than duplicated.
+        pages = {}
+        async for original_page in Page.objects.filter(document=original):
+            page = Page(
                 document=self.document,
-                number=1,
-                filepath=self.document.filepath
+                number=original_page.number,
+                filepath=original_page.filepath,
+                image_hash=original_page.image_hash,
+                status=PageStatusCodes.READY,
+            )
+            page.copy_contents_from(original_page)
+            pages[original_page.id] = page
+
+        # bulk_create doesn't go through Page.save, so embeddings are not
+        # recalculated.
+        await Page.objects.abulk_create(pages.values())
+
+        # Nor are the chunks', which are copied too.
+        await PageChunk.objects.abulk_create([
+            PageChunk(
+                page=pages[chunk.page_id], index=chunk.index, start=chunk.start,
+                end=chunk.end, embedding=chunk.embedding
             )
+            async for chunk in PageChunk.objects.filter(page__document=original)
+        ])
 
-        # TODO: Clean this up once parsing logic is moved here.
-        # This is just to temporarily demonstrate/test the ability to broadcast.
-        # self.document.status = 1
-        # self.document = await self.document.asave()
-        # await self.document.arefresh_from_db()
+        self.document.summary = original.summary
+        self.document.status = DocumentStatusCodes.READY
+        await self.document.asave()
 
-        await self.parse_pages(pages_info)
-        await broadcast_document_update(self.document)
+        return True
+
+    async def iter_pages(self):
+        """Split the document into pages and save them to the DB.
+
+        Picks up where any previous, interrupted run left off. Pages already
+        split out and saved are not split out again, and of those only the ones
+        still waiting to be parsed are yielded. Ready pages are never parsed
+        again, and failed ones only once reset (see retry_failed_pages).
+
+        Yields:
+            models.Page: Each page waiting to be parsed, as soon as it has been
+                saved.
+        """
+        saved_pages = {
+            page.number: page
+            async for page in Page.objects.filter(document=self.document)
+        }
+
+        for number in sorted(saved_pages):
+            if saved_pages[number].status == PageStatusCodes.PROCESSING:
+                yield saved_pages[number]
+
+        if self.document.type == 1:  # 'pdf'
+            # Pages are split out and saved in order, so carry on after the
+            # last saved one.
+            resume_from = max(saved_pages, default=0) + 1
+            async for page_info in self.split_pdf(self.document.filepath, first_page=resume_from):
+                yield await self.save_page_to_db(page_info)
+
+        elif self.document.type == 2 and not saved_pages:  # 'image'
+            await asyncio.to_thread(
+                utils.save_page_image_derivatives, self.document.filepath
+            )
+            yield await self.save_page_to_db(
+                {'number': 1, 'filepath': self.document.filepath}
+            )
 
-    async def split_pdf(self, filepath):
+    async def split_pdf(self, filepath, first_page=1):
         """Split a pdf file into separate pages and save them as images.
 
+        Pages are rendered a few at a time across a pool of processes (see
+        utils.iter_pdf_pages), so memory use stays flat regardless of the
+        document's length.
+
         Args:
             filepath: str - Path to the file to split.
+            first_page: int - Number of the page to start from. Default 1.
 
-        Returns:
-            list of dict: List of dictionaries, each with a page's info:
-                number and filepath.
+        Yields:
+            dict: A page's info: number, filepath and image_hash, as soon as
+                it is saved.
         """
         pages_folder = os.path.join(os.path.dirname(filepath), self.document.id)
 
-        return await utils.save_pdf_as_images(filepath, pages_folder)
+        async for page_info in utils.iter_pdf_pages(filepath, pages_folder, first_page=first_page):
+            yield page_info
 
-    async def save_pages_to_db(self, pages_info):
-        """Split a pdf file into separate pages and save them as images.
+    async def save_page_to_db(self, page_info):
+        """Create a DB record for a page of the document.
 
         Args:
-            pages_info: list of dict - List of dictionaries, each with a page's
-                info number and filepath.
+            page_info: dict - The page's info: number, filepath and
+                optionally image_hash.
 
         Returns:
-            list of dict: List of dictionaries, each with a page's info:
-                number and filepath.
+            models.Page: The created page.
         """
-        page_save_tasks = []
-        for page_info in pages_info:
-            # TODO: Handle case where page save fails.
-            page_save_tasks.append(
-                Page.objects.acreate(
-                    document=self.document,
-                    number=page_info['number'],
-                    filepath=page_info['filepath']
-                )
-            )
+        # TODO: Handle case where page save fails.
+        return await Page.objects.acreate(
+            document=self.document,
+            number=page_info['number'],
+            filepath=page_info['filepath'],
+            image_hash=page_info.get('image_hash', '')
+        )
 
-        await asyncio.gather(*page_save_tasks)
-
-    async def parse_pages(self, pages_info):
-        """Parse all the given pages and update the page and document statuses.
+    async def parse_page(self, page):
+        """Parse a single page and save the results to it.
 
         Args:
-            pages_info: list of dict - A list of dicts each containing a page's
-                number and filepath.
+            page: models.Page - The page to parse.
+
+        Returns:
+            bool: True if the page was parsed successfully, False otherwise. In
+                the latter case the page is marked as failed.
         """
-        at_least_one_failure = False
-        for page_info in pages_info:
-            page = await Page.objects.aget(document=self.document, number=page_info['number'])
+        return not await self.parse_page_batch([page])
 
-            try:
-                page_image = Image(page.filepath)
-                parse_result = await asyncio.to_thread(parse_page_image, page_image)
+    async def parse_page_batch(self, pages):
+        """Parse a batch of consecutive pages and save the results to them.
 
-                page.text = parse_result['text']
-                page.summary = parse_result['summary']
-                page.description = parse_result['description']
-                page.status = 1
-                await page.asave()
+        Pages identical to ones already parsed reuse their results. The rest
+        are parsed together, in as few requests as the model allows (see
+        parser.parse_page_images). Requests are made on the event loop rather
+        than in threads, so the number in flight isn't bound by the thread pool.
+
+        Args:
+            pages: list of models.Page - Consecutive pages to parse, in order.
+
+        Returns:
+            list of int: Numbers of the pages that failed. These are marked as
+                failed.
+        """
+        failures = []
+        pages_to_parse = []
+        for page in pages:
+            try:
+                if not await self.reuse_identical_page(page):
+                    pages_to_parse.append(page)
 
             # TODO: Catch more specific Exceptions here.
             except Exception as e:
-                page.status = 2
-                page.error_details = f'{type(e)}: {e}'
-                await page.asave()
-                at_least_one_failure = True
+                await self.save_page_failure(page, e)
+                failures.append(page.number)
+
+        if not pages_to_parse:
+            return failures
+
+        try:
+            page_images = [Image(page.filepath) for page in pages_to_parse]
+            parse_results = await aparse_page_images(
+                page_images,
+                image_hashes=[page.image_hash for page in pages_to_parse],
+                return_exceptions=True
+            )
+
+        except Exception as e:
+            parse_results = [e] * len(pages_to_parse)
+
+        for page, parse_result in zip(pages_to_parse, parse_results):
+            if isinstance(parse_result, Exception):
+                await self.save_page_failure(page, parse_result)
+                failures.append(page.number)
+                continue
+
+            page.text = parse_result['text']
+            page.summary = parse_result['summary']
+            page.description = parse_result['description']
+            page.status = 1
+            await page.asave()
+
+        return failures
+
+    async def reuse_identical_page(self, page):
+        """Copy over the results for an identical page that has already been parsed.
+
+        e.g. a repeated cover page or a re-uploaded scan.
 
-        if at_least_one_failure:
+        Args:
+            page: models.Page - The page to find an identical page for.
+
+        Returns:
+            bool: True if an identical page was found and its results copied
+                and saved. False otherwise.
+        """
+        if not page.image_hash:
+            page.image_hash = await asyncio.to_thread(Image(page.filepath).content_hash)
+
+        identical_page = await Page.objects.filter(
+            image_hash=page.image_hash, status=PageStatusCodes.READY
+        ).exclude(id=page.id).afirst()
+
+        if identical_page is None:
+            return False
+
+        # The embeddings are copied along with the text they were calculated
+        # from, so aren't calculated again.
+        page.copy_contents_from(identical_page)
+        page.status = 1
+        await page.asave()
+        await sync_to_async(page.copy_chunks_from)(identical_page)
+
+        return True
+
+    async def save_page_failure(self, page, error):
+        """Mark a page as failed, with the details of the error."""
+        page.status = 2
+        page.error_details = f'{type(error)}: {error}'
+        await page.asave(update_fields=['status', 'error_details'])
+
+    async def parse_pages(self, pages):
+        """Parse all the given pages and update the page and document statuses.
+
+        Up to self.concurrency batches of pages are parsed at once. Batches
+        are made up of consecutive pages, up to the parser's batch size (see
+        parser.get_page_batch_size). Pages are taken from pages as they become
+        available, so this can be fed by a generator that is still producing
+        them (see iter_pages).
+
+        Args:
+            pages: iterable or async iterable of models.Page - The pages to parse.
+        """
+        batch_size = get_page_batch_size()
+        # Bounded, so the producer doesn't run too far ahead of the parsers.
+        page_queue = asyncio.Queue(maxsize=self.concurrency * batch_size)
+        failures = []
+
+        async def parse_queued_pages():
+            while True:
+                batch = [await page_queue.get()]
+                # Batch up whatever else is ready, without waiting for more.
+                while len(batch) < batch_size and not page_queue.empty():
+                    batch.append(page_queue.get_nowait())
+
+                try:
+                    for run in consecutive_runs(batch):
+                        failures.extend(await self.parse_page_batch(run))
+
+                except Exception as e:
+                    # Only if the pages can't even be saved as failed. Keep
+                    # going so the rest of the document still gets parsed.
+                    numbers = [page.number for page in batch]
+                    print(f'Error parsing pages {numbers} of {self.document.id}: {e}')
+                    failures.extend(numbers)
+
+                finally:
+                    for _ in batch:
+                        page_queue.task_done()
+
+        parsers = [
+            asyncio.create_task(parse_queued_pages())
+            for _ in range(self.concurrency)
+        ]
+
+        try:
+            if hasattr(pages, '__aiter__'):
+                async for page in pages:
+                    await page_queue.put(page)
+
+            else:
+                for page in pages:
+                    await page_queue.put(page)
+
+            await page_queue.join()
+
+        finally:
+            for parser in parsers:
+                parser.cancel()
+
+            await asyncio.gather(*parsers, return_exceptions=True)
+
+        # Failures from previous runs count too.
+        if failures or await Page.objects.filter(
+                document=self.document, status=PageStatusCodes.ERROR).aexists():
             self.document.status = 2
         else:
             self.document.status = 1
@@ -184,41 +487,266 @@ class DocumentProcessor():
         await self.document.arefresh_from_db()
 
 
-class DocumentProcessorQueue():
-    """Queue for processing documents."""
-    def __init__(self):
-        self.queue = asyncio.Queue()
-        self.processing_task = None
+def consecutive_runs(pages):
+    """Split pages up into runs of consecutive pages.
+
+    Args:
+        pages: list of models.Page - The pages.
+
+    Returns:
+        list of list of models.Page: Runs of consecutively numbered pages, each
+            in order.
+    """
+    runs = []
+    for page in sorted(pages, key=lambda page: page.number):
+        if runs and runs[-1][-1].number == page.number - 1:
+            runs[-1].append(page)
+        else:
+            runs.append([page])
+
+    return runs
+
+
+async def retry_failed_pages(document):
+    """Queue a document's failed pages up to be parsed again.
+
+    Only the failed pages are parsed again. Pages that are ready are left as
+    they are. Nothing is queued up while the document is being processed, as
+    that run may already be past the pages.
+
+    Args:
+        document: models.Document - The document.
+
+    Returns:
+        int: The number of pages queued up.
+    """
+    if await IngestJob.objects.filter(
+            document=document, status=IngestJobStatusCodes.RUNNING).aexists():
+        return 0
+
+    # A single queryset update, rather than saving the pages one by one.
+    num_pages = await Page.objects.filter(
+        document=document, status=PageStatusCodes.ERROR
+    ).aupdate(status=PageStatusCodes.PROCESSING, error_details=None)
+
+    if num_pages:
+        document.status = DocumentStatusCodes.PROCESSING
+        await document.asave()
+        await enqueue_document(document)
+
+    return num_pages
+
+
+def recover_interrupted_ingests():
+    """Queue up documents left mid-processing with no job to finish them.
 
-    async def enqueue(self, document):
-        """Add a document processor to the queue.
+    e.g. documents that were being processed in-process when the server went
+    down, before ingest moved to job-table backed workers. Jobs that were
+    running on a worker that went down are picked up again without this, once
+    their lease runs out.
 
+    Returns:
+        int: The number of documents queued up.
+    """
+    with transaction.atomic():
+        # Locked so that workers starting up at the same time don't both
+        # queue the same documents.
+        stuck_documents = Document.objects.select_for_update(skip_locked=True).filter(
+            status=DocumentStatusCodes.PROCESSING
+        ).exclude(
+            ingest_jobs__status__in=IngestJob.ACTIVE_STATUSES
+        )
+
+        # Conflicts are documents queued up concurrently, e.g. by a retry.
+        jobs = IngestJob.objects.bulk_create(
+            [IngestJob(document=document) for document in stuck_documents],
+            ignore_conflicts=True
+        )
+
+    return len(jobs)
+
+
+async def enqueue_document(document):
+    """Queue a document up for processing by an ingest worker, unless it already is.
+
+    Args:
+        document: models.Document - The document to process.
+
+    Returns:
+        models.IngestJob: The document's queued or running job. See
+            models.IngestJob.enqueue.
+    """
+    return await sync_to_async(IngestJob.enqueue)(document)
+
+
+async def close_stale_db_connections():
+    """Close DB connections that errored or outlived CONN_MAX_AGE, so the next query reconnects.
+
+    Django only does this around requests, so long-running loops (e.g. ingest
+    workers) have to themselves, or keep reusing a connection the DB dropped.
+    Runs on the thread the async ORM calls use, whose connection that is.
+    """
+    await sync_to_async(close_old_connections)()
+
+
+class IngestWorker():
+    """Processes documents queued in the ingest job table.
+
+    Any number of workers, in any number of processes or on any number of
+    machines, can run against the same database. Each claims jobs by taking a
+    lease on them (see models.IngestJob.claim_next), which it renews while the
+    job runs. If a worker dies its jobs' leases run out and they are picked up
+    by another.
+
+    A worker processes up to `concurrency` documents at once, so one long
+    document doesn't hold up the ones queued after it. A failure while
+    processing one document is contained to that document.
+
+    Run with: python manage.py ingest_worker
+    """
+    def __init__(self, concurrency=None, lease_duration=None, poll_interval=None,
+            max_attempts=None):
+        """
         Args:
-            file: file - A file to process.
-            id: str - A unique id for the document. Optional. If none is provided
-                one will be generated.
+            concurrency: int - Optional. Number of documents to process at
+                once. Default DOCUMENT_QUEUE_WORKERS.
+            lease_duration: int - Optional. Seconds a claimed job's lease lasts
+                without renewal. Default INGEST_JOB_LEASE_SECONDS.
+            poll_interval: float - Optional. Seconds to wait before checking
+                for jobs again when there are none. Default
+                INGEST_POLL_INTERVAL_SECONDS.
+            max_attempts: int - Optional. Times a job may be claimed before
+                giving up on it. Default INGEST_JOB_MAX_ATTEMPTS.
         """
-        processor = DocumentProcessor(document)
-        await self.queue.put(processor)
+        self.concurrency = concurrency or DOCUMENT_QUEUE_WORKERS
+        self.lease_duration = datetime.timedelta(
+            seconds=lease_duration or INGEST_JOB_LEASE_SECONDS
+        )
+        self.poll_interval = poll_interval or INGEST_POLL_INTERVAL_SECONDS
+        self.max_attempts = max_attempts or INGEST_JOB_MAX_ATTEMPTS
+        self.name = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    async def run(self):
+        """Claim and process jobs until cancelled."""
+        print(f'Ingest worker {self.name} started ({self.concurrency} slots).')
+
+        num_recovered = await sync_to_async(recover_interrupted_ingests)()
+        if num_recovered:
+            print(f'Queued up {num_recovered} interrupted document(s) to resume.')
+
+        await asyncio.gather(
+            self.write_metrics_snapshots(),
+            *[self.process_jobs() for _ in range(self.concurrency)]
+        )
+
+    async def write_metrics_snapshots(self):
+        """Periodically write this process's LLM metrics out for the app to report."""
+        while True:
+            await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL_SECONDS)
+            try:
+                await asyncio.to_thread(llm_metrics.write_snapshot)
 
-        # Ensure the processing loop is running (in case it was idle).
-        if self.processing_task is None or self.processing_task.done():
-            self.processing_task = asyncio.create_task(self.process_queue())
+            except OSError as e:
+                print(f'Error writing metrics snapshot: {e}')
 
-    async def process_queue(self):
-        while not self.queue.empty():
-            processor = await self.queue.get()
+    async def process_jobs(self):
+        """Worker loop. Claim jobs and process them, one at a time."""
+        while True:
+            await close_stale_db_connections()
+            try:
+                await sync_to_async(IngestJob.fail_exhausted)(self.max_attempts)
+                job = await sync_to_async(IngestJob.claim_next)(
+                    self.name, self.lease_duration, self.max_attempts
+                )
+
+            except Exception as e:
+                # e.g. DB connection issues. Back off and try again, on a
+                # fresh connection if this one is broken.
+                print(f'Error claiming ingest job: {type(e)}: {e}')
+                await close_stale_db_connections()
+                job = None
+
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
 
             try:
-                await processor.process()
+                await self.process_job(job)
 
             except Exception as e:
-                print(e)
-                raise
-                pass
+                # e.g. the DB going away while recording the outcome. The job
+                # is reclaimed once its lease expires.
+                print(f'Error processing ingest job {job.id}: {type(e)}: {e}')
+                await close_stale_db_connections()
 
-            finally:
-                self.queue.task_done()
+    async def process_job(self, job):
+        """Process a claimed job's document, renewing the lease while at it.
+
+        If the lease is lost (e.g. it expired while the DB was unreachable and
+        another worker claimed the job), processing is stopped and the job is
+        left to its new holder.
+        """
+        processing = asyncio.create_task(self._process_job_document(job))
+        lease_renewal = None
+        try:
+            lease_renewal = asyncio.create_task(self._renew_lease(job, processing))
+            await processing
+
+        except asyncio.CancelledError:
+            # Cancelled by _renew_lease, which has then returned, or else by
+            # whatever cancelled this worker.
+            if lease_renewal is None or not lease_renewal.done() or lease_renewal.cancelled():
+                raise
 
+            print(f'Ingest worker {self.name} stopped processing job {job.id}.')
+
+        finally:
+            processing.cancel()
+            if lease_renewal is not None:
+                lease_renewal.cancel()
+
+    async def _process_job_document(self, job):
+        document = None
+        try:
+            document = await Document.objects.aget(id=job.document_id)
+            await DocumentProcessor(document).process()
+            await sync_to_async(job.finish)(IngestJobStatusCodes.DONE)
+
+        except Document.DoesNotExist:
+            # Deleted since it was queued.
+            await sync_to_async(job.finish)(IngestJobStatusCodes.DONE)
+
+        except Exception as e:
+            print(f'Error processing document {job.document_id}: {type(e)}: {e}')
+            await close_stale_db_connections()
+            await sync_to_async(job.finish)(
+                IngestJobStatusCodes.FAILED, f'{type(e)}: {e}'
+            )
+            if document is not None:
+                await self._mark_failed(document)
+
+    async def _renew_lease(self, job, processing):
+        """Renew job's lease until cancelled, cancelling processing if it's lost."""
+        # Renew well before expiry so a slow DB round trip doesn't lose it.
+        interval = self.lease_duration.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await sync_to_async(job.renew_lease)(self.lease_duration):
+                    print(f'Ingest worker {self.name} lost the lease on job {job.id}.')
+                    processing.cancel()
+                    return
 
-document_processor_queue = DocumentProcessorQueue()
+            except Exception as e:
+                print(f'Error renewing lease on job {job.id}: {e}')
+                await close_stale_db_connections()
+
+    async def _mark_failed(self, document):
+        """Flag a document whose processing failed outright as such."""
+        try:
+            document.status = 2
+            await document.asave()
+            await broadcast_document_update(document)
+
+        except Exception as e:
+            print(f'Error marking document {document.id} as failed: {e}')
@@ -6,8 +6,8 @@ import uuid
 
 from asgiref.sync import sync_to_async
 from pgvector.django import CosineDistance
-from quart import (Quart, render_template, redirect, request, jsonify, session,
-    url_for, send_from_directory, send_file, abort)
+from quart import (Quart, Response, render_template, redirect, request, jsonify,
+    session, url_for, send_from_directory, send_file, abort)
 
 # 1. The refactor to move the app definition to the app module was done to allow
 #    importing socket functionality from other places e.g. models, without cyclic
@@ -22,12 +22,19 @@ try:
 except ImportError:
     from app import app
 
-from db.models import Document, Page, User, calculate_embeddings
+from db.models import Document, Page, PageChunk, User, query_embedding_cache
 import env
-from processing import UnsupportedFileType, document_processor_queue, get_file_type, save_file
+from llm.metrics import llm_metrics, read_snapshots, render_prometheus
+from processing import (MAX_UPLOAD_SIZE, FileTooLarge, UnsupportedFileType,
+    enqueue_document, retry_failed_pages, save_file)
+from utils import (PAGE_IMAGE_DERIVATIVES, page_image_derivative_path,
+    save_page_image_derivatives)
 
 
 app.secret_key = os.environ.get('FLASK_SECRET_KEY')
+# Reject requests that are obviously too large up front, before reading the
+# body. Leaves some room for the rest of the multipart form.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 1024 * 1024
 
 
 UPLOAD_FOLDER = os.path.join(
@@ -35,6 +42,10 @@ UPLOAD_FOLDER = os.path.join(
     'media/'
 )
 
+# Most matching chunks to consider per semantic search. Lets the chunk
+# embedding index be used, rather than scanning every chunk.
+SEMANTIC_SEARCH_MAX_CHUNKS = int(os.environ.get('SEMANTIC_SEARCH_MAX_CHUNKS', 200))
+
 
 # To keep track of async tasks running in the bg
 # See note below on keeping a reference to tasks:
@@ -122,6 +133,88 @@ async def admin():
     return await render_template('admin.html')
 
 
+@app.route('/admin/metrics', methods=['GET'])
+@login_required(admin_required=True, json_response=True)
+async def metrics():
+    """LLM call metrics (see llm.metrics) in Prometheus' text format.
+
+    Covers this process and the ingest workers, labelled by process.
+    """
+    snapshots = [llm_metrics.snapshot()] + await asyncio.to_thread(read_snapshots)
+
+    return Response(
+        render_prometheus(snapshots),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+def _get_page_search_result(page):
+    return {
+        'document': {
+            'id': page.document.id,
+            'name': page.document.name,
+        },
+        'number': page.number,
+        'id': page.number,
+        'text': page.text,
+        'summary': page.summary,
+    }
+
+
+async def find_similar_pages(embedding, threshold):
+    """Return the pages whose text is semantically similar to an embedding.
+
+    Pages match on their text as a whole or on any of its chunks (see
+    db.models.PageChunk), and score as their best match (max pooling).
+
+    Args:
+        embedding: list of float - The embedding to compare against. None
+            matches nothing.
+        threshold: float - Minimum cosine similarity, between 0 and 1.
+
+    Returns:
+        list of (Page, float, list of dict): Each page, its score and its
+            matching chunks' start/end offsets into its text and scores, best
+            first. Pages are ordered by score, best first.
+    """
+    if embedding is None:
+        return []
+
+    max_distance = 1.0 - threshold
+    scores = {}
+    chunks = {}
+
+    chunk_matches = PageChunk.objects.annotate(
+        distance=CosineDistance('embedding', embedding)
+    ).filter(distance__lt=max_distance
+    ).order_by('distance'
+    ).values_list('page_id', 'start', 'end', 'distance')[:SEMANTIC_SEARCH_MAX_CHUNKS]
+
+    async for page_id, start, end, distance in chunk_matches:
+        score = 1.0 - distance
+        scores[page_id] = max(scores.get(page_id, 0.0), score)
+        chunks.setdefault(page_id, []).append({'start': start, 'end': end, 'score': score})
+
+    pages = {}
+    page_matches = Page.objects.annotate(
+        distance=CosineDistance('text_embeddings', embedding)
+    ).filter(distance__lt=max_distance
+    ).select_related('document')
+
+    async for page in page_matches:
+        pages[page.id] = page
+        scores[page.id] = max(scores.get(page.id, 0.0), 1.0 - page.distance)
+
+    # Pages that only matched on chunks.
+    async for page in Page.objects.filter(id__in=set(scores) - set(pages)).select_related('document'):
+        pages[page.id] = page
+
+    return sorted(
+        [(pages[id], score, chunks.get(id, [])) for id, score in scores.items() if id in pages],
+        key=lambda match: match[1], reverse=True
+    )
+
+
 @app.route('/search', methods=['POST'])
 @login_required(json_response=True)
 async def search():
@@ -138,6 +231,8 @@ async def search():
             # 1. Simple search:
             if search_mode == 'keyword':
                 queryset = Page.objects.filter(text__icontains=search_term).select_related('document')
+                async for page in queryset:
+                    results.append(_get_page_search_result(page))
 
             # 2. Semantic Search
             else:
@@ -147,27 +242,18 @@ async def search():
                     threshold = 0.5
 
                 print(threshold)
-                search_term_embedding = await asyncio.to_thread(calculate_embeddings, search_term)
-                queryset = Page.objects.alias(
-                    distance=CosineDistance('text_embeddings', search_term_embedding)
-                ).filter(distance__lt=(1.0 - threshold)
-                ).order_by('distance'
-                ).select_related('document')
-
-            async for page in queryset:
-                results.append(
-                    {
-                        'document': {
-                            'id': page.document.id,
-                            'name': page.document.name,
-                        },
-                        'number': page.number,
-                        'id': page.number,
-                        'number': page.number,
-                        'text': page.text,
-                        'summary': page.summary,
-                    }
-                )
+                # Cached, as the same query is searched repeatedly while the
+                # user types and adjusts the threshold.
+                search_term_embedding = await query_embedding_cache.aget(search_term)
+                for page, score, chunks in await find_similar_pages(search_term_embedding, threshold):
+                    results.append(
+                        {
+                            **_get_page_search_result(page),
+                            'score': score,
+                            # Offsets into text, for highlighting.
+                            'chunks': chunks,
+                        }
+                    )
 
     except (json.JSONDecodeError, KeyError) as e:
         print(e)
@@ -186,26 +272,29 @@ async def upload_file():
     if not file:
         return jsonify({"error": "No file provided."}), 400
 
-    filename = file.filename
     try:
-        file_type = await get_file_type(file)
         file_info = await save_file(file)
+        file_type = file_info['type']
 
         document = await Document.objects.acreate(
             id=document_id,
-            name=filename,
+            name=file_info['filename'],
             filepath=file_info['filepath'],
+            sha256=file_info['sha256'],
             type=1 if file_type == 'pdf' else 2 if file_type == 'image' else 0
         )
 
-        # TODO: Should this be in here? Document processing mishaps will be
-        # registered as status changes. If we're already here we're out of
-        # danger.
-        await document_processor_queue.enqueue(document)
+        # Processing happens in the ingest workers (python manage.py
+        # ingest_worker). Document processing mishaps will be registered as
+        # status changes. If we're already here we're out of danger.
+        await enqueue_document(document)
 
     except UnsupportedFileType as e:
         return jsonify({"error": str(e)}), 400
 
+    except FileTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
     except Exception as e:
         # TODO: Handle different error classes here appropriately.
         print(type(e), e)
@@ -255,16 +344,48 @@ async def document_detail(id):
         abort(404)
 
 
+@app.route('/document/<id>/retry', methods=['POST'])
+@login_required(admin_required=True, json_response=True)
+async def retry_document(id):
+    """Re-run processing for only the pages of a document that failed."""
+    try:
+        document = await Document.objects.aget(id=id)
+        num_pages = await retry_failed_pages(document)
+
+    except Document.DoesNotExist:
+        return jsonify({'error': 'Document not found.'}), 404
+
+    return jsonify({'message': f'{num_pages} failed page(s) of document {id} queued for processing.'})
+
+
 @app.route('/page/<document_id>/<number>', methods=['GET'])
 @login_required()
 async def serve_page_image(document_id, number):
+    """Serve a page's image.
+
+    Query Args:
+        size: str - Optional. 'thumbnail' or 'preview' for a smaller version
+            of the image (see utils.PAGE_IMAGE_DERIVATIVES). The full
+            resolution image is served otherwise.
+    """
+    size = request.args.get('size')
+
     try:
         page = await Page.objects.aget(document=document_id, number=number)
-        return await send_file(page.filepath)
 
     except Page.DoesNotExist:
         abort(404)
 
+    if size not in PAGE_IMAGE_DERIVATIVES:
+        return await send_file(page.filepath)
+
+    derivative_path = page_image_derivative_path(page.filepath, size)
+    # e.g. pages ingested before derivatives were introduced.
+    if not os.path.exists(derivative_path):
+        await asyncio.to_thread(save_page_image_derivatives, page.filepath)
+
+    return await send_file(derivative_path, mimetype='image/webp')
+
 
 @app.route('/page/<document_id>/<number>/info', methods=['GET'])
 @login_required(json_response=True)
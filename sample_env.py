@@ -15,3 +15,87 @@ os.environ.setdefault('POSTGRES_DB_USER', '')
 os.environ.setdefault('POSTGRES_DB_PASSWORD', '')
 os.environ.setdefault('POSTGRES_HOST', '')
 os.environ.setdefault('POSTGRES_PORT', '')
+
+# Ingest settings.
+# Max memory (MB) used by decoded page images at a time when splitting PDFs
+# (across all rasterization processes).
+os.environ.setdefault('RASTERIZATION_MEMORY_BUDGET_MB', '256')
+# Max number of pages of a document being parsed (LLM + embeddings) at once.
+os.environ.setdefault('PAGE_PARSE_CONCURRENCY', '4')
+# Number of documents processed at once by each ingest worker.
+os.environ.setdefault('DOCUMENT_QUEUE_WORKERS', '2')
+# Max concurrent calls per LLM provider / embedding backend, as name=limit pairs
+# e.g. 'google=8,openai=16,ollama=2'. Unlisted providers use the default limit
+# (unlimited if empty).
+os.environ.setdefault('LLM_CONCURRENCY_LIMITS', '')
+os.environ.setdefault('LLM_DEFAULT_CONCURRENCY_LIMIT', '')
+os.environ.setdefault('EMBEDDING_CONCURRENCY_LIMITS', 'ollama=4')
+os.environ.setdefault('EMBEDDING_DEFAULT_CONCURRENCY_LIMIT', '')
+# Ingest workers (python manage.py ingest_worker) claim queued documents with a
+# lease, renewed while they work. Jobs whose lease runs out are retried by
+# another worker, up to the max attempts.
+os.environ.setdefault('INGEST_JOB_LEASE_SECONDS', '120')
+os.environ.setdefault('INGEST_JOB_MAX_ATTEMPTS', '3')
+os.environ.setdefault('INGEST_POLL_INTERVAL_SECONDS', '2')
+# Max number of page parse results kept in the (DB) parse result cache.
+os.environ.setdefault('PARSE_CACHE_MAX_ENTRIES', '50000')
+# Max upload size. Keep in line with client_max_body_size in the Nginx config.
+os.environ.setdefault('MAX_UPLOAD_SIZE_MB', '50')
+# Number of processes PDF pages are rendered in (defaults to the number of CPUs)
+# and the format page images are saved in: PNG or WEBP (lossless).
+os.environ.setdefault('RASTERIZATION_WORKERS', '')
+os.environ.setdefault('PAGE_IMAGE_FORMAT', 'PNG')
+# Byte budget (KB) for each image sent to an LLM. JPEG quality is picked to fit.
+os.environ.setdefault('LLM_IMAGE_MAX_KB', '400')
+# Pages parsed per LLM request by long-context (Gemini 1.5) models.
+os.environ.setdefault('GEMINI_PAGE_BATCH_SIZE', '4')
+# Requests/tokens per minute per LLM provider or model, as
+# provider[/model]=rpm,tpm;... e.g. "google=360,4000000;openai/gpt-4o=500,30000".
+os.environ.setdefault('LLM_RATE_LIMITS', '')
+# Times to retry LLM requests that are rate limited or fail transiently.
+os.environ.setdefault('LLM_MAX_RETRIES', '5')
+# Pooled, kept alive connections to the Ollama server per process.
+os.environ.setdefault('OLLAMA_MAX_CONNECTIONS', '32')
+# Stream page parse responses and abandon malformed ones early (1) or not (0).
+os.environ.setdefault('PARSE_STREAMING', '1')
+# Vision models to parse pages with, in order of preference. Unconfigured ones,
+# and Ollama ones that haven't been pulled, are skipped.
+os.environ.setdefault('PAGE_PARSER_MODELS', 'gemini-1.5-pro-latest,gemini-1.5-flash-latest,gpt-4o-mini,llava:latest')
+# Send a hedged request to the next model once a request takes longer than
+# this percentile of the model's latencies (or the default delay, until enough
+# have been recorded).
+os.environ.setdefault('LLM_HEDGE_PERCENTILE', '95')
+os.environ.setdefault('LLM_HEDGE_DEFAULT_DELAY_SECONDS', '30')
+# Maximum requests in flight per prompt, hedges included. 1 disables hedging.
+os.environ.setdefault('LLM_MAX_REQUESTS_IN_FLIGHT', '2')
+# How often ingest workers write out their LLM metrics for /admin/metrics.
+# They go in LLM_METRICS_DIR (default: metrics/ in the project folder).
+os.environ.setdefault('METRICS_SNAPSHOT_INTERVAL_SECONDS', '15')
+# live, or record/replay to capture real LLM responses/embeddings into fixtures
+# (REPLAY_FIXTURES_DIR, default fixtures/replay/) or serve them back offline.
+os.environ.setdefault('LLM_BACKEND_MODE', 'live')
+os.environ.setdefault('EMBEDDING_BACKEND_MODE', 'live')
+# Synthetic latency for replayed responses: milliseconds, or "recorded".
+os.environ.setdefault('REPLAY_LATENCY_MS', '0')
+os.environ.setdefault('REPLAY_LATENCY_JITTER_MS', '0')
+# Texts are embedded in batches of up to this many texts/estimated tokens per
+# request. Pages saved within EMBEDDING_BATCH_WAIT_MS of each other share batches.
+os.environ.setdefault('EMBEDDING_BATCH_SIZE', '32')
+os.environ.setdefault('EMBEDDING_BATCH_MAX_TOKENS', '16384')
+os.environ.setdefault('EMBEDDING_BATCH_WAIT_MS', '10')
+# Embeddings are cached by text: up to this many in the DB (shared by all
+# processes; 0 disables) and this many in each process's memory.
+os.environ.setdefault('EMBEDDING_CACHE_MAX_ENTRIES', '500000')
+os.environ.setdefault('EMBEDDING_CACHE_MEMORY_ENTRIES', '10000')
+# Up to SEARCH_QUERY_LOG_MAX_ENTRIES search queries are logged (for `manage.py
+# warm_query_embeddings`), and the embeddings of QUERY_EMBEDDING_MEMORY_ENTRIES
+# kept in each process's memory, on top of the embedding cache.
+os.environ.setdefault('QUERY_EMBEDDING_MEMORY_ENTRIES', '2000')
+os.environ.setdefault('SEARCH_QUERY_LOG_MAX_ENTRIES', '100000')
+# Page text is also embedded in overlapping chunks of about this many
+# characters, for semantic search. Existing pages get chunks with
+# `manage.py backfill_embeddings`.
+os.environ.setdefault('PAGE_CHUNK_SIZE', '1000')
+os.environ.setdefault('PAGE_CHUNK_OVERLAP', '200')
+# Most matching chunks considered per semantic search.
+os.environ.setdefault('SEMANTIC_SEARCH_MAX_CHUNKS', '200')
@@ -1,3 +1,8 @@
+import asyncio
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
 from quart import websocket
 
 # See reasoning in routes.py
@@ -6,9 +11,18 @@ try:
 except ImportError:
     from app import app
 
+from db.models import Document, DocumentStatusCodes
+
 # To keep track of socket connections.
 connected_clients = {}
 
+# Documents are processed by ingest workers in other processes, which can't
+# broadcast to this process' clients directly, so check for status changes at
+# this interval while there are clients to tell.
+STATUS_POLL_INTERVAL_SECONDS = 3
+STATUS_POLL_OVERLAP = datetime.timedelta(seconds=STATUS_POLL_INTERVAL_SECONDS)
+status_watcher_task = None
+
 
 @app.websocket('/ws/status/')
 async def status_socket():
@@ -16,6 +30,10 @@ async def status_socket():
     client_id = await websocket.receive()
     connected_clients[client_id] = websocket._get_current_object()
 
+    global status_watcher_task
+    if status_watcher_task is None or status_watcher_task.done():
+        status_watcher_task = asyncio.create_task(watch_document_statuses())
+
     # Acknowldege connection.
     await websocket.send_json({'action': 'connection-ack'})
 
@@ -42,3 +60,42 @@ async def broadcast_document_update(document):
               }
             }
         )
+
+
+async def watch_document_statuses():
+    """Broadcast status changes of documents being processed, while clients are connected.
+
+    Documents that were processing at the last poll, or whose ingest jobs have
+    been updated since, are checked against their status at the last poll. The
+    latter catches documents processed in full between two polls.
+    """
+    # Statuses of the documents checked at the last poll.
+    statuses = {}
+    last_poll_time = timezone.now()
+    while connected_clients:
+        poll_time = timezone.now()
+        processing = [
+            document_id for document_id, status in statuses.items()
+            if status == DocumentStatusCodes.PROCESSING
+        ]
+        try:
+            documents = Document.objects.filter(
+                Q(status=DocumentStatusCodes.PROCESSING)
+                | Q(id__in=processing)
+                # Overlaps the last poll, in case workers' clocks are behind.
+                | Q(ingest_jobs__time_updated__gte=last_poll_time - STATUS_POLL_OVERLAP)
+            ).distinct()
+            new_statuses = {}
+            async for document in documents:
+                if document.status != statuses.get(document.id, DocumentStatusCodes.PROCESSING):
+                    await broadcast_document_update(document)
+
+                new_statuses[document.id] = document.status
+
+            statuses = new_statuses
+            last_poll_time = poll_time
+
+        except Exception as e:
+            print(f'Error checking document statuses: {e}')
+
+        await asyncio.sleep(STATUS_POLL_INTERVAL_SECONDS)
@@ -39,6 +39,16 @@ fi
  # Apply db migrations.
 python manage.py migrate
 
+# Start ingest workers (document processing) in the background. More can be
+# run on other machines against the same database:
+#     python manage.py ingest_worker
+INGEST_WORKER_PROCESSES=${INGEST_WORKER_PROCESSES:-1}
+i=0
+while [ "$i" -lt "$INGEST_WORKER_PROCESSES" ]; do
+    python manage.py ingest_worker >> "$LOG_DIR/ingest_worker.log" 2>&1 &
+    i=$((i + 1))
+done
+
 # Start Hypercorn with different logging configurations based on DEBUG flag.
 if [ "$DEBUG" = "1" ]; then
     echo "\nServer running in DEBUG mode. Set the DEBUG environment variable to 0 in production!\n"
@@ -78,7 +78,7 @@ function displayPage(pageNumber) {
   }
 
   let pageImage = document.createElement("img");
-  pageImage.src = `${PAGE_IMAGE_ENDPOINT_PREFIX}/${DOCUMENT_ID}/${pageNumber}`;
+  pageImage.src = `${PAGE_IMAGE_ENDPOINT_PREFIX}/${DOCUMENT_ID}/${pageNumber}?size=preview`;
   pageDisplay.appendChild(pageImage);
 }
 
@@ -94,6 +94,13 @@ async function updateSearchResults() {
     let resultText = result.text;
     if (getSelectedSearchMode() == "keyword") {
       resultText = highlightTermInText(searchTerm, result.text);
+    } else if (result.chunks && result.chunks.length > 0) {
+      // Chunks come best first. Highlight the passage that matched best.
+      resultText = highlightSpanInText(
+        result.text,
+        result.chunks[0].start,
+        result.chunks[0].end,
+      );
     }
     resultsBox.innerHTML += `
       <a href="${DOCUMENT_ENDPOINT_PREFIX}/${result.document.id}#${result.number}">
@@ -186,3 +193,27 @@ function highlightTermInText(term, text) {
 
   return text.replace(regex, '<span class="highlight">$1</span>');
 }
+
+/* Highlight a span of a piece of text, given by offsets.
+
+  @param {string} text - The text within which to highlight the span.
+  @param {number} start - Offset of the span's first character.
+  @param {number} end - Offset just past the span's last character.
+
+  @returns {string} - The text with the span surrounded with a <span> with a
+    class that can be styled to achieve the highlight.
+*/
+function highlightSpanInText(text, start, end) {
+  if (!text) return text;
+
+  // Offsets are in Unicode code points (as in Python), which JS string
+  // indices aren't, so index by code point.
+  const characters = Array.from(text);
+  return (
+    characters.slice(0, start).join("") +
+    '<span class="highlight">' +
+    characters.slice(start, end).join("") +
+    "</span>" +
+    characters.slice(end).join("")
+  );
+}
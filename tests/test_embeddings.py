@@ -0,0 +1,79 @@
+import unittest
+
+try:
+    from db.models import batch_texts, chunk_text, estimate_embedding_tokens
+
+except ImportError:
+    # Needs Django, pgvector, ollama and an env.py (see sample_env.py).
+    batch_texts = chunk_text = estimate_embedding_tokens = None
+
+
+@unittest.skipIf(chunk_text is None, 'db.models is not importable here')
+class ChunkTextTest(unittest.TestCase):
+
+    def test_empty_text(self):
+        self.assertEqual(chunk_text(None), [])
+        self.assertEqual(chunk_text(''), [])
+
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(chunk_text('A short page.', size=100, overlap=20), [(0, 13)])
+
+    def test_chunks_cover_the_text_and_overlap(self):
+        text = ' '.join(f'word{number}' for number in range(500))
+        spans = chunk_text(text, size=100, overlap=20)
+
+        self.assertEqual(spans[0][0], 0)
+        self.assertEqual(spans[-1][1], len(text))
+        for (start, end), (next_start, next_end) in zip(spans, spans[1:]):
+            self.assertLessEqual(end - start, 100)
+            self.assertLess(start, next_start)
+            self.assertLess(next_start, end)
+            self.assertGreaterEqual(end - next_start, 10)
+
+    def test_chunks_dont_cut_words(self):
+        text = ' '.join(f'word{number}' for number in range(500))
+        for start, end in chunk_text(text, size=100, overlap=20):
+            self.assertTrue(start == 0 or text[start - 1] == ' ')
+            self.assertTrue(end == len(text) or text[end] == ' ')
+
+    def test_text_without_whitespace_is_cut_at_size(self):
+        spans = chunk_text('x' * 250, size=100, overlap=20)
+
+        self.assertEqual(spans, [(0, 100), (80, 180), (160, 250)])
+
+    def test_overlap_larger_than_size_still_advances(self):
+        spans = chunk_text('x' * 30, size=10, overlap=50)
+
+        self.assertEqual(spans[-1][1], 30)
+        self.assertEqual([start for start, _ in spans], list(range(len(spans))))
+
+
+@unittest.skipIf(batch_texts is None, 'db.models is not importable here')
+class BatchTextsTest(unittest.TestCase):
+
+    def test_batches_by_count(self):
+        texts = [f'text {number}' for number in range(7)]
+        batches = list(batch_texts(texts, batch_size=3, max_tokens=1000))
+
+        self.assertEqual(batches, [texts[0:3], texts[3:6], texts[6:7]])
+
+    def test_batches_by_tokens(self):
+        texts = ['x' * 39] * 5  # 10 tokens each.
+        batches = list(batch_texts(texts, batch_size=100, max_tokens=25))
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        for batch in batches:
+            self.assertLessEqual(sum(estimate_embedding_tokens(text) for text in batch), 25)
+
+    def test_oversized_texts_get_a_batch_of_their_own(self):
+        texts = ['short', 'x' * 1000, 'short']
+        batches = list(batch_texts(texts, batch_size=100, max_tokens=25))
+
+        self.assertEqual(batches, [['short'], ['x' * 1000], ['short']])
+
+    def test_no_texts(self):
+        self.assertEqual(list(batch_texts([], batch_size=10, max_tokens=100)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import unittest
+
+from llm.json_stream import IncrementalJSONValidator, JSONStreamError
+
+
+def validate(chunks, field_types=None):
+    validator = IncrementalJSONValidator(field_types)
+    for chunk in chunks:
+        validator.feed(chunk)
+
+    validator.finish()
+    return validator
+
+
+class IncrementalJSONValidatorTest(unittest.TestCase):
+
+    def test_valid_objects(self):
+        for text in [
+            '{}',
+            ' { } \n',
+            '{"text": "A \\"quoted\\" \\u00e9 \\n line", "count": -12.5e+3}',
+            '{"a": [1, 2.0, [], {}], "b": {"c": [true, false, null]}, "d": 0}',
+            json.dumps({'text': 'x' * 100, 'pages': [{'number': 1, 'text': None}]}),
+        ]:
+            with self.subTest(text=text):
+                self.assertTrue(validate([text]).complete)
+
+    def test_valid_object_in_single_character_chunks(self):
+        text = '{"text": "caf\\u00e9", "n": 10, "ok": true, "items": [null, -1]}'
+        self.assertTrue(validate(list(text)).complete)
+
+    def test_truncated_streams(self):
+        text = '{"text": "abc", "n": 12, "items": [true, null]}'
+        for end in range(len(text)):
+            with self.subTest(truncated_at=end):
+                validator = IncrementalJSONValidator()
+                validator.feed(text[:end])
+                self.assertFalse(validator.complete)
+                with self.assertRaises(JSONStreamError):
+                    validator.finish()
+
+    def test_malformed_streams(self):
+        for text in [
+            'Sure! {"text": "a"}',
+            '[1, 2]',
+            '"text"',
+            '{text: "a"}',
+            '{"text" "a"}',
+            '{"text": "a",}',
+            '{"text": "a" "b": 1}',
+            '{"a": [1, 2}',
+            '{"a": tru}',
+            '{"a": nul1}',
+            '{"a": 01}',
+            '{"a": 1.}',
+            '{"a": "\\x"}',
+            '{"a": "\\u12g4"}',
+            '{"a": "line\nbreak"}',
+            '{"a": 1} trailing',
+            '{"a": 1}{}',
+        ]:
+            with self.subTest(text=text):
+                with self.assertRaises(JSONStreamError):
+                    validate([text])
+
+    def test_fails_at_the_first_invalid_chunk(self):
+        validator = IncrementalJSONValidator()
+        validator.feed('{"text": "a", ')
+
+        with self.assertRaises(JSONStreamError) as context:
+            validator.feed('oops')
+
+        self.assertEqual(context.exception.position, len('{"text": "a", '))
+
+    def test_field_types(self):
+        field_types = {'text': {'string', 'null'}, 'pages': {'array'}}
+
+        validate(['{"text": null, "pages": [], "other": 1}'], field_types)
+        validate(['{"text": "a", "nested": {"text": 1}}'], field_types)
+
+        for text in ['{"text": 1}', '{"pages": {}}', '{"text": ["a"]}']:
+            with self.subTest(text=text):
+                with self.assertRaises(JSONStreamError):
+                    validate([text], field_types)
+
+    def test_field_type_checked_as_the_value_starts(self):
+        validator = IncrementalJSONValidator({'text': {'string'}})
+        validator.feed('{"te')
+        validator.feed('xt": ')
+
+        with self.assertRaises(JSONStreamError):
+            validator.feed('4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from llm.limits import ConcurrencyLimiter, Slots, parse_limits
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out')
+
+        time.sleep(0.001)
+
+
+class ParseLimitsTest(unittest.TestCase):
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(' Google=8, ollama=2,'), {'google': 8, 'ollama': 2})
+
+        with self.assertRaises(ValueError):
+            parse_limits('google')
+
+
+class SlotsTest(unittest.TestCase):
+
+    def test_threads_are_handed_slots_in_order(self):
+        slots = Slots(1)
+        slots.acquire()
+        order = []
+
+        def take(number):
+            slots.acquire()
+            order.append(number)
+            slots.release()
+
+        threads = []
+        for number in range(5):
+            thread = threading.Thread(target=take, args=(number,))
+            thread.start()
+            threads.append(thread)
+            wait_for(lambda: len(slots._waiters) == number + 1)
+
+        slots.release()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(order, list(range(5)))
+        self.assertEqual(slots._available, 1)
+
+    def test_coroutines_are_handed_slots_in_order(self):
+        async def main():
+            slots = Slots(1)
+            await slots.aacquire()
+            order = []
+
+            async def take(number):
+                await slots.aacquire()
+                order.append(number)
+                slots.release()
+
+            tasks = []
+            for number in range(5):
+                tasks.append(asyncio.create_task(take(number)))
+                await asyncio.sleep(0)
+
+            slots.release()
+            await asyncio.gather(*tasks)
+
+            self.assertEqual(order, list(range(5)))
+            self.assertEqual(slots._available, 1)
+
+        asyncio.run(main())
+
+    def test_threads_and_coroutines_share_slots(self):
+        slots = Slots(2)
+        in_use = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def use():
+            nonlocal in_use, peak
+            with lock:
+                in_use += 1
+                peak = max(peak, in_use)
+
+            time.sleep(0.002)
+            with lock:
+                in_use -= 1
+
+        def thread_worker():
+            for _ in range(10):
+                slots.acquire()
+                try:
+                    use()
+
+                finally:
+                    slots.release()
+
+        async def coroutine_worker():
+            for _ in range(10):
+                await slots.aacquire()
+                try:
+                    await asyncio.to_thread(use)
+
+                finally:
+                    slots.release()
+
+        async def loop_main():
+            await asyncio.gather(*(coroutine_worker() for _ in range(3)))
+
+        threads = [threading.Thread(target=thread_worker) for _ in range(3)]
+        threads += [threading.Thread(target=asyncio.run, args=(loop_main(),)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join(30)
+
+        self.assertLessEqual(peak, 2)
+        self.assertEqual(slots._available, 2)
+        self.assertFalse(slots._waiters)
+
+    def test_cancelled_waiter_gives_up_its_place(self):
+        async def main():
+            slots = Slots(1)
+            await slots.aacquire()
+
+            cancelled = asyncio.create_task(slots.aacquire())
+            waiting = asyncio.create_task(slots.aacquire())
+            await asyncio.sleep(0)
+
+            cancelled.cancel()
+            await asyncio.sleep(0)
+            self.assertTrue(cancelled.cancelled())
+            self.assertEqual(len(slots._waiters), 1)
+
+            slots.release()
+            await asyncio.wait_for(waiting, 5)
+            slots.release()
+            self.assertEqual(slots._available, 1)
+
+        asyncio.run(main())
+
+    def test_waiter_cancelled_after_being_handed_a_slot_passes_it_on(self):
+        async def main():
+            slots = Slots(1)
+            await slots.aacquire()
+
+            cancelled = asyncio.create_task(slots.aacquire())
+            waiting = asyncio.create_task(slots.aacquire())
+            await asyncio.sleep(0)
+
+            # The slot is handed over, but the waiter is cancelled before it
+            # wakes up to take it.
+            slots.release()
+            cancelled.cancel()
+
+            await asyncio.wait_for(waiting, 5)
+            self.assertTrue(cancelled.cancelled())
+            self.assertFalse(slots._waiters)
+
+            slots.release()
+            self.assertEqual(slots._available, 1)
+
+        asyncio.run(main())
+
+    def test_waiters_on_closed_loops_are_skipped(self):
+        slots = Slots(1)
+        slots.acquire()
+
+        loop = asyncio.new_event_loop()
+        abandoned = loop.create_task(slots.aacquire())
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+        thread = threading.Thread(target=slots.acquire)
+        thread.start()
+        wait_for(lambda: len(slots._waiters) == 2)
+
+        slots.release()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(abandoned.done())
+        self.assertFalse(slots._waiters)
+
+        # It never finishes, by design.
+        abandoned._log_destroy_pending = False
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+
+    def test_limits_by_name(self):
+        limiter = ConcurrencyLimiter({'Google': 1}, default=None)
+
+        with limiter.limit('google'):
+            self.assertEqual(limiter._get_slots('GOOGLE')._available, 0)
+
+        self.assertEqual(limiter._get_slots('google')._available, 1)
+        self.assertIsNone(limiter._get_slots('ollama'))
+
+    def test_stream_holds_a_slot_until_closed(self):
+        limiter = ConcurrencyLimiter(default=1)
+        slots = limiter._get_slots('ollama')
+
+        chunks = limiter.limit_stream('ollama', iter(['a', 'b']))
+        self.assertEqual(next(chunks), 'a')
+        self.assertEqual(slots._available, 0)
+
+        chunks.close()
+        self.assertEqual(slots._available, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
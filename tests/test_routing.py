@@ -0,0 +1,257 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from llm.json_stream import IncrementalJSONValidator, JSONStreamError
+from llm.routing import LatencyHistogram, ModelRouter, latency_histograms, routed_model
+
+_model_numbers = itertools.count()
+
+
+class StubModel():
+    """Stands in for a Model, answering prompts with a fixed response.
+
+    Args:
+        response: str or Exception - What to answer, or raise.
+        delay: float - Seconds to take answering (or before the first chunk).
+        chunks: list of str - What to stream, if not the response in one chunk.
+    """
+    def __init__(self, response='ok', delay=0, chunks=None, output_token_limit=8192, page_batch_size=1):
+        # Unique names, as latencies are recorded per model name.
+        self.name = f'stub-{next(_model_numbers)}'
+        self.response = response
+        self.delay = delay
+        self.chunks = chunks
+        self.output_token_limit = output_token_limit
+        self.input_token_limit = 100000
+        self.page_batch_size = page_batch_size
+        self.available = True
+        self.calls = []
+        self.closed = threading.Event()
+
+    def run_prompt(self, stream=False, **kwargs):
+        self.calls.append(kwargs)
+        time.sleep(self.delay)
+        if isinstance(self.response, Exception):
+            raise self.response
+
+        if not stream:
+            return self.response
+
+        return self._stream()
+
+    def _stream(self):
+        try:
+            yield from self.chunks or [self.response]
+
+        finally:
+            self.closed.set()
+
+    async def arun_prompt(self, stream=False, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        if isinstance(self.response, Exception):
+            raise self.response
+
+        if not stream:
+            return self.response
+
+        return self._astream()
+
+    async def _astream(self):
+        try:
+            for chunk in self.chunks or [self.response]:
+                yield chunk
+
+        finally:
+            self.closed.set()
+
+
+def validate_json(response):
+    json.loads(response)
+
+
+class ModelRouterTest(unittest.TestCase):
+
+    def test_uses_the_first_model(self):
+        first, second = StubModel('first'), StubModel('second')
+        router = ModelRouter([first, second])
+
+        self.assertEqual(router.run_prompt('hi'), 'first')
+        self.assertIs(routed_model.get(), first)
+        self.assertFalse(second.calls)
+
+    def test_fails_over_on_errors(self):
+        first, second = StubModel(RuntimeError('down')), StubModel('second')
+        router = ModelRouter([first, second])
+
+        self.assertEqual(router.run_prompt('hi'), 'second')
+        self.assertIs(routed_model.get(), second)
+        self.assertEqual(latency_histograms.get(first.name, 'response').errors, 1)
+
+    def test_fails_over_on_invalid_responses(self):
+        router = ModelRouter([StubModel('not json'), StubModel('{"text": "a"}')], validator=validate_json)
+        self.assertEqual(router.run_prompt('hi'), '{"text": "a"}')
+
+    def test_raises_the_last_error_if_all_fail(self):
+        router = ModelRouter([StubModel(RuntimeError('first')), StubModel(KeyError('last'))])
+        with self.assertRaises(KeyError):
+            router.run_prompt('hi')
+
+    def test_hedges_slow_models(self):
+        slow, fast = StubModel('slow', delay=1), StubModel('fast')
+        router = ModelRouter([slow, fast])
+
+        start_time = time.monotonic()
+        with mock.patch('llm.routing.HEDGE_DEFAULT_DELAY', 0.05):
+            self.assertEqual(router.run_prompt('hi'), 'fast')
+
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        self.assertIs(routed_model.get(), fast)
+
+    def test_hedge_delay_follows_recorded_latencies(self):
+        model = StubModel()
+        router = ModelRouter([model], hedge_percentile=50)
+        with mock.patch('llm.routing.HEDGE_DEFAULT_DELAY', 30):
+            self.assertEqual(router.hedge_delay(model, 'response'), 30)
+
+            histogram = latency_histograms.get(model.name, 'response')
+            for _ in range(20):
+                histogram.record(1.0)
+
+            self.assertAlmostEqual(router.hedge_delay(model, 'response'), 1.0, delta=0.25)
+            # Kept apart from requests with a different number of images.
+            self.assertEqual(router.hedge_delay(model, 'response', num_images=4), 30)
+
+    def test_no_hedging_with_one_request_in_flight(self):
+        slow, fast = StubModel('slow', delay=0.2), StubModel('fast')
+        router = ModelRouter([slow, fast], max_requests_in_flight=1)
+
+        with mock.patch('llm.routing.HEDGE_DEFAULT_DELAY', 0.01):
+            self.assertEqual(router.run_prompt('hi'), 'slow')
+
+        self.assertFalse(fast.calls)
+
+    def test_caps_max_tokens_per_model(self):
+        model = StubModel(output_token_limit=100)
+        ModelRouter([model]).run_prompt('hi', max_tokens=500)
+
+        self.assertEqual(model.calls[0]['max_tokens'], 100)
+
+    def test_skips_models_that_take_fewer_images(self):
+        single_page, multi_page = StubModel('single'), StubModel('multi', page_batch_size=4)
+        router = ModelRouter([single_page, multi_page])
+
+        self.assertEqual(router.run_prompt('hi', images=['a', 'b']), 'multi')
+        self.assertFalse(single_page.calls)
+        self.assertEqual(router.run_prompt('hi', images=['a']), 'single')
+
+        with self.assertRaises(ValueError):
+            router.run_prompt('hi', images=['a'] * 5)
+
+    def test_streams_fail_over_until_the_first_chunk(self):
+        first, second = StubModel(RuntimeError('down')), StubModel(chunks=['a', 'b'])
+        router = ModelRouter([first, second])
+
+        self.assertEqual(list(router.run_prompt('hi', stream=True)), ['a', 'b'])
+        self.assertTrue(second.closed.is_set())
+
+    def test_validated_streams_fail_over_on_the_first_bad_chunk(self):
+        bad = StubModel(chunks=['{"text": ', '12', '"never read"'])
+        good = StubModel(chunks=['{"text": ', '"a"}'])
+        router = ModelRouter(
+            [bad, good], validator=validate_json,
+            stream_validator=lambda: IncrementalJSONValidator({'text': {'string'}})
+        )
+
+        self.assertEqual(list(router.run_prompt('hi', stream=True)), ['{"text": "a"}'])
+        self.assertIs(routed_model.get(), good)
+        self.assertTrue(bad.closed.is_set())
+
+    def test_validated_streams_keep_the_bad_response(self):
+        router = ModelRouter(
+            [StubModel(chunks=['{"text": ', '"a"'])],
+            stream_validator=IncrementalJSONValidator
+        )
+
+        with self.assertRaises(JSONStreamError) as context:
+            list(router.run_prompt('hi', stream=True))
+
+        self.assertEqual(context.exception.response, '{"text": "a"')
+
+
+class AsyncModelRouterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fails_over_on_errors(self):
+        first, second = StubModel(RuntimeError('down')), StubModel('second')
+        router = ModelRouter([first, second])
+
+        self.assertEqual(await router.arun_prompt('hi'), 'second')
+        self.assertIs(routed_model.get(), second)
+
+    async def test_raises_the_last_error_if_all_fail(self):
+        router = ModelRouter([StubModel(RuntimeError('first')), StubModel(KeyError('last'))])
+        with self.assertRaises(KeyError):
+            await router.arun_prompt('hi')
+
+    async def test_hedges_slow_models_and_cancels_the_loser(self):
+        slow, fast = StubModel('slow', delay=5), StubModel('fast')
+        router = ModelRouter([slow, fast])
+
+        start_time = time.monotonic()
+        with mock.patch('llm.routing.HEDGE_DEFAULT_DELAY', 0.05):
+            self.assertEqual(await router.arun_prompt('hi'), 'fast')
+
+        self.assertLess(time.monotonic() - start_time, 1)
+        self.assertIs(routed_model.get(), fast)
+
+        await asyncio.sleep(0)
+        self.assertFalse([
+            task for task in asyncio.all_tasks()
+            if task is not asyncio.current_task() and not task.done()
+        ])
+
+    async def test_hedged_streams_use_the_first_to_respond(self):
+        slow = StubModel(chunks=['slow'], delay=0.2)
+        fast = StubModel(chunks=['fast'])
+        router = ModelRouter([slow, fast])
+
+        with mock.patch('llm.routing.HEDGE_DEFAULT_DELAY', 0.05):
+            chunks = await router.arun_prompt('hi', stream=True)
+            self.assertEqual([chunk async for chunk in chunks], ['fast'])
+
+        self.assertIs(routed_model.get(), fast)
+        self.assertEqual(len(slow.calls), 1)
+        self.assertTrue(fast.closed.is_set())
+
+    async def test_validated_streams_fail_over_on_the_first_bad_chunk(self):
+        bad = StubModel(chunks=['[', '"never read"'])
+        good = StubModel(chunks=['{"text": ', '"a"}'])
+        router = ModelRouter([bad, good], stream_validator=IncrementalJSONValidator)
+
+        chunks = await router.arun_prompt('hi', stream=True)
+        self.assertEqual([chunk async for chunk in chunks], ['{"text": "a"}'])
+        self.assertTrue(bad.closed.is_set())
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+
+        for latency in [0.01] * 90 + [10] * 10:
+            histogram.record(latency)
+
+        self.assertEqual(histogram.percentile(50), LatencyHistogram.MIN_LATENCY)
+        self.assertGreaterEqual(histogram.percentile(95), 10)
+        self.assertLess(histogram.percentile(95), 10 * LatencyHistogram.GROWTH_FACTOR)
+        self.assertEqual(histogram.snapshot()['count'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+from unittest import mock
+
+from llm.scheduler import RequestScheduler, TokenBucket, parse_rate_limits
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('llm.scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_wait_while_there_are_tokens(self):
+        bucket = TokenBucket(60, period=60)
+        for _ in range(60):
+            self.assertEqual(bucket.reserve(1), 0)
+
+    def test_debt_is_waited_off_in_order(self):
+        bucket = TokenBucket(60, period=60)  # 1 token a second.
+        bucket.reserve(60)
+
+        # Each caller waits for the ones before it.
+        self.assertAlmostEqual(bucket.reserve(1), 1)
+        self.assertAlmostEqual(bucket.reserve(1), 2)
+        self.assertAlmostEqual(bucket.reserve(3), 5)
+        self.assertAlmostEqual(bucket.tokens, -5)
+
+    def test_refill_pays_off_debt(self):
+        bucket = TokenBucket(60, period=60)
+        bucket.reserve(60)
+        bucket.reserve(10)
+
+        self.clock.now += 4
+        self.assertAlmostEqual(bucket.reserve(0), 6)
+
+        self.clock.now += 6
+        self.assertEqual(bucket.reserve(0), 0)
+
+    def test_refill_is_capped_at_capacity(self):
+        bucket = TokenBucket(10, period=1)
+        self.clock.now += 3600
+
+        self.assertEqual(bucket.reserve(10), 0)
+        self.assertAlmostEqual(bucket.reserve(10), 1)
+
+    def test_oversized_reservations_are_capped_at_capacity(self):
+        bucket = TokenBucket(100, period=60)
+        bucket.reserve(100)
+
+        self.assertAlmostEqual(bucket.reserve(10 ** 6), 60)
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('llm.scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_rate_limits(self):
+        self.assertEqual(
+            parse_rate_limits('Google=360,4000000; openai/gpt-4o-mini=500,;ollama=,1000'),
+            {
+                'google': (360, 4000000),
+                'openai/gpt-4o-mini': (500, None),
+                'ollama': (None, 1000),
+            }
+        )
+
+        with self.assertRaises(ValueError):
+            parse_rate_limits('google')
+
+    def test_reserve_waits_for_the_tighter_limit(self):
+        scheduler = RequestScheduler({'google': (60, 600)})
+
+        self.assertEqual(scheduler.reserve('Google', 'gemini', 600), 0)
+        # 1 request a second, but 10 tokens a second: the token debt is longer.
+        self.assertAlmostEqual(scheduler.reserve('Google', 'gemini', 100), 10)
+
+    def test_model_limits_take_precedence(self):
+        scheduler = RequestScheduler({'openai': (1, None), 'openai/gpt-4o-mini': (60, None)})
+
+        scheduler.reserve('OpenAI', 'gpt-4o-mini', 0)
+        self.assertAlmostEqual(scheduler.reserve('OpenAI', 'gpt-4o-mini', 0), 0)
+
+        scheduler.reserve('OpenAI', 'gpt-4o', 0)
+        self.assertAlmostEqual(scheduler.reserve('OpenAI', 'gpt-4o', 0), 60)
+
+    def test_unlimited_providers_are_not_paced(self):
+        scheduler = RequestScheduler({'google': (1, None)})
+        for _ in range(10):
+            self.assertEqual(scheduler.reserve('Ollama', 'llava', 10 ** 6), 0)
+
+    def test_retries_then_raises(self):
+        scheduler = RequestScheduler(max_retries=2, base_delay=0)
+        request = mock.Mock(side_effect=ConnectionError('down'))
+
+        with self.assertRaises(ConnectionError):
+            scheduler.run('Ollama', 'llava', request, classify_error=lambda e: (True, None))
+
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(scheduler.stats()['Ollama/llava']['retries'], 2)
+        self.assertEqual(scheduler.stats()['Ollama/llava']['failures'], 1)
+
+    def test_retry_after_is_honoured(self):
+        scheduler = RequestScheduler(base_delay=0)
+        self.assertEqual(scheduler.backoff_delay(1, retry_after=7), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,40 @@
 import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import os
 
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image as PILImage
+
+from image import Image
+
+
+# Upper bound on the memory taken up by decoded page images at any one time
+# while rasterizing a PDF, across all rasterization processes. Pages are
+# rendered in windows sized to fit this.
+RASTERIZATION_MEMORY_BUDGET = int(
+    os.environ.get('RASTERIZATION_MEMORY_BUDGET_MB', 256)
+) * 1024 * 1024
+
+# Number of processes PDF pages are rendered and encoded in.
+RASTERIZATION_WORKERS = int(
+    os.environ.get('RASTERIZATION_WORKERS', '').strip() or os.cpu_count() or 1
+)
+
+# Format page images are saved in: 'PNG' or 'WEBP' (lossless).
+PAGE_IMAGE_FORMAT = os.environ.get('PAGE_IMAGE_FORMAT', 'PNG').upper()
+
+# Smaller versions of page images saved alongside them for the page viewer, so
+# it doesn't have to load full resolution images: name -> longest side in px.
+PAGE_IMAGE_DERIVATIVES = {
+    'thumbnail': 240,
+    'preview': 1600,
+}
+PAGE_IMAGE_DERIVATIVE_QUALITY = 80
+
+# Used when pdfinfo doesn't report a page size: US letter, in points.
+DEFAULT_PAGE_SIZE_PTS = (612, 792)
 
 
 async def save_image(image, save_path):
@@ -14,37 +47,225 @@ async def save_image(image, save_path):
     await asyncio.to_thread(image.save, save_path, 'PNG')
 
 
-async def save_pdf_as_images(pdf_path, output_folder, dpi=200):
-    """Given a PDF file path convert and save its pages as images.
+def estimate_page_image_size(pdf_info, dpi):
+    """Estimate how much memory a decoded page image will take up.
 
     Args:
-        pdf_path: str - Path to the PDF file.
-        output_folder: str - Path of folter to save images to.
-        dpi: int - Capture resolution. Default 200.
+        pdf_info: dict - Output of pdf2image.pdfinfo_from_path.
+        dpi: int - Capture resolution.
+
+    Returns:
+        int - Estimated size of a single RGB page image, in bytes.
     """
-    images = await asyncio.to_thread(convert_from_path, pdf_path, dpi=dpi)
+    # pdfinfo reports the size of the first page, e.g. '612 x 792 pts (letter)'.
+    try:
+        width, _, height = pdf_info.get('Page size', '').split()[:3]
+        width, height = float(width), float(height)
 
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    except ValueError:
+        width, height = DEFAULT_PAGE_SIZE_PTS
+
+    # 72 points to an inch, 3 bytes (RGB) per pixel.
+    return int((width / 72 * dpi) * (height / 72 * dpi) * 3)
+
+
+# Created on first use. See get_rasterization_pool.
+_rasterization_pool = None
+
+
+def get_rasterization_pool():
+    """Return the process pool that PDF pages are rendered in.
+
+    Processes are spawned rather than forked, as forking a process that is
+    running an event loop and threads (DB, LLM calls) is asking for trouble.
+    """
+    global _rasterization_pool
+    if _rasterization_pool is None:
+        _rasterization_pool = ProcessPoolExecutor(
+            max_workers=RASTERIZATION_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    return _rasterization_pool
+
+
+def page_image_derivative_path(filepath, size):
+    """Return the path of a derivative (see PAGE_IMAGE_DERIVATIVES) of a page image.
+
+    Args:
+        filepath: str - Path to the page image.
+        size: str - Name of the derivative, e.g. 'thumbnail'.
+
+    Returns:
+        str - Path to the derivative, next to the page image.
+    """
+    return f'{os.path.splitext(filepath)[0]}.{size}.webp'
+
+
+def save_page_image_derivatives(filepath, image=None):
+    """Save the derivatives of a page image (see PAGE_IMAGE_DERIVATIVES) next to it.
+
+    Args:
+        filepath: str - Path to the page image.
+        image: PIL Image - Optional. The page image, if already loaded.
+            Loaded from filepath if not provided.
+
+    Returns:
+        dict of str -> str: Derivative names mapped to their paths.
+    """
+    if image is None:
+        image = PILImage.open(filepath)
+
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    paths = {}
+    for size, long_side in PAGE_IMAGE_DERIVATIVES.items():
+        derivative = image.copy()
+        # Only ever scales down, keeping the aspect ratio.
+        derivative.thumbnail((long_side, long_side), PILImage.LANCZOS)
+        paths[size] = page_image_derivative_path(filepath, size)
+        derivative.save(paths[size], 'WEBP', quality=PAGE_IMAGE_DERIVATIVE_QUALITY)
+
+    return paths
+
+
+def rasterize_pdf_pages(pdf_path, output_folder, dpi, first_page, last_page,
+        image_format=PAGE_IMAGE_FORMAT):
+    """Render a range of a PDF's pages and save them as images.
+
+    Runs in a rasterization process (see iter_pdf_pages), so rendering, hashing
+    and encoding (incl. of the page's derivatives, see
+    save_page_image_derivatives) all happen off the event loop process and its
+    GIL.
+
+    Args:
+        pdf_path: str - Path to the PDF file.
+        output_folder: str - Path of folder to save images to.
+        dpi: int - Capture resolution.
+        first_page: int - Number of the first page to render.
+        last_page: int - Number of the last page to render.
+        image_format: str - 'PNG' or 'WEBP'. Default PAGE_IMAGE_FORMAT.
+
+    Returns:
+        list of dict: List of dictionaries, each with a page's info: number,
+            filepath and image_hash (see image.Image.content_hash).
+    """
+    images = convert_from_path(
+        pdf_path, dpi=dpi, first_page=first_page, last_page=last_page
+    )
 
-    save_tasks = []
     pages = []
-    for i, image in enumerate(images):
-        page_number = i + 1
-        output_image_path = os.path.join(output_folder, f'{page_number}.png')
+    for page_number, image in enumerate(images, start=first_page):
+        output_image_path = os.path.join(
+            output_folder, f'{page_number}.{image_format.lower()}'
+        )
+        if image_format == 'WEBP':
+            image.save(output_image_path, 'WEBP', lossless=True)
+        else:
+            image.save(output_image_path, 'PNG')
+
+        save_page_image_derivatives(output_image_path, image)
+
         pages.append(
             {
                 'number': page_number,
                 'filepath': output_image_path,
+                'image_hash': Image(image).content_hash(),
             }
         )
-        save_tasks.append(save_image(image, output_image_path))
-
-    await asyncio.gather(*save_tasks)
 
     return pages
 
 
+async def iter_pdf_pages(pdf_path, output_folder, dpi=200, memory_budget=None,
+        first_page=1):
+    """Convert a PDF's pages to images a few at a time, yielding each as it's saved.
+
+    Windows of consecutive pages are fanned out to a pool of
+    RASTERIZATION_WORKERS processes. Only one window per process is in flight
+    at any one time, with windows sized so that the decoded images fit within
+    memory_budget. Peak memory therefore doesn't grow with the number of pages
+    in the document.
+
+    Pages are yielded in order.
+
+    Args:
+        pdf_path: str - Path to the PDF file.
+        output_folder: str - Path of folder to save images to.
+        dpi: int - Capture resolution. Default 200.
+        memory_budget: int - Maximum number of bytes of decoded page images to
+            hold at a time. Default RASTERIZATION_MEMORY_BUDGET. At least one
+            page per process is always rendered at a time, regardless of this
+            value.
+        first_page: int - Number of the page to start from. Earlier pages are
+            skipped. Default 1.
+
+    Yields:
+        dict: A page's info: number, filepath and image_hash.
+    """
+    if memory_budget is None:
+        memory_budget = RASTERIZATION_MEMORY_BUDGET
+
+    pdf_info = await asyncio.to_thread(pdfinfo_from_path, pdf_path)
+    num_pages = pdf_info['Pages']
+    if first_page > num_pages:
+        return
+
+    # Small enough to fit the budget with every process busy, and to keep
+    # every process busy on shorter documents.
+    window_size = max(1, min(
+        memory_budget // (estimate_page_image_size(pdf_info, dpi) * RASTERIZATION_WORKERS),
+        -(-(num_pages - first_page + 1) // RASTERIZATION_WORKERS)
+    ))
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    loop = asyncio.get_running_loop()
+    pool = get_rasterization_pool()
+    in_flight = deque()
+    try:
+        for window_start in range(first_page, num_pages + 1, window_size):
+            window_end = min(window_start + window_size - 1, num_pages)
+            in_flight.append(
+                loop.run_in_executor(
+                    pool, rasterize_pdf_pages, pdf_path, output_folder, dpi,
+                    window_start, window_end
+                )
+            )
+
+            if len(in_flight) >= RASTERIZATION_WORKERS:
+                for page in await in_flight.popleft():
+                    yield page
+
+        while in_flight:
+            for page in await in_flight.popleft():
+                yield page
+
+    finally:
+        # e.g. if the consumer stops early.
+        for window in in_flight:
+            window.cancel()
+
+
+async def save_pdf_as_images(pdf_path, output_folder, dpi=200):
+    """Given a PDF file path convert and save its pages as images.
+
+    Prefer iter_pdf_pages where pages can be handled as they are produced.
+
+    Args:
+        pdf_path: str - Path to the PDF file.
+        output_folder: str - Path of folter to save images to.
+        dpi: int - Capture resolution. Default 200.
+
+    Returns:
+        list of dict: List of dictionaries, each with a page's info:
+            number and filepath.
+    """
+    return [page async for page in iter_pdf_pages(pdf_path, output_folder, dpi=dpi)]
+
+
 def read_text_file(filepath, ignore_comments=False):
     """Read and return the contents of a text file.
 